@@ -1,6 +1,6 @@
 import numpy as np
-import cv2
 import math
+import torch
 
 
 def precision(true_positives, predicted_positives):
@@ -13,44 +13,70 @@ def recall(true_positives, possible_positives):
 def f1_score(recalls, precisions):
     return 2. / (1. / recalls + 1. / precisions + 0.000001)
 
-def metrics_pred(pred_b , images, masks):
+def confusion_counts(pred_b, masks, thresholds=0.5):
     '''
-    :param pred_b: shape of (bs, H, W), per pixel class
-    :param gt_b:  shape of (bs, H, W), per pixel class
-    :param labels:
-    :return:
+    batched segmentation counts at every threshold, computed in one pass on the device of pred_b
+    :param pred_b: tensor of shape (bs, H, W), per pixel probability, a pixel is predicted when above a threshold
+    :param masks: tensor of shape (bs, H, W), per pixel class, binarized at 0.5
+    :param thresholds: a threshold or a sequence of T thresholds
+    :return: true_positives, false_positives, false_negatives, union_areas, int64 tensors of shape (T, bs),
+     or (bs,) for a single threshold
     '''
-    bs = pred_b.shape[0]
-    true_positives = []
-    predicted_positives = []
-    possible_positives = []
-    union_areas = []
+    pred_b = torch.as_tensor(pred_b).detach()
+    masks = torch.as_tensor(masks, device=pred_b.device).detach()
+    single = not isinstance(thresholds, (list, tuple)) and not torch.is_tensor(thresholds)
+    thresholds = torch.as_tensor([thresholds] if single else thresholds, dtype=pred_b.dtype,
+                                 device=pred_b.device).reshape(-1)
+    bs, num_thresholds = pred_b.size(0), thresholds.numel()
+    sorted_thresholds, order = torch.sort(thresholds)
+    # the bin of a pixel is the number of thresholds below it, it is predicted at these thresholds only
+    bins = torch.bucketize(pred_b.reshape(bs, -1), sorted_thresholds)
+    bins = bins + torch.arange(bs, device=bins.device).unsqueeze(1) * (num_thresholds + 1)
+    positive = masks.reshape(bs, -1) > 0.5
+    size = bs * (num_thresholds + 1)
+    predicted = torch.bincount(bins.reshape(-1), minlength=size).view(bs, num_thresholds + 1)
+    true = torch.bincount(bins[positive], minlength=size).view(bs, num_thresholds + 1)
+    # counts above each sorted threshold, then back in the order of thresholds
+    inverse = torch.argsort(order)
+    predicted = predicted.flip(1).cumsum(1).flip(1)[:, 1:][:, inverse].t()
+    true_positives = true.flip(1).cumsum(1).flip(1)[:, 1:][:, inverse].t()
+    possible = positive.sum(1).unsqueeze(0)
+    false_positives = predicted - true_positives
+    false_negatives = possible - true_positives
+    union_areas = predicted + false_negatives
+    if single:
+        return true_positives[0], false_positives[0], false_negatives[0], union_areas[0]
+    return true_positives, false_positives, false_negatives, union_areas
 
-    for i in range(bs):
-        heatmap = pred_b[i].copy()
-        pred_b[i][pred_b[i] > 0.5] = 1
-        pred_b[i][pred_b[i] <= 0.5] = 0
 
-        masks[i][masks[i] > 0.5] = 1
-        masks[i][masks[i] <= 0.5] = 0
-
-        predicted_positive = pred_b[i].astype(np.int32).sum()
-        possible_positive = masks[i].astype(np.int32).sum()
-        true_positive = np.logical_and(pred_b[i], masks[i]).astype(np.int32).sum()
-
-        union_area = np.logical_or(pred_b[i], masks[i]).sum()
-
-        im_color = cv2.applyColorMap((pred_b[i] * 250).astype(np.uint8), cv2.COLORMAP_JET)
-        # cv2.imshow("pred",im_color)
-        # cv2.imshow("mask", masks[i])
-        # cv2.imshow("images", cv2.cvtColor(np.transpose(images[i], (1, 2, 0)),cv2.COLOR_RGB2BGR))
-        # cv2.waitKey(0)
+def pr_curve(true_positives, false_positives, false_negatives):
+    '''
+    the precision and recall at every threshold of counts summed over a dataset, clamped like precision and recall
+    :param true_positives, false_positives, false_negatives: tensors of shape (T,)
+    :return: precisions, recalls, float64 tensors of shape (T,)
+    '''
+    true_positives = true_positives.double()
+    precisions = true_positives / (true_positives + false_positives + 0.000001)
+    recalls = true_positives / (true_positives + false_negatives + 0.000001)
+    return precisions.clamp(0.00001, 1.0), recalls.clamp(0.00001, 1.0)
 
-        true_positives.append(true_positive)
-        predicted_positives.append(predicted_positive)
-        possible_positives.append(possible_positive)
-        union_areas.append(union_area)
 
-    return true_positives, predicted_positives, possible_positives, union_areas
+def metrics_pred(pred_b, images, masks):
+    '''
+    :param pred_b: shape of (bs, H, W), per pixel probability
+    :param masks:  shape of (bs, H, W), per pixel class
+    :return: the true positive, predicted positive, possible positive and union area of every sample, as lists
+    '''
+    true_positives, false_positives, false_negatives, union_areas = confusion_counts(pred_b, masks)
+    return (true_positives.tolist(), (true_positives + false_positives).tolist(),
+            (true_positives + false_negatives).tolist(), union_areas.tolist())
 
 
+def pixel_counts(pred_b, masks, threshold=0.5):
+    '''
+    the counts of metrics_pred summed over the batch, left on the device of pred_b
+    :return: true_positive, predicted_positive, possible_positive, as 0-dim tensors
+    '''
+    true_positives, false_positives, false_negatives, _ = confusion_counts(pred_b, masks, threshold)
+    true_positive = true_positives.sum()
+    return true_positive, true_positive + false_positives.sum(), true_positive + false_negatives.sum()
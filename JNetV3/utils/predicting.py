@@ -3,19 +3,18 @@ import torch
 from torch.autograd import Variable
 import torch.nn.functional as F
 import numpy as np
-from JNetV3.utils.metrics import metrics_pred, precision, recall, f1_score
+from JNetV3.utils.metrics import confusion_counts, precision, recall, f1_score
+from vision.utils.misc import RunningSums
 
-def predict(loss_fn, model, data_set, data_loader, counting=False):
-    """ Validate after training an epoch
-    Note:
+
+def validation_counts(loss_fn, model, data_set, data_loader, thresholds=(0.5,), counting=False):
+    """ Run the model over a validation set once and count its pixels at every threshold
+    Note: the counts are summed on the gpu, PR curves come out of pr_curve
+    Returns: true_positives, false_positives, false_negatives of shape (T,), and the mean loss
     """
     model.eval()
 
-    true_positives = []
-    predicted_positives = []
-    possible_positives = []
-    union_areas = []
-    loss = []
+    running = RunningSums()
     for bc_cnt, bc_data in enumerate(data_loader):
         if counting:
             print('%d/%d' % (bc_cnt, len(data_set)//data_loader.batch_size))
@@ -24,7 +23,8 @@ def predict(loss_fn, model, data_set, data_loader, counting=False):
         masks = Variable(masks).cuda()
         # labels = Variable(labels).cuda()
 
-        outputs = model(imgs)
+        with torch.no_grad():
+            outputs = model(imgs)
 
         outputs = outputs.view(-1, outputs.size()[2], outputs.size()[3])
 
@@ -33,27 +33,26 @@ def predict(loss_fn, model, data_set, data_loader, counting=False):
             outputs = F.upsample(outputs, size=masks.size()[-2:], mode='bilinear')
 
         # loss = criterion(outputs, masks)
-
-        loss.append(float(loss_fn(outputs, masks)))
-        # loss.append(loss_fn(outputs, masks))
         # outputs = F.softmax(model(imgs), dim=1)
         # if outputs.size() != masks.size():
         #     outputs = F.upsample(outputs, size=masks.size()[-2:], mode='bilinear')
         #
         # _, outputs = torch.max(outputs, dim=1)
-        outputs = outputs.cpu().data.numpy()
-        # labels = labels.cpu().data.numpy()
-        masks = masks.cpu().data.numpy()
-        imgs = imgs.cpu().data.numpy()
-
-        true_positive, predicted_positive, possible_positive, union_area = metrics_pred(outputs,imgs,masks)
-
-        true_positives += true_positive
-        predicted_positives += predicted_positive
-        possible_positives += possible_positive
-        union_areas += union_area
-    precisions = precision(true_positives, predicted_positives)
-    recalls = recall(true_positives, possible_positives)
+        true_positives, false_positives, false_negatives, _ = confusion_counts(outputs, masks, list(thresholds))
+        running.add(loss=loss_fn(outputs, masks), true_positives=true_positives.sum(1),
+                    false_positives=false_positives.sum(1), false_negatives=false_negatives.sum(1))
+    counts = {name: value.cpu() for name, value in running.sums.items()}
+    loss = counts['loss'].item() / max(running.count, 1)
+    return counts['true_positives'], counts['false_positives'], counts['false_negatives'], loss
+
+
+def predict(loss_fn, model, data_set, data_loader, counting=False):
+    """ Validate after training an epoch
+    Note:
+    """
+    true_positives, false_positives, false_negatives, loss = validation_counts(
+        loss_fn, model, data_set, data_loader, counting=counting)
+    precisions = precision(true_positives.numpy(), (true_positives + false_positives).numpy())
+    recalls = recall(true_positives.numpy(), (true_positives + false_negatives).numpy())
     f1_scores = f1_score(recalls, precisions)
-    loss = torch.tensor(loss)
-    return precisions, recalls, f1_scores, loss.mean()
+    return precisions, recalls, f1_scores, loss
@@ -6,14 +6,15 @@ import logging
 import torch.nn.functional as F
 import numpy as np
 from math import ceil
-from copy import deepcopy
 # from JNetV3.logs import *
 from JNetV3.utils.preprocessing import *
 from torchvision.utils import make_grid
 from tensorboardX import SummaryWriter
 from JNetV3.utils.plotting import getPlotImg
 from JNetV3.utils.predicting import predict
-from JNetV3.utils.metrics import metrics_pred, precision, recall, f1_score
+from JNetV3.utils.metrics import pixel_counts, precision, recall, f1_score
+from vision.utils.checkpoint import CheckpointManager, snapshot
+from vision.utils.misc import RunningSums
 
 dt = datetime.datetime.now().strftime('%b-%d-%h-%m-%s')
 def cross_entropy_loss_RCF(prediction, label):
@@ -58,13 +59,18 @@ def train(model,
           save_dir,
           print_inter=200,
           val_inter=3500,
+          keep_best=3,
+          keep_last=2,
           ):
     writer = SummaryWriter(save_dir)
+    checkpoints = CheckpointManager(save_dir, keep_best=keep_best, keep_last=keep_last, higher_is_better=True)
     best_model_wts = model.state_dict()
     best_f1 = 0
     val_loss = 0
     train_loss = 0
     # running_loss = 20
+    # the pixel counts are summed on the gpu and only read back every print_inter steps
+    running = RunningSums()
     step = -1
     for epoch in range(start_epoch,epoch_num):
         # train phase
@@ -94,17 +100,14 @@ def train(model,
 
                 if test_f1_scores > best_f1:
                     best_f1 = test_f1_scores
-                    best_model_wts = deepcopy(model.state_dict())
+                    best_model_wts = snapshot(model.state_dict())
 
-                # save model
-                save_path1 = os.path.join(save_dir,
-                                          'weights-%d-%d-[%.3f].pth' % (epoch, batch_cnt, test_f1_scores))
-                torch.save(model.state_dict(), save_path1)
-                save_path2 = os.path.join(save_dir,
-                                          'optimizer-state.pth')
-                torch.save(optimizer.state_dict(), save_path2)
+                # save model, the optimizer state is saved next to the weights
+                save_path1 = checkpoints.save(model, 'weights-%d-%d-[%.3f]' % (epoch, batch_cnt, test_f1_scores),
+                                              test_f1_scores, epoch=epoch, optimizer=optimizer,
+                                              extra={'step': step, 'batch_cnt': batch_cnt})
 
-                logging.info('saved model to %s' % (save_path1))
+                logging.info('saving model to %s' % (save_path1))
                 logging.info('--' * 30)
 
 
@@ -145,14 +148,16 @@ def train(model,
             # batch_corrects = torch.sum((preds==masks).long()).data[0]
             # batch_acc = 1.*batch_corrects / (masks.size(0)*masks.size(1)*masks.size(2))
 
-            true_positives, predicted_positives, possible_positives, union_areas = metrics_pred(outputs.data.cpu().numpy(),\
-                             imgs.cpu().data.numpy(), masks.cpu().data.numpy())
-
-            train_precisions = precision(true_positives, predicted_positives)
-            train_recalls = recall(true_positives, possible_positives)
-            train_f1_scores = f1_score(train_recalls, train_precisions)
+            true_positives, predicted_positives, possible_positives = pixel_counts(outputs, masks)
+            running.add(true_positives=true_positives, predicted_positives=predicted_positives,
+                        possible_positives=possible_positives)
 
             if step % print_inter == 0:
+                counts = running.totals()
+                running.reset()
+                train_precisions = precision(counts['true_positives'], counts['predicted_positives'])
+                train_recalls = recall(counts['true_positives'], counts['possible_positives'])
+                train_f1_scores = f1_score(train_recalls, train_precisions)
                 logging.info('%s [%d-%d] | train_loss: %.4f | precisions: %.4f | recalls: %.4f | f1_scores: %.4f'
                              % (dt, epoch, batch_cnt, train_loss, train_precisions, train_recalls, train_f1_scores))
 
@@ -172,6 +177,7 @@ def train(model,
                 writer.add_scalar('val_loss', val_loss, step)
 
 
+    checkpoints.close()
     # save best model
     save_path = os.path.join(save_dir,
                              'bestweights-[%.3f].pth' % (best_f1))
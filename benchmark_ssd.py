@@ -0,0 +1,68 @@
+import argparse
+import logging
+import sys
+import time
+
+import torch
+
+from vision.utils.misc import autocast, str2bool
+from vision.ssd import registry
+
+
+parser = argparse.ArgumentParser(description="Compare the speed and memory of the SSD networks in float32 and under autocast.")
+parser.add_argument('--net', default="jnet-ssd-lite",
+                    help=f"The network architecture, it can be {', '.join(registry.net_names())}.")
+parser.add_argument('--batch_size', default=4, type=int)
+parser.add_argument('--iterations', default=20, type=int)
+parser.add_argument('--warmup', default=3, type=int)
+parser.add_argument('--use_cuda', default=True, type=str2bool)
+args = parser.parse_args()
+DEVICE = torch.device("cuda:0" if torch.cuda.is_available() and args.use_cuda else "cpu")
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+def synchronize():
+    if DEVICE.type == "cuda":
+        torch.cuda.synchronize(DEVICE)
+
+
+def run(net, images, mixed_precision, train):
+    """Average seconds per iteration and peak GPU memory in MB, None on CPU."""
+    net.train(train)
+    if DEVICE.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(DEVICE)
+    for i in range(args.warmup + args.iterations):
+        if i == args.warmup:
+            synchronize()
+            start = time.time()
+        with torch.set_grad_enabled(train), autocast(DEVICE, mixed_precision):
+            outputs = net(images)
+        if train:
+            # a stand-in loss, reduced in float32 like MultiboxLoss
+            sum(output.float().mean() for output in outputs).backward()
+            net.zero_grad()
+    synchronize()
+    elapsed = (time.time() - start) / args.iterations
+    memory = torch.cuda.max_memory_allocated(DEVICE) / 2 ** 20 if DEVICE.type == "cuda" else None
+    return elapsed, memory
+
+
+if __name__ == '__main__':
+    if args.net not in registry.net_names():
+        logging.fatal("The net type is wrong.")
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    config = registry.get_config(args.net)
+    net = registry.create_net(args.net, 2).to(DEVICE)
+    images = torch.rand(args.batch_size, 3, config.image_size, config.image_size, device=DEVICE)
+    for train in [False, True]:
+        results = {mixed_precision: run(net, images, mixed_precision, train) for mixed_precision in [False, True]}
+        for mixed_precision, (elapsed, memory) in results.items():
+            logging.info(
+                f"{'Train' if train else 'Inference'}, " +
+                f"{'autocast' if mixed_precision else 'float32'}: " +
+                f"{elapsed * 1000:.1f} ms/iteration, " +
+                f"speedup {results[False][0] / elapsed:.2f}x" +
+                (f", peak memory {memory:.0f} MB" if memory is not None else "")
+            )
@@ -1,7 +1,4 @@
-from vision.ssd.vgg_ssd import create_vgg_ssd
-from vision.ssd.mobilenetv1_ssd import create_mobilenetv1_ssd
-from vision.ssd.mobilenetv1_ssd_lite import create_mobilenetv1_ssd_lite
-from vision.ssd.squeezenet_ssd_lite import create_squeezenet_ssd_lite
+from vision.ssd import registry
 
 import sys
 import torch.onnx
@@ -20,17 +17,10 @@ label_path = sys.argv[3]
 class_names = [name.strip() for name in open(label_path).readlines()]
 num_classes = len(class_names)
 
-if net_type == 'vgg16-ssd':
-    net = create_vgg_ssd(len(class_names), is_test=True)
-elif net_type == 'mb1-ssd':
-    net = create_mobilenetv1_ssd(len(class_names), is_test=True)
-elif net_type == 'mb1-ssd-lite':
-    net = create_mobilenetv1_ssd_lite(len(class_names), is_test=True)
-elif net_type == 'sq-ssd-lite':
-    net = create_squeezenet_ssd_lite(len(class_names), is_test=True)
-else:
-    print("The net type is wrong. It should be one of vgg16-ssd, mb1-ssd and mb1-ssd-lite.")
+if net_type not in registry.net_names():
+    print(f"The net type is wrong. It should be one of {', '.join(registry.net_names())}.")
     sys.exit(1)
+net = registry.create_net(net_type, len(class_names), is_test=True)
 net.load(model_path)
 net.eval()
 
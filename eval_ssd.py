@@ -1,19 +1,22 @@
 import torch
+from torch.utils.data import DataLoader
 
 from vision.datasets.voc_dataset import VOCDataset
 
 from vision.utils.misc import str2bool, Timer
+from vision.utils import measurements
+from vision.utils.manifest import file_digest
+from vision.transforms.transforms import CvtRatio
 import argparse
+import json
+import os
 import pathlib
 import numpy as np
 
-import random
-
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite_predictor
+from vision.ssd.config import mobilenetv1_ssd_config as config
 import cv2
-import string
-import imutils
 parser = argparse.ArgumentParser(description="SSD Evaluation on VOC Dataset.")
 # model_log/jnet-ssd-lite-Epoch-210-Loss-0.6506194928113151.pth
 parser.add_argument("--trained_model", default= 'model_log/jnet-ssd-lite-Epoch-1080-Loss-0.6063801158558239.pth', type=str)
@@ -27,42 +30,127 @@ parser.add_argument("--iou_threshold", type=float, default=0.5, help="The thresh
 parser.add_argument("--eval_dir", default="eval_results", type=str, help="The directory to store evaluation results.")
 parser.add_argument('--mb2_width_mult', default=1.0, type=float,
                     help='Width Multiplifier for MobilenetV2')
+parser.add_argument('--batch_size', default=8, type=int, help='The number of images predicted in one forward pass.')
+parser.add_argument('--num_workers', default=4, type=int, help='The number of workers loading the test images.')
+parser.add_argument('--prob_threshold', default=0.01, type=float,
+                    help='The lowest probability of the predicted, and cached, detections.')
+parser.add_argument('--score_thresholds', default="0.4", type=str,
+                    help='Comma separated detection probability thresholds to compute the AP at.')
+parser.add_argument('--iou_thresholds', default=None, type=str,
+                    help='Comma separated IoU thresholds to compute the AP at, --iou_threshold when not given.')
+parser.add_argument('--deskew_angle_tolerance', default=0.0, type=float,
+                    help="Skip the deskew rotation of the pages whose estimated skew is below this many degrees, "
+                         "0 rotates every page.")
+parser.add_argument('--reuse_predictions', default=True, type=str2bool,
+                    help='Reuse the predictions cached in eval_dir when the model, the dataset and the NMS are unchanged.')
 args = parser.parse_args()
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() and args.use_cuda else "cpu")
 # DEVICE = torch.device("cpu")
+CANDIDATE_SIZE = 200
+
+
+class EvalImages:
+
+    def __init__(self, dataset):
+        """The test images of dataset, stretched by CvtRatio.h_ratio and padded to a square like in training."""
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        src_image, gt_mask = self.dataset.get_image(index)
+        image = cv2.resize(src_image, (src_image.shape[1], src_image.shape[0] * CvtRatio.h_ratio))
+        max_edge = max(image.shape[0], image.shape[1])
+        image = cv2.copyMakeBorder(image, 0, max_edge - image.shape[0], 0, max_edge - image.shape[1],
+                                   cv2.BORDER_CONSTANT)
+        return index, image, gt_mask, max_edge
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def _collate_list(batch):
+    return list(zip(*batch))
+
 
 def group_annotation_by_class(dataset):
-    true_case_stat = {}
-    all_gt_boxes = {}
-    all_difficult_cases = {}
+    """The ground truth of every class as flat arrays of image indexes, boxes and difficult flags."""
+    gt = {}
     for i in range(len(dataset)):
-        image_id, annotation = dataset.get_annotation(i)
-        gt_boxes, classes, is_difficult = annotation
-        gt_boxes = torch.from_numpy(gt_boxes)
-        for i, difficult in enumerate(is_difficult):
-            class_index = int(classes[i])
-            gt_box = gt_boxes[i]
-            if not difficult:
-                true_case_stat[class_index] = true_case_stat.get(class_index, 0) + 1
-
-            if class_index not in all_gt_boxes:
-                all_gt_boxes[class_index] = {}
-            if image_id not in all_gt_boxes[class_index]:
-                all_gt_boxes[class_index][image_id] = []
-            all_gt_boxes[class_index][image_id].append(gt_box)
-            if class_index not in all_difficult_cases:
-                all_difficult_cases[class_index]={}
-            if image_id not in all_difficult_cases[class_index]:
-                all_difficult_cases[class_index][image_id] = []
-            all_difficult_cases[class_index][image_id].append(difficult)
-
-    for class_index in all_gt_boxes:
-        for image_id in all_gt_boxes[class_index]:
-            all_gt_boxes[class_index][image_id] = torch.stack(all_gt_boxes[class_index][image_id])
-    for class_index in all_difficult_cases:
-        for image_id in all_difficult_cases[class_index]:
-            all_gt_boxes[class_index][image_id] = torch.tensor(all_gt_boxes[class_index][image_id])
-    return true_case_stat, all_gt_boxes, all_difficult_cases
+        _, (gt_boxes, classes, is_difficult) = dataset.get_annotation(i)
+        for class_index in np.unique(classes):
+            selected = classes == class_index
+            image_ids, boxes, difficult = gt.setdefault(int(class_index), ([], [], []))
+            image_ids.append(np.full(selected.sum(), i))
+            boxes.append(gt_boxes[selected])
+            difficult.append(is_difficult[selected])
+    return {class_index: tuple(np.concatenate(values) for values in arrays) for class_index, arrays in gt.items()}
+
+
+def boxes_to_source(boxes, Matrix, factor, max_edge, margin=5):
+    """Map the predicted boxes from the deskewed network input back to axis aligned boxes of the source image."""
+    size = config.image_size
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x1 = np.minimum(boxes[:, 0] + margin, size - 1) / factor[0]
+    y1 = np.minimum(boxes[:, 1] + margin, size - 1) / factor[1]
+    x2 = np.maximum(boxes[:, 2] - margin, boxes[:, 0]) / factor[0]
+    y2 = np.maximum(boxes[:, 3] - margin, boxes[:, 1]) / factor[1]
+    # (N, 4 corners, x y 1)
+    corners = np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1),
+                        np.stack([x2, y2], 1), np.stack([x1, y2], 1)], 1)
+    corners = np.concatenate([corners, np.ones(corners.shape[:2] + (1,))], 2)
+    corners = corners @ np.asarray(Matrix, dtype=np.float64).T
+    corners = corners * (max_edge / float(size))
+    corners[:, :, 1] /= CvtRatio.h_ratio
+    return np.concatenate([corners.min(1), corners.max(1)], 1)
+
+
+def predict_dataset(predictor, dataset):
+    """Stream the dataset through the predictor in batches, the images being loaded by a pool of workers.
+
+    Returns:
+        the image indexes, probabilities, labels and source image boxes of all the detections.
+    """
+    loader = DataLoader(EvalImages(dataset), args.batch_size, shuffle=False, num_workers=args.num_workers,
+                        collate_fn=_collate_list)
+    image_ids, probs, labels, boxes = [], [], [], []
+    for indexes, images, gt_masks, max_edges in loader:
+        print(f"process images {indexes[0]}-{indexes[-1]}")
+        results = predictor.predict_batch(images, gt_masks, prob_threshold=args.prob_threshold)
+        for index, max_edge, result in zip(indexes, max_edges, results):
+            if len(result) < 7:
+                continue
+            picked_boxes, picked_labels, picked_probs, _, _, Matrix, factor = result
+            image_ids.append(np.full(picked_boxes.size(0), index))
+            probs.append(picked_probs.numpy())
+            labels.append(picked_labels.numpy())
+            boxes.append(boxes_to_source(picked_boxes.numpy(), Matrix, factor, max_edge))
+    if not image_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros((0, 4))
+    return np.concatenate(image_ids), np.concatenate(probs), np.concatenate(labels), np.concatenate(boxes)
+
+
+def load_predictions(cache_file, meta):
+    meta_file = cache_file.with_suffix('.json')
+    if not (args.reuse_predictions and cache_file.exists() and meta_file.exists()):
+        return None
+    with open(meta_file) as f:
+        if json.load(f) != meta:
+            return None
+    cached = np.load(cache_file)
+    return cached['image_ids'], cached['probs'], cached['labels'], cached['boxes']
+
+
+def save_predictions(cache_file, meta, image_ids, probs, labels, boxes):
+    np.savez(cache_file, image_ids=image_ids, probs=probs, labels=labels, boxes=boxes)
+    with open(cache_file.with_suffix('.json'), "w") as f:
+        json.dump(meta, f)
+
+
+def write_detections(path, dataset, image_ids, probs, boxes):
+    # the det_test_{class}.txt layout read by draw_eval_results.py
+    with open(path, "w") as f:
+        for image_id, prob, box in zip(image_ids, probs, boxes):
+            f.write(f"{dataset.ids[image_id]} {prob} {box[0]} {box[1]} {box[2]} {box[3]}\n")
+
 
 if __name__ == '__main__':
     eval_path = pathlib.Path(args.eval_dir)
@@ -71,76 +159,75 @@ if __name__ == '__main__':
     class_names = [name.strip() for name in open(args.label_file).readlines()]
     dataset = VOCDataset(args.dataset, is_test=True)
 
-    true_case_stat, all_gb_boxes, all_difficult_cases = group_annotation_by_class(dataset)
-
-    net = create_imJnet_ssd_lite(len(class_names), width_mult=args.mb2_width_mult, is_test=True)
-
-    import collections
-    timer.start("Load Model")
-    # net.load(args.trained_model)
-    pretrained_dict = torch.load(args.trained_model)
-    # new_state_dict = collections.OrderedDict()
-    # for k, v in pretrained_dict.items():
-    #     print(k)
-    #     name = k[7:]
-    #     new_state_dict[name] = v
-    net.load_state_dict(pretrained_dict)
-    net = net.to(DEVICE)
-    print(f'It took {timer.end("Load Model")} seconds to load the model.')
-
-    predictor = create_imJnet_ssd_lite_predictor(net, nms_method=args.nms_method, device=DEVICE)
-
-    for i in range(len(dataset)):
-        print("process image", i)
-        timer.start("Load Image")
-        src_image, gt_mask = dataset.get_image(i)
-        # image = imutils.resize(image,image.shape[1], image.shape[0] * 2)
-        image = cv2.resize(src_image,(src_image.shape[1], src_image.shape[0] * 2))
-        max_edge = max(image.shape[0], image.shape[1])
-        image = cv2.copyMakeBorder(image, 0, max_edge - image.shape[0], 0, max_edge - image.shape[1],cv2.BORDER_CONSTANT)
-
-        print("Load Image: {:4f} seconds.".format(timer.end("Load Image")))
+    gt_by_class = group_annotation_by_class(dataset)
+
+    cache_file = eval_path / "predictions.npz"
+    # everything the predictions depend on, the checkpoint by its contents so that a rewritten one is never reused
+    meta = {'model': os.path.abspath(args.trained_model), 'model_digest': file_digest(args.trained_model),
+            'width_mult': args.mb2_width_mult, 'class_names': class_names,
+            'dataset': os.path.abspath(args.dataset), 'ids': list(dataset.ids),
+            'image_size': config.image_size, 'h_ratio': CvtRatio.h_ratio,
+            'deskew_angle_tolerance': args.deskew_angle_tolerance,
+            'nms_method': args.nms_method, 'nms_iou_threshold': config.iou_threshold,
+            'candidate_size': CANDIDATE_SIZE, 'prob_threshold': args.prob_threshold}
+    predictions = load_predictions(cache_file, meta)
+    if predictions is None:
+        net = create_imJnet_ssd_lite(len(class_names), width_mult=args.mb2_width_mult, is_test=True)
+        net.set_deskew_angle_tolerance(args.deskew_angle_tolerance)
+
+        timer.start("Load Model")
+        net.load_state_dict(torch.load(args.trained_model, map_location=lambda storage, loc: storage))
+        net = net.to(DEVICE)
+        print(f'It took {timer.end("Load Model")} seconds to load the model.')
+
+        predictor = create_imJnet_ssd_lite_predictor(net, candidate_size=CANDIDATE_SIZE, nms_method=args.nms_method,
+                                                     device=DEVICE)
         timer.start("Predict")
-        boxes, labels, probs, masks, angle, Matrix, factor= predictor.predict(image, gt_mask)
-        print("Prediction: {:4f} seconds.".format(timer.end("Predict")))
-
-        orig_image = image.copy()
-        image_id, annotation = dataset.get_annotation(i)
-        gt_boxes, classes, is_difficult = annotation
-
-        seg_mask = masks[0]
-        seg_mask = torch.squeeze(seg_mask)
-        seg_mask = seg_mask.cpu().detach().numpy().astype(np.float32)
-
-        ran_str = ''.join(random.sample(string.ascii_letters + string.digits, 20))
-        ocr_cropped_bbox = 'eval_results/bbox/'+ ran_str + ".png"
-        ocr_cropped_heatmap = 'eval_results/heatmap/' + ran_str + ".png"
-        print(factor)
-        final_pts = []
-        for i in range(boxes.size(0)):
-            if probs[i] > 0.4:
-                box = boxes[i, :]
-
-                x1 = min(box[0] + 5, 768-1) / factor[0]
-                y1 = min(box[1] + 5, 768-1) / factor[1]
-                x2 = max(box[2] - 5, box[0]) / factor[0]
-                y2 = max(box[3] - 5, box[1]) / factor[1]
-                pts = np.array([[x1, y1, 1], [x2, y1, 1], [x2, y2, 1], [x1, y2, 1]])
-                # print(pts.T.shape, M.shape)
-                dst_ps = np.dot(Matrix, pts.T).T
-                for p in range(dst_ps.shape[0]):
-                    dst_ps[p, 0] = int(dst_ps[p, 0] * (image.shape[1] / 768.0))
-                    dst_ps[p, 1] = int(dst_ps[p, 1] * (image.shape[1] / 768.0) / 2.0)
-
-                final_pts.append(dst_ps.astype(np.int32))
-
-        for dps in final_pts:
-            b = random.randint(0, 255)
-            g = random.randint(0, 255)
-            r = random.randint(0, 255)
-            cv2.line(src_image, (dps[0,0],dps[0,1]), (dps[2,0],dps[2,1]), (b, g, r), 2)
-            # for p in range(dps.shape[0]):
-                # cv2.circle(src_image, (dps[p,0], dps[p,1]), 2, (b, g, r), 2)
-        cv2.imshow('src_image',src_image)
-        cv2.imshow('seg_mask', seg_mask)
-        cv2.waitKey(0)
+        predictions = predict_dataset(predictor, dataset)
+        print(f'It took {timer.end("Predict")} seconds to predict {len(dataset)} images.')
+        save_predictions(cache_file, meta, *predictions)
+    else:
+        print(f"Reusing the predictions cached in {cache_file}.")
+    image_ids, probs, labels, boxes = predictions
+
+    score_thresholds = [float(t) for t in args.score_thresholds.split(",")]
+    iou_thresholds = [float(t) for t in args.iou_thresholds.split(",")] if args.iou_thresholds else [args.iou_threshold]
+    results = []
+    for class_index, class_name in enumerate(class_names):
+        if class_index == 0:
+            continue  # ignore background
+        selected = labels == class_index
+        write_detections(eval_path / f"det_test_{class_name}.txt", dataset,
+                         image_ids[selected], probs[selected], boxes[selected])
+    for score_threshold in score_thresholds:
+        for iou_threshold in iou_thresholds:
+            aps = {}
+            for class_index, class_name in enumerate(class_names):
+                if class_index == 0:
+                    continue
+                selected = (labels == class_index) & (probs >= score_threshold)
+                gt_image_ids, gt_boxes, gt_difficult = gt_by_class.get(
+                    class_index, (np.zeros(0, dtype=np.int64), np.zeros((0, 4)), np.zeros(0, dtype=np.uint8)))
+                true_positive, false_positive = measurements.match_detections(
+                    image_ids[selected], probs[selected], boxes[selected],
+                    gt_image_ids, gt_boxes, gt_difficult, iou_threshold)
+                num_true_cases = int((gt_difficult == 0).sum())
+                aps[class_name] = {
+                    'voc2007': float(measurements.average_precision(true_positive, false_positive,
+                                                                    num_true_cases, use_2007_metric=True)),
+                    'voc2010': float(measurements.average_precision(true_positive, false_positive,
+                                                                    num_true_cases, use_2007_metric=False)),
+                }
+            metric = 'voc2007' if args.use_2007_metric else 'voc2010'
+            mean_ap = sum(ap[metric] for ap in aps.values()) / max(len(aps), 1)
+            print(f"\nScore threshold {score_threshold}, IoU threshold {iou_threshold}, Average Precision Per-class:")
+            for class_name, ap in aps.items():
+                print(f"{class_name}: {ap[metric]}")
+            print(f"Average Precision Across All Classes:{mean_ap}")
+            results.append({'score_threshold': score_threshold, 'iou_threshold': iou_threshold,
+                            'average_precisions': aps,
+                            'mean_average_precision': {
+                                name: sum(ap[name] for ap in aps.values()) / max(len(aps), 1)
+                                for name in ['voc2007', 'voc2010']}})
+    with open(eval_path / "average_precisions.json", "w") as f:
+        json.dump(results, f, indent=2)
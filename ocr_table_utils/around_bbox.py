@@ -4,8 +4,9 @@ import xml.etree.ElementTree as ET
 import cv2
 import random
 from lxml import etree
-import string
 import os
+# run from the repository root as python -m ocr_table_utils.around_bbox
+from vision.utils.manifest import GenerationManifest, file_digest
 
 class OcrDataset:
 
@@ -142,83 +143,94 @@ class VOCAnnotation(object):
         tree = etree.ElementTree(self._annotation)
         tree.write(saveFileName, pretty_print=True)
 
+def crop_areas(dataset, image_id, annotation):
+    """The regions around the cells of a page, with the cell boxes inside every region."""
+    image = dataset._read_image(image_id)
+    gt_boxes, classes, is_difficult = annotation
+    mask = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) * 0
+    for jdx in range(gt_boxes.shape[0]):
+
+        box = gt_boxes[jdx, :].astype(np.int32)
+        # cv2.rectangle(image, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
+        mask[box[1]: box[3],box[0]: box[2]] = mask[box[1]: box[3],box[0]: box[2]] * 0 + 1
+
+    contours = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    area_list = []
+    for jdx in range(0, len(contours)):
+        x, y, w, h = cv2.boundingRect(contours[jdx])
+        detla_x = random.randint(4, 8)
+        detla_y = random.randint(4, 8)
+        detla_w = random.randint(8, 16)
+        detla_h = random.randint(8, 16)
+        x = max(0, x - detla_x)
+        y = max(0, y - detla_y)
+        w = min(x + w + detla_w, image.shape[1]) - x
+        h = min(y + h + detla_h, image.shape[0]) - y
+
+        area_box = []
+        area = image[y: y + h, x: x + w, :]
+        for kdx in range(gt_boxes.shape[0]):
+            box = gt_boxes[kdx, :].astype(np.int32)
+            if box[0] >= x and box[2] <= x + w and box[1] >= y and box[3] <= y + h:
+                area_box.append([box[0] - x + 1, box[1] - y + 1, box[2] - x - 1, box[3] - y - 1])
+        area_list.append([area_box, area])
+
+        # cv2.rectangle(con_img, (x, y), (x + w, y + h), (153, 153, 0), 5)
+    return area_list
+
+
+def save_area(ocr_cropped_root, name, boxes, area):
+    """Write the crop and its annotation, each replacing the previous one at once."""
+    ocr_cropped_xml = os.path.join(ocr_cropped_root, 'Annotations', '01', name + ".xml")
+    ocr_cropped_img = os.path.join(ocr_cropped_root, 'Images', '01', name + ".png")
+
+    voc = VOCAnnotation(name + ".png", area.shape[1], area.shape[0])
+    for box in boxes:
+        # cv2.rectangle(area, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
+        voc.addBoundingBox(box[0], box[1], box[2], box[3], "1111")
+
+    voc.save(ocr_cropped_xml + ".tmp")
+    cv2.imwrite(ocr_cropped_img + ".tmp.png", area)
+    os.replace(ocr_cropped_xml + ".tmp", ocr_cropped_xml)
+    os.replace(ocr_cropped_img + ".tmp.png", ocr_cropped_img)
+    return [ocr_cropped_xml, ocr_cropped_img]
+
+
 if __name__ == "__main__":
     ocr_cropped_root = '/media/handsome/backupdata/hanson/orc_cropped'
+    dataset_root = "/media/handsome/backupdata/hanson/ocr_table_dataset"
     is_test = False
     if is_test:
         txt_file = ocr_cropped_root + "/test.txt"
     else:
         txt_file = ocr_cropped_root + "/trainval.txt"
-    dataset = OcrDataset("/media/handsome/backupdata/hanson/ocr_table_dataset", is_test=is_test)
+    dataset = OcrDataset(dataset_root, is_test=is_test)
 
     print(len(dataset.ids))
-    area_list = []
-    for idx in range(len(dataset.ids)):
-        image_id, annotation = dataset.get_annotation(idx)
-        image = dataset._read_image(image_id)
-        gt_boxes, classes, is_difficult = annotation
-        mask = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) * 0
-        for jdx in range(gt_boxes.shape[0]):
-
-            box = gt_boxes[jdx, :].astype(np.int32)
-            # cv2.rectangle(image, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
-            mask[box[1]: box[3],box[0]: box[2]] = mask[box[1]: box[3],box[0]: box[2]] * 0 + 1
-
-        con_img, contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-
-        for jdx in range(0, len(contours)):
-            x, y, w, h = cv2.boundingRect(contours[jdx])
-            detla_x = random.randint(4, 8)
-            detla_y = random.randint(4, 8)
-            detla_w = random.randint(8, 16)
-            detla_h = random.randint(8, 16)
-            x = max(0, x - detla_x)
-            y = max(0, y - detla_y)
-            w = min(x + w + detla_w, image.shape[1]) - x
-            h = min(y + h + detla_h, image.shape[0]) - y
-            # xmin = max(0, xmin - 5)
-            # ymin = max(0, ymin - 5)
-            # xmax = min(w, xmax + 5)
-            # ymax = min(h, ymax + 5)
-            #
-            # y1 = y + 1
-            # y2 = y + h - 1
-            # x1 = x + 1
-            # x2 = x + w - 1
-            #
-            area_box = []
-            area = image[y: y + h, x: x + w, :]
-            for jdx in range(gt_boxes.shape[0]):
-                box = gt_boxes[jdx, :].astype(np.int32)
-                if box[0] >= x and box[2] <= x + w and box[1] >= y and box[3] <= y + h:
-                    area_box.append([box[0] - x + 1, box[1] - y + 1, box[2] - x - 1, box[3] - y - 1])
-            area_list.append([area_box, area])
-
-            # cv2.rectangle(con_img, (x, y), (x + w, y + h), (153, 153, 0), 5)
-
-    with open(txt_file,'w') as f:
-        for area_ in area_list:
-
-            boxes = area_[0]
-            area = area_[1]
-            ran_str = ''.join(random.sample(string.ascii_letters + string.digits, 20))
-            ocr_cropped_xml = os.path.join(ocr_cropped_root, 'Annotations', '01', ran_str + ".xml")
-            ocr_cropped_img = os.path.join(ocr_cropped_root, 'Images', '01', ran_str + ".png")
-
-            voc = VOCAnnotation(ran_str + ".png", area.shape[1], area.shape[0])
-
-            for box in boxes:
-                # cv2.rectangle(area, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
-                voc.addBoundingBox(box[0], box[1], box[2], box[3], "1111")
-
-            voc.save(ocr_cropped_xml)
-            cv2.imwrite(ocr_cropped_img, area)
-            f.write('01/'+ ran_str + '\n')
-            cv2.imshow("area", area)
-            cv2.waitKey(10)
-
-        # cv2.imshow("img",image)
-        # cv2.imshow("con_img", con_img)
-        # cv2.imshow("mask", mask * 255)
-        # cv2.waitKey(0)
\ No newline at end of file
+    # the crops of every page are named after it, so a rerun replaces them instead of adding new ones, and the
+    # pages already cropped from the same image and annotation are skipped
+    manifest = GenerationManifest(txt_file + ".manifest.jsonl", settings={'dataset': dataset_root})
+    names = []
+    with manifest:
+        for idx in range(len(dataset.ids)):
+            image_id = dataset.ids[idx]
+            digest = file_digest(dataset.root / f"Images/{image_id}.png",
+                                 dataset.root / f"Annotations/{image_id}.xml")
+            if not manifest.is_done(image_id, digest):
+                for path in manifest.outputs(image_id):
+                    if os.path.exists(path):
+                        os.remove(path)
+                _, annotation = dataset.get_annotation(idx)
+                outputs = []
+                for jdx, (boxes, area) in enumerate(crop_areas(dataset, image_id, annotation)):
+                    name = f"{image_id.replace('/', '_')}_{jdx:03d}"
+                    outputs += save_area(ocr_cropped_root, name, boxes, area)
+                manifest.record(image_id, digest, outputs)
+            names += [os.path.splitext(os.path.basename(path))[0]
+                      for path in manifest.outputs(image_id) if path.endswith(".png")]
+
+    with open(txt_file + ".tmp", 'w') as f:
+        for name in names:
+            f.write('01/' + name + '\n')
+    os.replace(txt_file + ".tmp", txt_file)
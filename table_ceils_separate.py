@@ -10,6 +10,7 @@ import xml.etree.ElementTree as ET
 from lxml import etree
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite_predictor
+from vision.datasets.annotation_index import AnnotationIndex
 import cv2
 import string,os
 
@@ -56,6 +57,8 @@ class OcrDataset:
             'qqq'
         )
         self.class_dict = {class_name: i for i, class_name in enumerate(self.class_names)}
+        self.annotation_index = AnnotationIndex(self.root / "Annotations", self.ids,
+                                                self.root / f"{image_sets_file.stem}.annotations.idx")
 
 
     def get_image(self, index):
@@ -79,56 +82,16 @@ class OcrDataset:
         return ids
 
     def _get_annotation(self, image_id):
-        annotation_file = self.root / f"Annotations/{image_id}.xml"
-        et = ET.parse(annotation_file)
-        objects = et.findall("object")
-        size = et.findall("size")
-        w = int(size[0].find('width').text)
-        h = int(size[0].find('height').text)
-        boxes = []
-        polyes = []
-        labels = []
-        is_difficult = []
-        for object in objects:
-            class_name = object.find('name').text.lower().strip()
-            if class_name == 'qqq':
-                polygon = object.find('polygon')
-                # VOC dataset format follows Matlab, in which indexes start from 0
-
-                point0 = polygon.find('point0').text.split(',')
-                point1 = polygon.find('point1').text.split(',')
-                point2 = polygon.find('point2').text.split(',')
-                point3 = polygon.find('point3').text.split(',')
-
-                point0[0] = int(point0[0])
-                point0[1] = int(point0[1])
-                point1[0] = int(point1[0])
-                point1[1] = int(point1[1])
-                point2[0] = int(point2[0])
-                point2[1] = int(point2[1])
-                point3[0] = int(point3[0])
-                point3[1] = int(point3[1])
-
-                polyes.append([point0, point1, point2, point3])
-
-                xmin = min([int(point0[0]),int(point1[0]),int(point2[0]),int(point3[0])])
-                ymin = min([int(point0[1]),int(point1[1]),int(point2[1]),int(point3[1])])
-                xmax =max([int(point0[0]),int(point1[0]),int(point2[0]),int(point3[0])])
-                ymax =max([int(point0[1]),int(point1[1]),int(point2[1]),int(point3[1])])
-
-                xmin = max(0, xmin - 5)
-                ymin = max(0, ymin - 5)
-                xmax = min(w, xmax + 5)
-                ymax = min(h, ymax + 5)
-                boxes.append([float(xmin), float(ymin), float(xmax), float(ymax)])
-                labels.append(self.class_dict[class_name])
-                is_difficult_str = object.find('difficult').text
-                is_difficult.append(int(is_difficult_str) if is_difficult_str else 0)
-
-        return (np.array(boxes, dtype=np.float32),
-                np.array(polyes, dtype=np.int32),
+        w, h, names, _, polygons, has_polygon, difficult = self.annotation_index.get(image_id)
+        keep = np.array([class_name == 'qqq' for class_name in names], dtype=np.bool_) & has_polygon
+        polyes = polygons[keep]
+        labels = [self.class_dict[class_name] for class_name, k in zip(names, keep) if k]
+        boxes = np.concatenate([np.maximum(polyes.min(1) - 5, 0),
+                                np.minimum(polyes.max(1) + 5, [w, h])], 1).astype(np.float32)
+        return (boxes.reshape(-1, 4),
+                polyes,
                 np.array(labels, dtype=np.int64),
-                np.array(is_difficult, dtype=np.uint8), w, h)
+                difficult[keep], w, h)
 
     def _read_image(self, image_id):
         image_file = self.root / f"Images/{image_id}.png"
@@ -10,8 +10,12 @@ import xml.etree.ElementTree as ET
 from lxml import etree
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite
 from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite_predictor
+from vision.datasets.annotation_index import AnnotationIndex
+from vision.utils.manifest import GenerationManifest, file_digest
 import cv2
 import string,os
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -32,6 +36,17 @@ parser.add_argument("--iou_threshold", type=float, default=0.5, help="The thresh
 parser.add_argument("--eval_dir", default="eval_results", type=str, help="The directory to store evaluation results.")
 parser.add_argument('--mb2_width_mult', default=1.0, type=float,
                     help='Width Multiplifier for MobilenetV2')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='The number of threads decoding the pages and proposing their regions.')
+parser.add_argument('--prefetch_pages', default=8, type=int,
+                    help='The number of pages decoded ahead of the inference.')
+parser.add_argument('--batch_size', default=16, type=int, help='The number of regions predicted in one forward pass.')
+parser.add_argument('--deskew_angle_tolerance', default=0.0, type=float,
+                    help="Skip the deskew rotation of the pages whose estimated skew is below this many degrees, "
+                         "0 rotates every page.")
+parser.add_argument('--incremental', default=True, type=str2bool,
+                    help='Skip the pages the manifest of generate_bbox records as done with the same image, '
+                         'annotation and model.')
 args = parser.parse_args()
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() and args.use_cuda else "cpu")
 
@@ -56,6 +71,8 @@ class OcrDataset:
             'qqq'
         )
         self.class_dict = {class_name: i for i, class_name in enumerate(self.class_names)}
+        self.annotation_index = AnnotationIndex(self.root / "Annotations", self.ids,
+                                                self.root / f"{image_sets_file.stem}.annotations.idx")
 
 
     def get_image(self, index):
@@ -79,56 +96,16 @@ class OcrDataset:
         return ids
 
     def _get_annotation(self, image_id):
-        annotation_file = self.root / f"Annotations/{image_id}.xml"
-        et = ET.parse(annotation_file)
-        objects = et.findall("object")
-        size = et.findall("size")
-        w = int(size[0].find('width').text)
-        h = int(size[0].find('height').text)
-        boxes = []
-        polyes = []
-        labels = []
-        is_difficult = []
-        for object in objects:
-            class_name = object.find('name').text.lower().strip()
-            if class_name == 'qqq':
-                polygon = object.find('polygon')
-                # VOC dataset format follows Matlab, in which indexes start from 0
-
-                point0 = polygon.find('point0').text.split(',')
-                point1 = polygon.find('point1').text.split(',')
-                point2 = polygon.find('point2').text.split(',')
-                point3 = polygon.find('point3').text.split(',')
-
-                point0[0] = int(point0[0])
-                point0[1] = int(point0[1])
-                point1[0] = int(point1[0])
-                point1[1] = int(point1[1])
-                point2[0] = int(point2[0])
-                point2[1] = int(point2[1])
-                point3[0] = int(point3[0])
-                point3[1] = int(point3[1])
-
-                polyes.append([point0, point1, point2, point3])
-
-                xmin = min([int(point0[0]),int(point1[0]),int(point2[0]),int(point3[0])])
-                ymin = min([int(point0[1]),int(point1[1]),int(point2[1]),int(point3[1])])
-                xmax =max([int(point0[0]),int(point1[0]),int(point2[0]),int(point3[0])])
-                ymax =max([int(point0[1]),int(point1[1]),int(point2[1]),int(point3[1])])
-
-                xmin = max(0, xmin - 5)
-                ymin = max(0, ymin - 5)
-                xmax = min(w, xmax + 5)
-                ymax = min(h, ymax + 5)
-                boxes.append([float(xmin), float(ymin), float(xmax), float(ymax)])
-                labels.append(self.class_dict[class_name])
-                is_difficult_str = object.find('difficult').text
-                is_difficult.append(int(is_difficult_str) if is_difficult_str else 0)
-
-        return (np.array(boxes, dtype=np.float32),
-                np.array(polyes, dtype=np.int32),
+        w, h, names, _, polygons, has_polygon, difficult = self.annotation_index.get(image_id)
+        keep = np.array([class_name == 'qqq' for class_name in names], dtype=np.bool_) & has_polygon
+        polyes = polygons[keep]
+        labels = [self.class_dict[class_name] for class_name, k in zip(names, keep) if k]
+        boxes = np.concatenate([np.maximum(polyes.min(1) - 5, 0),
+                                np.minimum(polyes.max(1) + 5, [w, h])], 1).astype(np.float32)
+        return (boxes.reshape(-1, 4),
+                polyes,
                 np.array(labels, dtype=np.int64),
-                np.array(is_difficult, dtype=np.uint8), w, h)
+                difficult[keep], w, h)
 
     def _read_image(self, image_id):
         image_file = self.root / f"Images/{image_id}.png"
@@ -187,6 +164,137 @@ class VOCAnnotation(object):
         tree.write(saveFileName, pretty_print=True)
 
 
+class PageDetections:
+
+    def __init__(self, image_id, width, height, image_shape, num_regions, digest=None):
+        """The detections of a page, complete when none of its regions is pending."""
+        self.image_id = image_id
+        self.digest = digest
+        self.width = width
+        self.height = height
+        self.image_shape = image_shape
+        self.pending = num_regions
+        self.boxes = []
+
+    def add(self, x, y, boxes, probs):
+        factor_xy = 1
+        for i in range(boxes.size(0)):
+            if probs[i] > 0.45:
+                box = boxes[i, :]
+                box[0] = int(min(x + factor_xy * (box[0] + 5), self.image_shape[1] - 1))
+                box[1] = int(min(y + factor_xy * (box[1] + 5), self.image_shape[0] - 1))
+                box[2] = int(max(x + factor_xy * (box[2] - 5), box[0]))
+                box[3] = int(max(y + factor_xy * (box[3] - 5), box[1]))
+                self.boxes.append(box)
+        self.pending -= 1
+
+
+def page_digest(dataset, image_id):
+    return file_digest(dataset.root / f"Images/{image_id}.png", dataset.root / f"Annotations/{image_id}.xml")
+
+
+def propose_regions(dataset, idx, manifest=None):
+    """Decode a page and crop the regions covered by its annotated cells, run by the worker threads.
+
+    Returns:
+        the PageDetections of the page and its regions as (x, y, padded crop, padded gt mask), or None
+         when the manifest records the page as done.
+    """
+    image_id = dataset.ids[idx]
+    digest = page_digest(dataset, image_id)
+    if manifest is not None and manifest.is_done(image_id, digest):
+        return None
+    image_id, annotation = dataset.get_annotation(idx)
+    image = dataset._read_image(image_id)
+    gt_boxes, polyes, classes, is_difficult, width, height = annotation
+    mask = np.zeros(image.shape[:2], dtype=np.uint8)
+    total_gt_mask = np.zeros(image.shape[:2], dtype=np.uint8)
+    cv2.polylines(total_gt_mask, polyes, 1, 255, 2)
+    for jdx in range(gt_boxes.shape[0]):
+        box = gt_boxes[jdx, :].astype(np.int32)
+        mask[box[1]: box[3], box[0]: box[2]] = 1
+
+    contours = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    regions = []
+    for jdx in range(0, len(contours)):
+        x, y, w, h = cv2.boundingRect(contours[jdx])
+        detla_x = random.randint(4, 8)
+        detla_y = random.randint(4, 8)
+        detla_w = random.randint(8, 16)
+        detla_h = random.randint(8, 16)
+        x = max(0, x - detla_x)
+        y = max(0, y - detla_y)
+        w = min(x + w + detla_w, image.shape[1]) - x
+        h = min(y + h + detla_h, image.shape[0]) - y
+
+        detect_area = image[y: y + h, x: x + w, :]
+        gt_mask = total_gt_mask[y: y + h, x: x + w]
+        max_edge = max(detect_area.shape[0], detect_area.shape[1])
+        detect_area = cv2.copyMakeBorder(detect_area, 0, max_edge - detect_area.shape[0], 0,
+                                         max_edge - detect_area.shape[1], cv2.BORDER_CONSTANT)
+        gt_mask = cv2.copyMakeBorder(gt_mask, 0, max_edge - gt_mask.shape[0], 0, max_edge - gt_mask.shape[1],
+                                     cv2.BORDER_CONSTANT)
+        regions.append((x, y, detect_area, gt_mask))
+    return PageDetections(image_id, width, height, image.shape, len(regions), digest), regions
+
+
+def stream_pages(dataset, num_workers, prefetch_pages, manifest=None):
+    """Yield the regions of every page in order, at most prefetch_pages pages being decoded ahead.
+
+    The pages the manifest records as done are skipped.
+    """
+    # cv2 releases the GIL while decoding and finding contours, so threads are enough
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = collections.deque()
+        for idx in range(len(dataset)):
+            futures.append(executor.submit(propose_regions, dataset, idx, manifest))
+            while futures and (len(futures) >= prefetch_pages or futures[0].done()):
+                page = futures.popleft().result()
+                if page is not None:
+                    yield page
+        while futures:
+            page = futures.popleft().result()
+            if page is not None:
+                yield page
+
+
+def write_page(page, gen_bbox_path, manifest=None):
+    voc = VOCAnnotation(page.image_id, page.width, page.height)
+    for box in page.boxes:
+        voc.addBoundingBox(box[0], box[1], box[2], box[3], "qqq")
+    xml_path = os.path.join(gen_bbox_path, page.image_id + ".xml")
+    # the xml is complete once it replaces the previous one, then only the page is recorded as done
+    voc.save(xml_path + ".tmp")
+    os.replace(xml_path + ".tmp", xml_path)
+    if manifest is not None:
+        manifest.record(page.image_id, page.digest, [xml_path])
+
+
+def detect_pages(predictor, pages, batch_size, gen_bbox_path, manifest=None):
+    """Predict the regions of the streamed pages in batches, writing the xml of every page once it is done."""
+    batch = []
+
+    def flush():
+        results = predictor.predict_batch([region[3] for region in batch], [region[4] for region in batch])
+        for (page, x, y, _, _), result in zip(batch, results):
+            boxes, _, probs = result[:3]
+            page.add(x, y, boxes, probs)
+            if page.pending == 0:
+                write_page(page, gen_bbox_path, manifest)
+        batch.clear()
+
+    for page, regions in pages:
+        if not regions:
+            write_page(page, gen_bbox_path, manifest)
+        for region in regions:
+            batch.append((page,) + region)
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+
+
 if __name__ == '__main__':
     eval_path = pathlib.Path(args.eval_dir)
     eval_path.mkdir(exist_ok=True)
@@ -194,6 +302,7 @@ if __name__ == '__main__':
     class_names = [name.strip() for name in open(args.label_file).readlines()]
 
     net = create_imJnet_ssd_lite(len(class_names), width_mult=args.mb2_width_mult, is_test=True)
+    net.set_deskew_angle_tolerance(args.deskew_angle_tolerance)
 
     timer.start("Load Model")
     pretrained_dict = torch.load(args.trained_model)
@@ -205,74 +314,19 @@ if __name__ == '__main__':
 
     dataset = OcrDataset(args.dataset, is_test=True)
     print(len(dataset.ids))
-    detect_list = []
-    for idx in range(len(dataset.ids)):
-        image_id, annotation = dataset.get_annotation(idx)
-        image = dataset._read_image(image_id)
-        gt_boxes, polyes, classes, is_difficult, width, height = annotation
-        mask = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) * 0
-        total_gt_mask = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) * 0
-        cv2.polylines(total_gt_mask, polyes, 1, 255, 2)
-        for jdx in range(gt_boxes.shape[0]):
-
-            box = gt_boxes[jdx, :].astype(np.int32)
-            # cv2.rectangle(image, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
-            mask[box[1]: box[3],box[0]: box[2]] = mask[box[1]: box[3],box[0]: box[2]] * 0 + 1
-
-        con_img, contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-        detect_boxes = []
-        for jdx in range(0, len(contours)):
-            x, y, w, h = cv2.boundingRect(contours[jdx])
-            detla_x = random.randint(4, 8)
-            detla_y = random.randint(4, 8)
-            detla_w = random.randint(8, 16)
-            detla_h = random.randint(8, 16)
-            x = max(0, x - detla_x)
-            y = max(0, y - detla_y)
-            w = min(x + w + detla_w, image.shape[1]) - x
-            h = min(y + h + detla_h, image.shape[0]) - y
-
-            detect_box = []
-            detect_area = image[y: y + h, x: x + w, :]
-            gt_mask = total_gt_mask[y: y + h, x: x + w]
-            max_edge = max(detect_area.shape[0],detect_area.shape[1])
-            factor_xy = float(max_edge)/ 768
-            factor_xy = 1
-            detect_area = cv2.copyMakeBorder(detect_area, 0, max_edge - detect_area.shape[0], 0, max_edge - detect_area.shape[1],cv2.BORDER_CONSTANT)
-            gt_mask = cv2.copyMakeBorder(gt_mask, 0, max_edge - detect_area.shape[0], 0, max_edge - detect_area.shape[1],cv2.BORDER_CONSTANT)
-
-            boxes, labels, probs, masks = predictor.predict(detect_area, gt_mask)
-            for i in range(boxes.size(0)):
-                if probs[i] > 0.45:
-                    box = boxes[i, :]
-                    b = random.randint(0, 255)
-                    g = random.randint(0, 255)
-                    r = random.randint(0, 255)
-                    box[0] = int(min(x + factor_xy * (box[0] + 5), image.shape[1] - 1))
-                    box[1] = int(min(y + factor_xy * (box[1] + 5), image.shape[0] - 1))
-                    box[2] = int(max(x + factor_xy * (box[2] - 5), box[0]))
-                    box[3] = int(max(y + factor_xy * (box[3] - 5), box[1]))
-                    # cv2.rectangle(image, (box[0], box[1]), (box[2], box[3]), (b, g, r), 2)
-                    detect_boxes.append(box)
-            # cv2.imshow('image',image)
-            # cv2.waitKey(1)
-        detect_list.append([image_id, detect_boxes, width, height])
-
     gen_bbox_path = os.path.join(args.dataset,'generate_bbox')
-    for idx, item in enumerate(detect_list):
-        image_id = item[0]
-        detect_boxes = item[1]
-        width = item[2]
-        height = item[3]
-
-        voc = VOCAnnotation(image_id, width, height)
-
-        for box in detect_boxes:
-            # cv2.rectangle(area, (box[0], box[1]), (box[2], box[3]), (0, 0, 255), 1)
-            voc.addBoundingBox(box[0], box[1], box[2], box[3], "qqq")
-
-        xml_path = os.path.join(gen_bbox_path, image_id + ".xml")
-        if not os.path.exists(os.path.dirname(xml_path)):
-            os.makedirs(os.path.dirname(xml_path))
-        voc.save(xml_path)
+    if not os.path.exists(gen_bbox_path):
+        os.makedirs(gen_bbox_path)
+    manifest = None
+    if args.incremental:
+        model_stat = os.stat(args.trained_model)
+        manifest = GenerationManifest(os.path.join(gen_bbox_path, 'manifest.jsonl'), settings={
+            'trained_model': os.path.abspath(args.trained_model), 'model_size': model_stat.st_size,
+            'model_mtime': model_stat.st_mtime_ns, 'nms_method': args.nms_method,
+            'deskew_angle_tolerance': args.deskew_angle_tolerance})
+    try:
+        detect_pages(predictor, stream_pages(dataset, args.num_workers, args.prefetch_pages, manifest),
+                     args.batch_size, gen_bbox_path, manifest)
+    finally:
+        if manifest is not None:
+            manifest.close()
@@ -6,23 +6,24 @@ import itertools
 import numpy as np
 import cv2
 import torch
-from torch.utils.data import DataLoader, ConcatDataset
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import ConcatDataset
 from torch.optim.lr_scheduler import CosineAnnealingLR, MultiStepLR
 
-from vision.utils.misc import str2bool, Timer, freeze_net_layers, store_labels
+from vision.utils.misc import str2bool, Timer, freeze_net_layers, store_labels, autocast, RunningSums
+from vision.ssd import registry
 from vision.ssd.ssd import MatchPrior
-from vision.ssd.vgg_ssd import create_vgg_ssd
-from vision.ssd.mobilenetv1_ssd import create_mobilenetv1_ssd
-from vision.ssd.mobilenetv1_ssd_lite import create_mobilenetv1_ssd_lite
-from vision.ssd.mobilenet_v2_ssd_lite import create_mobilenetv2_ssd_lite
-from vision.ssd.imJnet_ssd_lite import create_imJnet_ssd_lite
-from vision.ssd.squeezenet_ssd_lite import create_squeezenet_ssd_lite
+from vision.utils.box_utils import prior_levels
+from vision.utils.checkpoint import CheckpointManager, restore_training_state
+from vision.utils.distributed import (is_main_process, main_process_first, make_loader, all_reduce_mean,
+                                      save_checkpoint)
 from vision.datasets.voc_dataset import VOCDataset
 from vision.datasets.open_images import OpenImagesDataset
+from vision.datasets.mask_cache import build_mask_cache, is_deterministic
+from vision.datasets.image_store import build_image_store
+from vision.datasets.collation import padded_detection_collate
 from vision.nn.multibox_loss import MultiboxLoss
-from vision.ssd.config import vgg_ssd_config
-from vision.ssd.config import mobilenetv1_ssd_config
-from vision.ssd.config import squeezenet_ssd_config
 from vision.ssd.data_preprocessing import TrainAugmentation, TestTransform
 #fixed ,just a test
 parser = argparse.ArgumentParser(
@@ -38,7 +39,7 @@ parser.add_argument('--balance_data', default=False, action='store_true',
 
 
 parser.add_argument('--net', default="jnet-ssd-lite",
-                    help="The network architecture, it can be mb1-ssd, mb1-lite-ssd, jnet-ssd-lite, mb2-ssd-lite or vgg16-ssd.")
+                    help=f"The network architecture, it can be {', '.join(registry.net_names())}.")
 parser.add_argument('--freeze_base_net', default=False,action='store_true',
                     help="Freeze base net layers.")
 parser.add_argument('--freeze_net', default=False,action='store_true',
@@ -99,6 +100,29 @@ parser.add_argument('--use_cuda', default=True, type=str2bool,
 
 parser.add_argument('--checkpoint_folder', default='model_log/',
                     help='Directory for saving checkpoint models')
+parser.add_argument('--keep_best', default=3, type=int,
+                    help='Number of checkpoints with the lowest validation loss to keep, all of them if negative')
+parser.add_argument('--keep_last', default=2, type=int,
+                    help='Number of latest checkpoints to keep')
+parser.add_argument('--cache_mask_features', default=False, action='store_true',
+                    help="Precompute the frozen mask_net outputs of the un-augmented datasets and reuse them.")
+parser.add_argument('--mask_cache_folder', default='model_log/mask_cache/',
+                    help='Directory for the cached mask_net outputs')
+parser.add_argument('--distributed', default=False, action='store_true',
+                    help="Train with one process per device, started by torchrun, instead of DataParallel.")
+parser.add_argument('--dist_backend', default='gloo', type=str,
+                    help="Backend of the distributed training, gloo also runs on CPU hosts, nccl needs GPUs.")
+parser.add_argument('--mixed_precision', default=False, action='store_true',
+                    help="Run the network under autocast, bfloat16 on CPU and float16 with gradient scaling on GPU.")
+parser.add_argument('--match_on_device', default=False, action='store_true',
+                    help="Match the ground truth boxes to the priors for the whole batch on the training device.")
+parser.add_argument('--sparse_matching', default=False, action='store_true',
+                    help="Only compute the IoU of the priors near each ground truth box, for pages with many cells.")
+parser.add_argument('--image_store_folder', default='',
+                    help='Directory for the decoded and CvtRatio normalized images, they are decoded every step if empty')
+parser.add_argument('--deskew_angle_tolerance', default=0.0, type=float,
+                    help="Skip the deskew rotation of the pages whose estimated skew is below this many degrees, "
+                         "0 rotates every page.")
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO,
@@ -112,21 +136,27 @@ if args.use_cuda and torch.cuda.is_available():
     logging.info("Use Cuda.")
 
 
-def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
+def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1, match_prior=None, scaler=None):
     net.train(True)
-    running_loss = 0.0
-    running_regression_loss = 0.0
-    running_classification_loss = 0.0
-    running_segmentation_loss = 0.0
+    # the scaler only scales the float16 gradients of --mixed_precision on GPU
+    scaler = scaler or torch.cuda.amp.GradScaler(enabled=False)
+    # the losses are summed on the device and only read back when logged
+    running = RunningSums()
     for i, data in enumerate(loader):
-        images, boxes, labels, gt_masks = data
+        images, boxes, labels, gt_masks = data[:4]
         images = images.to(device)
         boxes = boxes.to(device)
         labels = labels.to(device)
         gt_masks = gt_masks.to(device)
+        # cached mask_net logits, see --cache_mask_features
+        mask_logits = data[4].to(device) if len(data) > 4 else None
+        if match_prior is not None:
+            # raw padded boxes, see --match_on_device
+            boxes, labels = match_prior.match_batch(boxes, labels)
 
         optimizer.zero_grad()
-        confidence, locations, seg_masks = net(images)
+        with autocast(device, args.mixed_precision):
+            confidence, locations, seg_masks = net(images, mask_logits)
         # for idx in range(images.size(0)):
         #     image=images[idx]
         #     gt_mask = gt_masks[idx]
@@ -139,95 +169,92 @@ def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
         #     cv2.imshow("gt_mask", gt_mask)
         #     cv2.imshow("seg_mask", seg_mask)
         #     cv2.waitKey(0)
-        regression_loss, classification_loss, segmentation_loss = criterion(confidence, locations, seg_masks, labels, boxes, gt_masks)  # TODO CHANGE BOXES
-        loss = regression_loss + classification_loss + segmentation_loss
+            regression_loss, classification_loss, segmentation_loss = criterion(confidence, locations, seg_masks, labels, boxes, gt_masks)  # TODO CHANGE BOXES
+            loss = regression_loss + classification_loss + segmentation_loss
         # loss = segmentation_loss
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        running_loss += loss.item()
-        running_regression_loss += regression_loss.item()
-        running_classification_loss += classification_loss.item()
-        running_segmentation_loss += segmentation_loss.item()
+        running.add(loss=loss, regression_loss=regression_loss, classification_loss=classification_loss,
+                    segmentation_loss=segmentation_loss)
         if i and i % debug_steps == 0:
-            avg_loss = running_loss / debug_steps
-            avg_reg_loss = running_regression_loss / debug_steps
-            avg_clf_loss = running_classification_loss / debug_steps
-            avg_seg_loss = running_segmentation_loss / debug_steps
+            avg = running.means()
             logging.info(
                 f"Epoch: {epoch}, Step: {i}, " +
-                f"Average Loss: {avg_loss:.4f}, " +
-                f"Average Regression Loss {avg_reg_loss:.4f}, " +
-                f"Average Classification Loss: {avg_clf_loss:.4f}, " +
-                f"Average Segmentation Loss: {avg_seg_loss:.4f}"
+                f"Average Loss: {avg['loss']:.4f}, " +
+                f"Average Regression Loss {avg['regression_loss']:.4f}, " +
+                f"Average Classification Loss: {avg['classification_loss']:.4f}, " +
+                f"Average Segmentation Loss: {avg['segmentation_loss']:.4f}"
             )
-            running_loss = 0.0
-            running_regression_loss = 0.0
-            running_classification_loss = 0.0
-            running_segmentation_loss = 0.0
+            running.reset()
 
 
-def test(loader, net, criterion, device):
+def test(loader, net, criterion, device, match_prior=None):
     net.eval()
-    running_loss = 0.0
-    running_regression_loss = 0.0
-    running_classification_loss = 0.0
-    running_segmentation_loss = 0.0
-    num = 0
+    # the losses are summed on the device and only read back when logged
+    running = RunningSums()
     for _, data in enumerate(loader):
-        images, boxes, labels, gt_masks = data
+        images, boxes, labels, gt_masks = data[:4]
         images = images.to(device)
         boxes = boxes.to(device)
         labels = labels.to(device)
         gt_masks = gt_masks.to(device)
-        num += 1
-
-        with torch.no_grad():
-            confidence, locations, seg_masks = net(images)
+        # cached mask_net logits, see --cache_mask_features
+        mask_logits = data[4].to(device) if len(data) > 4 else None
+        if match_prior is not None:
+            # raw padded boxes, see --match_on_device
+            boxes, labels = match_prior.match_batch(boxes, labels)
+
+        with torch.no_grad(), autocast(device, args.mixed_precision):
+            confidence, locations, seg_masks = net(images, mask_logits)
             regression_loss, classification_loss, segmentation_loss = criterion(confidence, locations, seg_masks,
                                                                                 labels, boxes,
                                                                                 gt_masks)  # TODO CHANGE BOXES
             loss = regression_loss + classification_loss
             # loss = regression_loss + classification_loss + segmentation_loss
-        running_loss += loss.item()
-        running_regression_loss += regression_loss.item()
-        running_classification_loss += classification_loss.item()
-        running_segmentation_loss += segmentation_loss.item()
-    return running_loss / num, running_regression_loss / num, running_classification_loss / num, running_segmentation_loss / num
+        running.add(loss=loss, regression_loss=regression_loss, classification_loss=classification_loss,
+                    segmentation_loss=segmentation_loss)
+    avg = running.means()
+    return avg['loss'], avg['regression_loss'], avg['classification_loss'], avg['segmentation_loss']
 
 
 if __name__ == '__main__':
     timer = Timer()
+    if args.distributed:
+        dist.init_process_group(args.dist_backend, init_method="env://")
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        if args.use_cuda and torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            DEVICE = torch.device("cuda", local_rank)
+        else:
+            DEVICE = torch.device("cpu")
+        if not is_main_process():
+            logging.getLogger().setLevel(logging.WARNING)
+        logging.info(f"Distributed training with {dist.get_world_size()} processes, {args.dist_backend} backend.")
 
     logging.info(args)
-    if args.net == 'vgg16-ssd':
-        create_net = create_vgg_ssd
-        config = vgg_ssd_config
-    elif args.net == 'mb1-ssd':
-        create_net = create_mobilenetv1_ssd
-        config = mobilenetv1_ssd_config
-    elif args.net == 'mb1-ssd-lite':
-        create_net = create_mobilenetv1_ssd_lite
-        config = mobilenetv1_ssd_config
-    elif args.net == 'sq-ssd-lite':
-        create_net = create_squeezenet_ssd_lite
-        config = squeezenet_ssd_config
-    elif args.net == 'mb2-ssd-lite':
-        create_net = lambda num: create_mobilenetv2_ssd_lite(num, width_mult=args.mb2_width_mult)
-        config = mobilenetv1_ssd_config
-    elif args.net == "jnet-ssd-lite":
-        config = mobilenetv1_ssd_config
-        create_net = lambda num: create_imJnet_ssd_lite(num, width_mult=args.mb2_width_mult)
-
-    else:
+    if args.net not in registry.net_names():
         logging.fatal("The net type is wrong.")
         parser.print_help(sys.stderr)
         sys.exit(1)
-    train_transform = TrainAugmentation(config.image_size, config.image_mean, config.image_std)
-    target_transform = MatchPrior(config.priors, config.center_variance,
-                                  config.size_variance, 0.5)
+    config = registry.get_config(args.net)
+    create_net = lambda num: registry.create_net(args.net, num, width_mult=args.mb2_width_mult)
+    cvt_ratio = not (args.image_store_folder and args.dataset_type == 'voc')
+    train_transform = TrainAugmentation(config.image_size, config.image_mean, config.image_std, cvt_ratio=cvt_ratio)
+    match_prior = MatchPrior(config.priors, config.center_variance,
+                             config.size_variance, 0.5,
+                             prior_levels=prior_levels(config.specs, config.image_size) if args.sparse_matching else None)
+    if args.match_on_device:
+        # workers only ship the raw boxes, the loops match them for the whole batch
+        target_transform = None
+        collate_fn = padded_detection_collate
+    else:
+        target_transform = match_prior
+        collate_fn = None
+        match_prior = None
 
-    test_transform = TestTransform(config.image_size, config.image_mean, config.image_std)
+    test_transform = TestTransform(config.image_size, config.image_mean, config.image_std, cvt_ratio=cvt_ratio)
 
     logging.info("Prepare training datasets.")
     datasets = []
@@ -235,6 +262,10 @@ if __name__ == '__main__':
         if args.dataset_type == 'voc':
             dataset = VOCDataset(dataset_path, transform=train_transform,
                                  target_transform=target_transform)
+            if not cvt_ratio:
+                with main_process_first():
+                    dataset.image_store = build_image_store(dataset,
+                                                            os.path.join(args.image_store_folder, "train.store"))
             label_file = os.path.join(args.checkpoint_folder, "voc-model-labels.txt")
             store_labels(label_file, dataset.class_names)
             num_classes = len(dataset.class_names)
@@ -253,13 +284,16 @@ if __name__ == '__main__':
     logging.info(f"Stored labels into file {label_file}.")
     train_dataset = ConcatDataset(datasets)
     logging.info("Train dataset size: {}".format(len(train_dataset)))
-    train_loader = DataLoader(train_dataset, args.batch_size,
-                              num_workers=args.num_workers,
-                              shuffle=True)
+    train_loader = make_loader(train_dataset, args.batch_size, shuffle=True, num_workers=args.num_workers,
+                               collate_fn=collate_fn)
     logging.info("Prepare Validation datasets.")
     if args.dataset_type == "voc":
         val_dataset = VOCDataset(args.validation_dataset, transform=test_transform,
                                  target_transform=target_transform, is_test=True)
+        if not cvt_ratio:
+            with main_process_first():
+                val_dataset.image_store = build_image_store(val_dataset,
+                                                            os.path.join(args.image_store_folder, "val.store"))
     elif args.dataset_type == 'open_images':
         val_dataset = OpenImagesDataset(dataset_path,
                                         transform=test_transform, target_transform=target_transform,
@@ -267,12 +301,12 @@ if __name__ == '__main__':
         logging.info(val_dataset)
     logging.info("validation dataset size: {}".format(len(val_dataset)))
 
-    val_loader = DataLoader(val_dataset, args.batch_size,
-                            num_workers=args.num_workers,
-                            shuffle=False)
+    val_loader = make_loader(val_dataset, args.batch_size, shuffle=False, num_workers=args.num_workers,
+                             collate_fn=collate_fn)
     logging.info("Build network.")
     net = create_net(num_classes)
-    print(net)
+    if is_main_process():
+        print(net)
     for param in net.parameters():
         param.requires_grad = True
     min_loss = -10000.0
@@ -329,14 +363,43 @@ if __name__ == '__main__':
 
     #========================================================================================================
     freeze_net_layers(net.mask_net)
+    net.set_deskew_angle_tolerance(args.deskew_angle_tolerance)
+    if args.cache_mask_features:
+        # the cached outputs come from the mask_net in eval mode, the live ones have to match them
+        net.set_mask_net_eval()
+        with main_process_first():
+            # the frozen mask_net gives the same outputs for un-augmented images, randomly augmented ones
+            # are still computed live
+            net.mask_net.to(DEVICE)
+            if all(is_deterministic(dataset.transform) for dataset in train_dataset.datasets):
+                train_dataset = ConcatDataset([
+                    build_mask_cache(net.mask_net, dataset, os.path.join(args.mask_cache_folder, f"train-{i}.npy"),
+                                     args.batch_size, args.num_workers, DEVICE)
+                    for i, dataset in enumerate(train_dataset.datasets)])
+                train_loader = make_loader(train_dataset, args.batch_size, shuffle=True,
+                                           num_workers=args.num_workers, collate_fn=collate_fn)
+            val_dataset = build_mask_cache(net.mask_net, val_dataset, os.path.join(args.mask_cache_folder, "val.npy"),
+                                           args.batch_size, args.num_workers, DEVICE)
+            val_loader = make_loader(val_dataset, args.batch_size, shuffle=False,
+                                     num_workers=args.num_workers, collate_fn=collate_fn)
+        logging.info(f"Cached mask_net outputs in {args.mask_cache_folder}.")
     # net.to(DEVICE)
     # net = net.cuda()
-    net = torch.nn.DataParallel(net, device_ids=device_ids).to(DEVICE)
+    if args.distributed:
+        net = DistributedDataParallel(net.to(DEVICE), device_ids=[DEVICE.index] if DEVICE.type == "cuda" else None)
+    else:
+        net = torch.nn.DataParallel(net, device_ids=device_ids).to(DEVICE)
     criterion = MultiboxLoss(config.priors, iou_threshold=0.5, neg_pos_ratio=3,
                              center_variance=0.1, size_variance=0.2, device=DEVICE)
     # optimizer = torch.optim.SGD(net.parameters(), lr=args.lr, momentum=args.momentum,
     #                             weight_decay=args.weight_decay)
     optimizer = torch.optim.RMSprop(net.parameters(), lr=1e-3, alpha=0.9)
+    if args.resume:
+        # the optimizer, epoch and RNG state saved along with the resumed weights, if any
+        training_state = restore_training_state(args.resume, optimizer)
+        if training_state is not None and training_state['epoch'] is not None:
+            last_epoch = training_state['epoch']
+    checkpoints = CheckpointManager(args.checkpoint_folder, keep_best=args.keep_best, keep_last=args.keep_last)
     # optimizer = torch.nn.DataParallel(optimizer, device_ids=device_ids)
     logging.info(f"Learning rate: {args.lr}, Base net learning rate: {base_net_lr}, "
                  + f"Extra Layers learning rate: {extra_layers_lr}.")
@@ -354,14 +417,21 @@ if __name__ == '__main__':
     #     parser.print_help(sys.stderr)
     #     sys.exit(1)
 
+    scaler = torch.cuda.amp.GradScaler(enabled=args.mixed_precision and DEVICE.type == "cuda")
     logging.info(f"Start training from epoch {last_epoch + 1}.")
     for epoch in range(last_epoch + 1, args.num_epochs):
         # scheduler.step()
+        if args.distributed:
+            train_loader.sampler.set_epoch(epoch)
         train(train_loader, net, criterion, optimizer,
-              device=DEVICE, debug_steps=args.debug_steps, epoch=epoch)
+              device=DEVICE, debug_steps=args.debug_steps, epoch=epoch,
+              match_prior=match_prior, scaler=scaler)
         
         if epoch % args.validation_epochs == 0 or epoch == args.num_epochs - 1:
-            val_loss, val_regression_loss, val_classification_loss, val_segmentation_loss = test(val_loader, net, criterion, DEVICE)
+            val_losses = test(val_loader, net, criterion, DEVICE, match_prior)
+            # average the losses of the validation shards
+            val_losses = all_reduce_mean(val_losses, DEVICE)
+            val_loss, val_regression_loss, val_classification_loss, val_segmentation_loss = val_losses
             logging.info(
                 f"Epoch: {epoch}, " +
                 f"Validation Loss: {val_loss:.4f}, " +
@@ -369,6 +439,10 @@ if __name__ == '__main__':
                 f"Validation Classification Loss: {val_classification_loss:.4f}, "+
                 f"Validation Segmentation Loss: {val_segmentation_loss:.4f}"
             )
-            model_path = os.path.join(args.checkpoint_folder, f"{args.net}-Epoch-{epoch}-Loss-{val_loss}.pth")
-            net.module.save(model_path)
-            logging.info(f"Saved model {model_path}")
+            model_path = save_checkpoint(checkpoints, net.module, f"{args.net}-Epoch-{epoch}-Loss-{val_loss}",
+                                         val_loss, epoch=epoch, optimizer=optimizer)
+            if model_path is not None:
+                logging.info(f"Saving model {model_path}")
+    checkpoints.close()
+    if args.distributed:
+        dist.destroy_process_group()
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import pathlib
+import uuid
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+_MAGIC = b"ANNIDX1\n"
+_ALIGNMENT = 64
+# name, dtype and shape after the leading count of every array stored in the index
+_ARRAYS = [
+    ('mtimes', np.int64, ()),
+    ('object_offsets', np.int64, ()),
+    ('sizes', np.int32, (2,)),
+    ('names', np.int32, ()),
+    ('bndboxes', np.float32, (4,)),
+    ('polygons', np.int32, (4, 2)),
+    ('has_polygon', np.uint8, ()),
+    ('difficult', np.uint8, ()),
+]
+
+
+class AnnotationIndex:
+
+    def __init__(self, annotation_dir, ids, index_file=None):
+        """Every annotation xml of a dataset compiled into one flat file, read through a memory map.
+
+        The objects of all the images are concatenated, object_offsets[i]:object_offsets[i + 1] being the
+        objects of ids[i]. The index is rebuilt when the image ids or the modification time of an xml change.
+        Args:
+            annotation_dir: the directory holding the {image_id}.xml files.
+            ids: the image ids of the dataset.
+            index_file: where to store the index, it is kept in memory only when the file can't be written.
+        """
+        self.annotation_dir = pathlib.Path(annotation_dir)
+        self.ids = list(ids)
+        self.positions = {image_id: i for i, image_id in enumerate(self.ids)}
+        self.index_file = pathlib.Path(index_file) if index_file else None
+        mtimes = self._mtimes()
+        loaded = self._load() if self.index_file and self.index_file.exists() else None
+        if loaded is not None and loaded[0] == self.ids and np.array_equal(loaded[2]['mtimes'], mtimes):
+            self.class_names, self.arrays = loaded[1], loaded[2]
+            self.saved = True
+        else:
+            self.class_names, self.arrays = self._compile(mtimes)
+            self.saved = self.index_file is not None and self._save()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # loader workers map the file again instead of receiving a copy of the arrays
+        state = self.__dict__.copy()
+        if self.saved:
+            state['arrays'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.arrays is None:
+            loaded = self._load() if self.index_file.exists() else None
+            if loaded is not None and loaded[0] == self.ids and loaded[1] == self.class_names:
+                self.arrays = loaded[2]
+            else:
+                logging.warning(f"The annotation index {self.index_file} changed, compiling the annotations again.")
+                self.class_names, self.arrays = self._compile(self._mtimes())
+                self.saved = False
+
+    def get(self, image_id):
+        """The raw annotation of image_id.
+
+        Returns:
+            width, height, the class names of the objects, their bndboxes (NaN when the object has none),
+             their polygons, whether the object has a polygon and the difficult flags.
+        """
+        i = self.positions[image_id]
+        start, end = self.arrays['object_offsets'][i], self.arrays['object_offsets'][i + 1]
+        width, height = self.arrays['sizes'][i]
+        names = [self.class_names[n] for n in self.arrays['names'][start:end]]
+        return (int(width), int(height), names,
+                np.array(self.arrays['bndboxes'][start:end]),
+                np.array(self.arrays['polygons'][start:end]),
+                np.array(self.arrays['has_polygon'][start:end], dtype=np.bool_),
+                np.array(self.arrays['difficult'][start:end]))
+
+    def _annotation_file(self, image_id):
+        return self.annotation_dir / f"{image_id}.xml"
+
+    def _mtimes(self):
+        return np.array([os.stat(self._annotation_file(image_id)).st_mtime_ns for image_id in self.ids],
+                        dtype=np.int64)
+
+    def _compile(self, mtimes):
+        class_names = []
+        class_indexes = {}
+        object_offsets = [0]
+        sizes = []
+        records = {name: [] for name in ['names', 'bndboxes', 'polygons', 'has_polygon', 'difficult']}
+        for image_id in self.ids:
+            et = ET.parse(self._annotation_file(image_id))
+            size = et.find("size")
+            if size is not None:
+                sizes.append([int(size.find('width').text), int(size.find('height').text)])
+            else:
+                sizes.append([-1, -1])
+            objects = et.findall("object")
+            for object in objects:
+                class_name = object.find('name').text.lower().strip()
+                if class_name not in class_indexes:
+                    class_indexes[class_name] = len(class_names)
+                    class_names.append(class_name)
+                records['names'].append(class_indexes[class_name])
+                bbox = object.find('bndbox')
+                if bbox is not None:
+                    records['bndboxes'].append([float(bbox.find(tag).text)
+                                                for tag in ['xmin', 'ymin', 'xmax', 'ymax']])
+                else:
+                    records['bndboxes'].append([np.nan] * 4)
+                polygon = object.find('polygon')
+                if polygon is not None:
+                    records['polygons'].append([[int(v) for v in polygon.find(f'point{k}').text.split(',')]
+                                                for k in range(4)])
+                else:
+                    records['polygons'].append([[0, 0]] * 4)
+                records['has_polygon'].append(polygon is not None)
+                difficult = object.find('difficult')
+                is_difficult_str = difficult.text if difficult is not None else None
+                records['difficult'].append(int(is_difficult_str) if is_difficult_str else 0)
+            object_offsets.append(object_offsets[-1] + len(objects))
+        values = dict(records, mtimes=mtimes, object_offsets=object_offsets, sizes=sizes)
+        arrays = {name: np.array(values[name], dtype=dtype).reshape((-1,) + shape)
+                  for name, dtype, shape in _ARRAYS}
+        return class_names, arrays
+
+    def _save(self):
+        header = {'ids': self.ids, 'class_names': self.class_names, 'arrays': []}
+        offset = 0
+        for name, _, _ in _ARRAYS:
+            header['arrays'].append([name, len(self.arrays[name]), offset])
+            offset += -(-self.arrays[name].nbytes // _ALIGNMENT) * _ALIGNMENT
+        header = json.dumps(header).encode()
+        data_start = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGNMENT) * _ALIGNMENT
+        # a name of its own, several processes may be writing the same index
+        tmp_file = self.index_file.with_name(f"{self.index_file.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(_MAGIC)
+                f.write(np.int64(len(header)).tobytes())
+                f.write(header)
+                for name, count, array_offset in json.loads(header)['arrays']:
+                    f.seek(data_start + array_offset)
+                    f.write(self.arrays[name].tobytes())
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            logging.warning(f"Could not write the annotation index {self.index_file}: {e}")
+            if tmp_file.exists():
+                os.remove(tmp_file)
+            return False
+        return True
+
+    def _load(self):
+        with open(self.index_file, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                return None
+            try:
+                header_size = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+                header = json.loads(f.read(header_size).decode())
+            except ValueError:
+                # truncated
+                return None
+        data_start = -(-(len(_MAGIC) + 8 + header_size) // _ALIGNMENT) * _ALIGNMENT
+        data = np.memmap(self.index_file, dtype=np.uint8, mode='r')
+        arrays = {}
+        for (name, dtype, shape), (_, count, offset) in zip(_ARRAYS, header['arrays']):
+            nbytes = count * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            start = data_start + offset
+            arrays[name] = data[start: start + nbytes].view(dtype).reshape((count,) + shape)
+        return header['ids'], header['class_names'], arrays
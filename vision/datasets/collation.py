@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from torch.utils.data.dataloader import default_collate
 
 
 def object_detection_collate(batch):
@@ -28,4 +29,22 @@ def object_detection_collate(batch):
             gt_labels.append(labels)
         else:
             raise TypeError(f"Labels should be tensor or np.ndarray, but got {label_type}.")
-    return torch.stack(images), gt_boxes, gt_labels
\ No newline at end of file
+    return torch.stack(images), gt_boxes, gt_labels
+
+def padded_detection_collate(batch):
+    """Collate samples of raw boxes and labels, to be matched to the priors by MatchPrior.match_batch.
+
+    The boxes and labels of every image are padded to the largest image of the batch, the padding having
+     the label -1. The other fields of the samples are stacked.
+    """
+    num_targets = max(len(sample[2]) for sample in batch)
+    gt_boxes = torch.zeros(len(batch), num_targets, 4)
+    gt_labels = torch.full((len(batch), num_targets), -1, dtype=torch.int64)
+    for i, sample in enumerate(batch):
+        boxes, labels = sample[1], sample[2]
+        if len(labels):
+            gt_boxes[i, :len(labels)] = torch.as_tensor(np.asarray(boxes, dtype=np.float32)).view(-1, 4)
+            gt_labels[i, :len(labels)] = torch.as_tensor(np.asarray(labels, dtype=np.int64))
+    others = [default_collate([sample[k] for sample in batch]) for k in range(len(batch[0]))
+              if k not in (1, 2)]
+    return (others[0], gt_boxes, gt_labels) + tuple(others[1:])
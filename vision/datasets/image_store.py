@@ -0,0 +1,87 @@
+import json
+import os
+import pathlib
+import uuid
+
+import numpy as np
+
+from ..transforms.transforms import CvtRatio
+
+
+class ImageStore:
+
+    def __init__(self, store_file):
+        """Decoded and CvtRatio normalized images and masks of a dataset, served from a memory map.
+
+        Every image is stored as its (side, side, 3) plane followed by its (side, side) mask, in uint8.
+        Args:
+            store_file: the file written by build_image_store, its layout is in the .json next to it.
+        """
+        self.store_file = pathlib.Path(store_file)
+        with open(self.store_file.with_suffix('.json')) as f:
+            meta = json.load(f)
+        self.entries = {image_id: (offset, tuple(shape)) for image_id, offset, shape in meta['entries']}
+        self._data = None
+
+    def __contains__(self, image_id):
+        return image_id in self.entries
+
+    def get(self, image_id):
+        """Read only views of the image and the mask of image_id, nothing is copied."""
+        # the memory map is opened lazily so every loader worker gets its own one
+        if self._data is None:
+            self._data = np.memmap(self.store_file, dtype=np.uint8, mode='r')
+        offset, (height, width, depth) = self.entries[image_id]
+        image_size = height * width * depth
+        image = self._data[offset: offset + image_size].reshape(height, width, depth)
+        mask = self._data[offset + image_size: offset + image_size + height * width].reshape(height, width)
+        return image, mask
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+def _source_mtimes(dataset, image_id):
+    return [os.stat(dataset.root / f"{folder}/{image_id}.png").st_mtime_ns for folder in ["Images", "Segmentations"]]
+
+
+def build_image_store(dataset, store_file):
+    """Decode every image and mask of a VOCDataset once, apply CvtRatio and store them for ImageStore.
+
+    The store is reused as long as the image ids and the modification times of the pngs are unchanged.
+    Returns:
+        the ImageStore.
+    """
+    store_file = pathlib.Path(store_file)
+    meta_file = store_file.with_suffix('.json')
+    mtimes = [_source_mtimes(dataset, image_id) for image_id in dataset.ids]
+    if store_file.exists() and meta_file.exists():
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if [entry[0] for entry in meta['entries']] == list(dataset.ids) and meta['mtimes'] == mtimes:
+            return ImageStore(store_file)
+
+    store_file.parent.mkdir(parents=True, exist_ok=True)
+    cvt_ratio = CvtRatio()
+    entries = []
+    offset = 0
+    # names of their own, several processes may be building the same store
+    tmp_file = store_file.with_name(f"{store_file.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_file, "wb") as f:
+        for image_id in dataset.ids:
+            image, _, _, mask = cvt_ratio(dataset._read_image(image_id), np.zeros((0, 4), dtype=np.float32),
+                                          None, dataset._read_mask(image_id))
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            mask = np.ascontiguousarray(mask, dtype=np.uint8)
+            f.write(image.tobytes())
+            f.write(mask.tobytes())
+            entries.append([image_id, offset, list(image.shape)])
+            offset += image.nbytes + mask.nbytes
+    tmp_meta_file = meta_file.with_name(f"{meta_file.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_meta_file, "w") as f:
+        json.dump({'entries': entries, 'mtimes': mtimes}, f)
+    os.replace(tmp_file, store_file)
+    os.replace(tmp_meta_file, meta_file)
+    return ImageStore(store_file)
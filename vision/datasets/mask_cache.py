@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import pathlib
+import uuid
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+
+def mask_net_fingerprint(mask_net):
+    """Hash of the mask_net weights, a cache built with other weights is stale."""
+    digest = hashlib.sha1()
+    for name, value in sorted(mask_net.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(value.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def is_deterministic(transform):
+    """Only the outputs of transforms flagged as deterministic can be cached."""
+    return transform is None or getattr(transform, "deterministic", False)
+
+
+def dataset_signature(dataset):
+    """What the mask_net outputs of dataset depend on besides the weights: its images and its transform.
+
+    The images are identified by the dataset ids and, for a VOCDataset, the modification times of their pngs.
+    """
+    ids = [str(image_id) for image_id in getattr(dataset, 'ids', range(len(dataset)))]
+    digest = hashlib.sha1()
+    root = getattr(dataset, 'root', None)
+    for image_id in ids:
+        digest.update(image_id.encode() + b"\0")
+        if root is not None:
+            for folder in ["Images", "Segmentations"]:
+                path = pathlib.Path(root) / f"{folder}/{image_id}.png"
+                digest.update(str(path.stat().st_mtime_ns if path.exists() else -1).encode() + b"\0")
+    return {'images': digest.hexdigest(), 'transform': getattr(dataset.transform, 'settings', None),
+            'transform_type': type(dataset.transform).__name__}
+
+
+class MaskCachedDataset:
+
+    def __init__(self, dataset, cache_file):
+        """Serve the items of dataset along with the mask_net logits precomputed by build_mask_cache.
+
+        Args:
+            dataset: a dataset returning (image, boxes, labels, mask), with a deterministic transform.
+            cache_file: the .npy file written by build_mask_cache, read through a memory map.
+        """
+        self.dataset = dataset
+        self.cache_file = pathlib.Path(cache_file)
+        self._logits = None
+
+    def __getitem__(self, index):
+        # the memory map is opened lazily so every loader worker gets its own one
+        if self._logits is None:
+            self._logits = np.load(self.cache_file, mmap_mode='r')
+        image, boxes, labels, mask = self.dataset[index]
+        return image, boxes, labels, mask, torch.from_numpy(np.array(self._logits[index]))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_logits'] = None
+        return state
+
+
+def _collate_images(batch):
+    # only the images go through the mask_net, whatever the boxes look like
+    return torch.stack([sample[0] for sample in batch])
+
+
+def build_mask_cache(mask_net, dataset, cache_file, batch_size=10, num_workers=4, device=None):
+    """Run the frozen mask_net once over dataset and store its logits in a memory mapped .npy file.
+
+    The image half of the mask_net output is its input, so only the logits are stored. The cache is
+    reused as long as the mask_net weights and the dataset_signature are unchanged.
+    Returns:
+        a MaskCachedDataset serving dataset with the cached logits.
+    """
+    if not is_deterministic(dataset.transform):
+        raise ValueError("The mask_net outputs of a randomly augmented dataset cannot be cached.")
+    cache_file = pathlib.Path(cache_file)
+    meta_file = cache_file.with_suffix('.json')
+    meta = dict(size=len(dataset), fingerprint=mask_net_fingerprint(mask_net), **dataset_signature(dataset))
+    if cache_file.exists() and meta_file.exists():
+        with open(meta_file) as f:
+            if json.load(f) == meta:
+                return MaskCachedDataset(dataset, cache_file)
+
+    if device is None:
+        device = next(mask_net.parameters()).device
+    was_training = mask_net.training
+    mask_net.eval()
+    loader = DataLoader(dataset, batch_size, num_workers=num_workers, shuffle=False, collate_fn=_collate_images)
+    logits = None
+    start = 0
+    with torch.no_grad():
+        for images in loader:
+            x_l, _ = mask_net(images.to(device))
+            if logits is None:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                # a name of its own, several runs may be building the same cache
+                tmp_file = cache_file.with_name(f"{cache_file.stem}.{uuid.uuid4().hex}.tmp.npy")
+                logits = np.lib.format.open_memmap(str(tmp_file), mode='w+', dtype=np.float32,
+                                                   shape=(len(dataset),) + tuple(x_l.shape[1:]))
+            logits[start: start + x_l.size(0)] = x_l.cpu().numpy()
+            start += x_l.size(0)
+    mask_net.train(was_training)
+    logits.flush()
+    del logits
+    tmp_meta_file = meta_file.with_name(f"{meta_file.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_meta_file, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, cache_file)
+    os.replace(tmp_meta_file, meta_file)
+    return MaskCachedDataset(dataset, cache_file)
@@ -3,14 +3,22 @@ import pathlib
 import xml.etree.ElementTree as ET
 import cv2
 
+from .annotation_index import AnnotationIndex
+from ..transforms.transforms import CvtRatio
+
 
 class VOCDataset:
 
-    def __init__(self, root, transform=None, target_transform=None, is_test=False, keep_difficult=False):
+    def __init__(self, root, transform=None, target_transform=None, is_test=False, keep_difficult=False,
+                 use_annotation_index=True, image_store=None):
         """Dataset for VOC data.
         Args:
             root: the root of the VOC2007 or VOC2012 dataset, the directory contains the following sub-directories:
                 Annotations, ImageSets, JPEGImages, SegmentationClass, SegmentationObject.
+            use_annotation_index: read the annotations from a compiled AnnotationIndex instead of parsing
+                the xml of every sample.
+            image_store: an ImageStore of the already decoded and CvtRatio normalized images and masks,
+                the transform must then leave CvtRatio out.
         """
         self.root = pathlib.Path(root)
         # self.root = root
@@ -28,6 +36,11 @@ class VOCDataset:
             'qqq'
         )
         self.class_dict = {class_name: i for i, class_name in enumerate(self.class_names)}
+        self.image_store = image_store
+        self.annotation_index = None
+        if use_annotation_index:
+            self.annotation_index = AnnotationIndex(self.root / "Annotations", self.ids,
+                                                    self.root / f"{image_sets_file.stem}.annotations.idx")
 
     def __getitem__(self, index):
         image_id = self.ids[index]
@@ -37,8 +50,14 @@ class VOCDataset:
             labels = labels[is_difficult == 0]
         # print(image_id)
         # print('===', boxes.shape)
-        image = self._read_image(image_id)
-        mask = self._read_mask(image_id)
+        if self.image_store is not None:
+            image, mask = self.image_store.get(image_id)
+            boxes = boxes.copy()
+            boxes[:, 1] *= CvtRatio.h_ratio
+            boxes[:, 3] *= CvtRatio.h_ratio
+        else:
+            image = self._read_image(image_id)
+            mask = self._read_mask(image_id)
 
 
         if self.transform:
@@ -90,6 +109,11 @@ class VOCDataset:
         return ids
 
     def _get_annotation(self, image_id):
+        if self.annotation_index is not None:
+            _, _, names, boxes, _, _, is_difficult = self.annotation_index.get(image_id)
+            return (boxes,
+                    np.array([self.class_dict[class_name] for class_name in names], dtype=np.int64),
+                    is_difficult)
         annotation_file = self.root / f"Annotations/{image_id}.xml"
         objects = ET.parse(annotation_file).findall("object")
         boxes = []
@@ -30,31 +30,23 @@ class MultiboxLoss(nn.Module):
             labels (batch_size, num_priors): real labels of all the priors.
             boxes (batch_size, num_priors, 4): real boxes corresponding all the priors.
         """
-        num_classes = confidence.size(2)
+        # the losses are reduced in float32 when the network ran under autocast
+        confidence = confidence.float()
+        predicted_locations = predicted_locations.float()
+        masks = masks.float()
+        # the log probabilities are computed once, for the mining and the classification loss, and the
+        # losses are reduced with masked sums instead of gathering the selected priors
+        log_probs = F.log_softmax(confidence, dim=2)
         with torch.no_grad():
-            # derived from cross_entropy=sum(log(p))
-            loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
+            # derived from cross_entropy=sum(log(p)), the negation is a copy the mining can modify
+            loss = -log_probs[:, :, 0]
             mask = box_utils.hard_negative_mining(loss, labels, self.neg_pos_ratio)
 
-        confidence = confidence[mask, :]
-        classification_loss = F.cross_entropy(confidence.reshape(-1, num_classes), labels[mask], size_average=False)
+        nll = -log_probs.gather(2, labels.unsqueeze(2)).squeeze(2)
+        classification_loss = torch.where(mask, nll, torch.zeros_like(nll)).sum()
         pos_mask = labels > 0
-        predicted_locations = predicted_locations[pos_mask, :].reshape(-1, 4)
-        gt_locations = gt_locations[pos_mask, :].reshape(-1, 4)
-        # print(predicted_locations, gt_locations)
-        smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, size_average=False)
-        masks = torch.squeeze(masks)
-        gt_masks = torch.squeeze(gt_masks)
-        #
-        # for idx in range(masks.size(0)):
-        #     gt_mask = gt_masks[idx]
-        #     seg_mask = masks[idx]
-        #     gt_mask = gt_mask.cpu().numpy().astype(np.float32)
-        #     seg_mask = torch.squeeze(seg_mask)
-        #     seg_mask = seg_mask.cpu().detach().numpy().astype(np.float32)
-        #     cv2.imshow("gt_mask", gt_mask)
-        #     cv2.imshow("seg_mask", seg_mask)
-        #     cv2.waitKey(0)
-        mse_loss = F.mse_loss(masks, gt_masks, size_average=True)
-        num_pos = gt_locations.size(0)
+        smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='none').sum(2)
+        smooth_l1_loss = torch.where(pos_mask, smooth_l1_loss, torch.zeros_like(smooth_l1_loss)).sum()
+        mse_loss = F.mse_loss(masks, gt_masks.view_as(masks))
+        num_pos = pos_mask.sum()
         return smooth_l1_loss/num_pos, classification_loss/num_pos, mse_loss
@@ -0,0 +1 @@
+from .registry import register_net, net_names, get_config, create_net, create_predictor
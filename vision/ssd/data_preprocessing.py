@@ -1,17 +1,22 @@
+import numpy as np
+
 from ..transforms.transforms import *
 
 
 class TrainAugmentation:
-    def __init__(self, size, mean=0, std=255.0):
+    deterministic = False
+
+    def __init__(self, size, mean=0, std=255.0, cvt_ratio=True):
         """
         Args:
             size: the size the of final image.
             mean: mean pixel value per channel.
+            cvt_ratio: False when the images are already CvtRatio normalized, see datasets.image_store.
         """
         self.mean = mean
         self.size = size
-        self.augment = Compose([
-            CvtRatio(),
+        self.settings = {'size': size, 'mean': np.asarray(mean).tolist(), 'std': std, 'cvt_ratio': cvt_ratio}
+        self.augment = Compose(([CvtRatio()] if cvt_ratio else []) + [
             ConvertFromInts(),
             PhotometricDistort(),
             Expand(self.mean),
@@ -37,9 +42,13 @@ class TrainAugmentation:
 
 
 class TestTransform:
-    def __init__(self, size, mean=0.0, std=255.0):
-        self.transform = Compose([
-            CvtRatio(),
+    # the same input always gives the same output, see datasets.mask_cache
+    deterministic = True
+
+    def __init__(self, size, mean=0.0, std=255.0, cvt_ratio=True):
+        # what the outputs depend on, part of the key of the mask cache
+        self.settings = {'size': size, 'mean': np.asarray(mean).tolist(), 'std': std, 'cvt_ratio': cvt_ratio}
+        self.transform = Compose(([CvtRatio()] if cvt_ratio else []) + [
             ToPercentCoords(),
             Resize(size),
             SubtractMeans(mean),
@@ -1,14 +1,17 @@
+import numpy as np
 import torch
 
 from ..utils import box_utils
 from .data_preprocessing import PredictionTransform
-from ..utils.misc import Timer
+from ..utils.misc import Timer, autocast
 
 
 class Predictor:
     def __init__(self, net, size, mean=0.0, std=1.0, nms_method=None,
-                 iou_threshold=0.45, filter_threshold=0.3, candidate_size=200, sigma=0.5, device=None):
+                 iou_threshold=0.45, filter_threshold=0.3, candidate_size=200, sigma=0.5, device=None,
+                 soft_method="gaussian", mixed_precision=False, soft_candidate_size=-1):
         self.net = net
+        self.size = size
         self.transform = PredictionTransform(size, mean, std)
         self.iou_threshold = iou_threshold
         self.filter_threshold = filter_threshold
@@ -16,6 +19,11 @@ class Predictor:
         self.nms_method = nms_method
 
         self.sigma = sigma
+        self.soft_method = soft_method
+        # the candidates of every image and class Soft-NMS considers, all of them if <= 0
+        self.soft_candidate_size = soft_candidate_size
+        # run the network under autocast, the post processing stays in float32
+        self.mixed_precision = mixed_precision
         if device:
             self.device = device
         else:
@@ -27,57 +35,163 @@ class Predictor:
         self.timer = Timer()
 
     def predict(self, image, gt_mask, top_k=-1, prob_threshold=None):
-
-        cpu_device = torch.device("cpu")
-        height, width, _ = image.shape
         self.timer.start()
         image, gt_mask = self.transform(image,None,None,gt_mask)
         images = image.unsqueeze(0)
 
         images = images.to(self.device)
         print("pre time: ", self.timer.end())
-        with torch.no_grad():
+        with torch.no_grad(), autocast(self.device, self.mixed_precision):
             self.timer.start()
             scores, boxes, seg_mask, angle, Matrix, factor = self.net.forward(images)
             print("Inference time: ", self.timer.end())
         self.timer.start()
-        boxes = boxes[0]
-        scores = scores[0]
+        picked_boxes, picked_labels, picked_probs = self._post_process(boxes[:1], scores[:1], top_k, prob_threshold)[0]
+        print("after time: ", self.timer.end())
+        if picked_boxes is None:
+            return torch.tensor([]), torch.tensor([]), torch.tensor([]), torch.tensor([])
+        return picked_boxes, picked_labels, picked_probs, seg_mask, angle[0], Matrix[0], factor[0]
+
+    def predict_batch(self, images, gt_masks, top_k=-1, prob_threshold=None):
+        """Run detection on several images with a single forward pass.
+
+        Args:
+            images: a list of images in the layout accepted by predict.
+            gt_masks: a list of masks, one per image.
+        Returns:
+            a list with one entry per image, each entry being what predict returns for that image.
+        """
+        self.timer.start()
+        transformed = []
+        for image, gt_mask in zip(images, gt_masks):
+            image, _ = self.transform(image, None, None, gt_mask)
+            transformed.append(image)
+        images = torch.stack(transformed).to(self.device)
+        print("pre time: ", self.timer.end())
+        with torch.no_grad(), autocast(self.device, self.mixed_precision):
+            self.timer.start()
+            scores, boxes, seg_masks, angles, Matrices, factors = self.net.forward(images)
+            print("Inference time: ", self.timer.end())
+        self.timer.start()
+        results = []
+        picked = self._post_process(boxes, scores, top_k, prob_threshold)
+        for i, (picked_boxes, picked_labels, picked_probs) in enumerate(picked):
+            if picked_boxes is None:
+                results.append((torch.tensor([]), torch.tensor([]), torch.tensor([]), torch.tensor([])))
+                continue
+            results.append((picked_boxes, picked_labels, picked_probs, seg_masks[i:i + 1],
+                            angles[i], Matrices[i], factors[i]))
+        print("after time: ", self.timer.end())
+        return results
+
+    def predict_tiled(self, image, gt_mask=None, tile_size=None, overlap=None, batch_size=8, seam_margin=4.0,
+                      top_k=-1, prob_threshold=None):
+        """Run detection on a page larger than the network input, without squeezing it to the input size.
+
+        The page is cut into tile_size tiles overlapping by overlap pixels, batch_size of them going through
+        the network in one forward pass, so the memory used doesn't grow with the page. The boxes of every tile
+        are mapped back from its deskewed input to the page and merged with box_utils.seam_aware_nms, which
+        also joins the fragments of an object longer than the overlap into one box.
+        Args:
+            image (H, W, C): the page, in the layout accepted by predict.
+            gt_mask (H, W): its mask, zeros when not given.
+            tile_size: the side of the tiles in pixels of the page, the network input size by default.
+            overlap: the overlap of neighbouring tiles in pixels of the page, a quarter of the tile by default.
+        Returns:
+            the boxes in pixels of the page, labels and probabilities of the detections.
+        """
+        tile_size = tile_size or self.size
+        if overlap is None:
+            overlap = tile_size // 4
+        if overlap >= tile_size:
+            raise ValueError(f"The tile overlap {overlap} must be smaller than the tile size {tile_size}.")
+        height, width = image.shape[:2]
+        origins = [(x, y) for y in _tile_starts(height, tile_size, overlap)
+                   for x in _tile_starts(width, tile_size, overlap)]
+        tile_boxes = torch.tensor([[x, y, min(x + tile_size, width), min(y + tile_size, height)]
+                                   for x, y in origins], dtype=torch.float32)
+        picked_boxes, picked_labels, picked_probs, picked_tiles = [], [], [], []
+        for start in range(0, len(origins), batch_size):
+            tiles = []
+            for x, y in origins[start: start + batch_size]:
+                # the tiles at the right and bottom of a page smaller than a tile are padded with zeros
+                tile = np.zeros((tile_size, tile_size) + image.shape[2:], dtype=image.dtype)
+                tile_mask = np.zeros((tile_size, tile_size), dtype=np.float32)
+                tile_height, tile_width = min(tile_size, height - y), min(tile_size, width - x)
+                tile[:tile_height, :tile_width] = image[y: y + tile_height, x: x + tile_width]
+                if gt_mask is not None:
+                    tile_mask[:tile_height, :tile_width] = gt_mask[y: y + tile_height, x: x + tile_width]
+                tiles.append(self.transform(tile, None, None, tile_mask)[0])
+            images = torch.stack(tiles).to(self.device)
+            with torch.no_grad(), autocast(self.device, self.mixed_precision):
+                scores, boxes, _, _, Matrices, factors = self.net.forward(images)
+            picked = self._post_process(boxes, scores, top_k, prob_threshold)
+            for i, (page_boxes, labels, probs) in enumerate(picked):
+                if page_boxes is None:
+                    continue
+                tile = start + i
+                x, y = origins[tile]
+                page_boxes = box_utils.unrotate_boxes(page_boxes, Matrices[i], factors[i]) * (tile_size / self.size)
+                page_boxes = page_boxes + torch.tensor([x, y, x, y], dtype=page_boxes.dtype)
+                picked_boxes.append(torch.max(torch.min(page_boxes, tile_boxes[tile, 2:].repeat(2)),
+                                              tile_boxes[tile, :2].repeat(2)))
+                picked_labels.append(labels)
+                picked_probs.append(probs)
+                picked_tiles.append(torch.full_like(labels, tile))
+        if not picked_boxes:
+            return torch.tensor([]), torch.tensor([]), torch.tensor([])
+        boxes, labels, probs, tiles = [torch.cat(values) for values in
+                                       [picked_boxes, picked_labels, picked_probs, picked_tiles]]
+        keep, boxes = box_utils.seam_aware_nms(boxes, probs, labels, tiles, tile_boxes, self.iou_threshold,
+                                               seam_margin)
+        return boxes[keep], labels[keep], probs[keep]
+
+    def _post_process(self, boxes, scores, top_k=-1, prob_threshold=None):
+        """Filter and suppress the detections of a batch of images.
+
+        Args:
+            boxes (batch_size, num_priors, 4): corner form boxes relative to the image size.
+            scores (batch_size, num_priors, num_classes): class probabilities.
+        Returns:
+            a list with, for every image, the boxes in input pixels, labels and probabilities of the
+             kept detections, or a tuple of None when nothing is kept.
+        """
+        cpu_device = torch.device("cpu")
         if not prob_threshold:
             prob_threshold = self.filter_threshold
         # this version of nms is slower on GPU, so we move data to CPU.
         boxes = boxes.to(cpu_device)
         scores = scores.to(cpu_device)
-        picked_box_probs = []
-        picked_labels = []
-        for class_index in range(1, scores.size(1)):
-            probs = scores[:, class_index]
-            mask = probs > prob_threshold
-            probs = probs[mask]
-            if probs.size(0) == 0:
+        if self.nms_method == "soft":
+            picked = box_utils.batched_class_aware_soft_nms(boxes, scores, prob_threshold,
+                                                            sigma=self.sigma,
+                                                            top_k=top_k,
+                                                            method=self.soft_method,
+                                                            iou_threshold=self.iou_threshold,
+                                                            candidate_size=self.soft_candidate_size)
+        else:
+            picked = box_utils.batched_class_aware_nms(boxes, scores, prob_threshold,
+                                                       iou_threshold=self.iou_threshold,
+                                                       top_k=top_k,
+                                                       candidate_size=self.candidate_size)
+        results = []
+        for picked_box_probs, picked_labels in picked:
+            if picked_box_probs.size(0) == 0:
+                results.append((None, None, None))
                 continue
-            subset_boxes = boxes[mask, :]
-            box_probs = torch.cat([subset_boxes, probs.reshape(-1, 1)], dim=1)
-            box_probs = box_utils.nms(box_probs, self.nms_method,
-                                      score_threshold=prob_threshold,
-                                      iou_threshold=self.iou_threshold,
-                                      sigma=self.sigma,
-                                      top_k=top_k,
-                                      candidate_size=self.candidate_size)
-            picked_box_probs.append(box_probs)
-            picked_labels.extend([class_index] * box_probs.size(0))
+            # picked_box_probs[:, 0] *= (width / factor[0])
+            # picked_box_probs[:, 1] *= (height / factor[1])
+            # picked_box_probs[:, 2] *= (width / factor[0])
+            # picked_box_probs[:, 3] *= (height / factor[1])
+            picked_box_probs = picked_box_probs.clone()
+            picked_box_probs[:, :4] *= self.size
+            results.append((picked_box_probs[:, :4], picked_labels, picked_box_probs[:, 4]))
+        return results
 
-        print("after time: ", self.timer.end())
-        if not picked_box_probs:
-            return torch.tensor([]), torch.tensor([]), torch.tensor([]), torch.tensor([])
 
-        picked_box_probs = torch.cat(picked_box_probs)
-        # picked_box_probs[:, 0] *= (width / factor[0])
-        # picked_box_probs[:, 1] *= (height / factor[1])
-        # picked_box_probs[:, 2] *= (width / factor[0])
-        # picked_box_probs[:, 3] *= (height / factor[1])
-        picked_box_probs[:, 0] *= 768
-        picked_box_probs[:, 1] *= 768
-        picked_box_probs[:, 2] *= 768
-        picked_box_probs[:, 3] *= 768
-        return picked_box_probs[:, :4], torch.tensor(picked_labels), picked_box_probs[:, 4], seg_mask, angle, Matrix, factor
\ No newline at end of file
+def _tile_starts(length, tile_size, overlap):
+    """Starts of the tiles covering length, the last tile ending with it."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
@@ -0,0 +1,61 @@
+import collections
+import importlib
+
+
+NetEntry = collections.namedtuple('NetEntry', ['module', 'create_net', 'create_predictor', 'config', 'options'])
+
+_nets = {}
+
+
+def register_net(name, module, create_net, create_predictor, config, options=()):
+    """Register a net under name by the names of its module, factories and config.
+
+    Nothing is imported here, the module of the net is only imported by the first call using it.
+    Args:
+        module: the module of the factories, relative to vision.ssd.
+        create_net, create_predictor: the names of the net and predictor factories in module.
+        config: the name of the config module in vision.ssd.config.
+        options: the keyword arguments create_net passes to the net factory besides is_test, like width_mult.
+    """
+    _nets[name] = NetEntry(module, create_net, create_predictor, config, frozenset(options))
+
+
+def net_names():
+    return list(_nets)
+
+
+def _entry(name):
+    if name not in _nets:
+        raise ValueError(f"The net type {name} is wrong, it can be {', '.join(_nets)}.")
+    return _nets[name]
+
+
+def get_config(name):
+    return importlib.import_module(f".config.{_entry(name).config}", __package__)
+
+
+def create_net(name, num_classes, is_test=False, **options):
+    """Build the net registered under name, options the net doesn't take are left out."""
+    entry = _entry(name)
+    factory = getattr(importlib.import_module(entry.module, __package__), entry.create_net)
+    options = {key: value for key, value in options.items() if key in entry.options}
+    return factory(num_classes, is_test=is_test, **options)
+
+
+def create_predictor(name, net, **kwargs):
+    entry = _entry(name)
+    factory = getattr(importlib.import_module(entry.module, __package__), entry.create_predictor)
+    return factory(net, **kwargs)
+
+
+register_net('vgg16-ssd', '.vgg_ssd', 'create_vgg_ssd', 'create_vgg_ssd_predictor', 'vgg_ssd_config')
+register_net('mb1-ssd', '.mobilenetv1_ssd', 'create_mobilenetv1_ssd', 'create_mobilenetv1_ssd_predictor',
+             'mobilenetv1_ssd_config')
+register_net('mb1-ssd-lite', '.mobilenetv1_ssd_lite', 'create_mobilenetv1_ssd_lite',
+             'create_mobilenetv1_ssd_lite_predictor', 'mobilenetv1_ssd_config')
+register_net('sq-ssd-lite', '.squeezenet_ssd_lite', 'create_squeezenet_ssd_lite',
+             'create_squeezenet_ssd_lite_predictor', 'squeezenet_ssd_config')
+register_net('mb2-ssd-lite', '.mobilenet_v2_ssd_lite', 'create_mobilenetv2_ssd_lite',
+             'create_mobilenetv2_ssd_lite_predictor', 'mobilenetv1_ssd_config', options=['width_mult'])
+register_net('jnet-ssd-lite', '.imJnet_ssd_lite', 'create_imJnet_ssd_lite', 'create_imJnet_ssd_lite_predictor',
+             'mobilenetv1_ssd_config', options=['width_mult'])
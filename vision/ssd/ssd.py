@@ -36,6 +36,8 @@ class SSD(nn.Module):
         if is_test:
             self.config = config
             self.priors = config.priors.to(self.device)
+        self.test_top_k = -1
+        self.test_score_threshold = 0.0
             
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         confidences = []
@@ -88,15 +90,32 @@ class SSD(nn.Module):
         locations = torch.cat(locations, 1)
         
         if self.is_test:
-            confidences = F.softmax(confidences, dim=2)
+            # the decoding stays in float32 when the heads ran under autocast
+            confidences = F.softmax(confidences.float(), dim=2)
+            locations = locations.float()
+            priors = self.priors
+            if self.test_top_k > 0 or self.test_score_threshold > 0:
+                confidences, locations, priors = box_utils.select_top_priors(
+                    confidences, locations, priors, self.test_top_k, self.test_score_threshold
+                )
             boxes = box_utils.convert_locations_to_boxes(
-                locations, self.priors, self.config.center_variance, self.config.size_variance
+                locations, priors, self.config.center_variance, self.config.size_variance
             )
             boxes = box_utils.center_form_to_corner_form(boxes)
             return confidences, boxes
         else:
             return confidences, locations
 
+    def set_test_pruning(self, top_k=-1, score_threshold=0.0):
+        """Decode only the top_k priors with the best foreground scores in test mode.
+
+        The outputs then have top_k rows per image instead of one per prior, a top_k <= 0 keeps them all.
+        Priors whose best foreground score is not above score_threshold come back with zero probabilities,
+        with or without top_k.
+        """
+        self.test_top_k = top_k
+        self.test_score_threshold = score_threshold
+
     def compute_header(self, i, x):
         confidence = self.classification_headers[i](x)
         confidence = confidence.permute(0, 2, 3, 1).contiguous()
@@ -139,20 +158,56 @@ class SSD(nn.Module):
 
 
 class MatchPrior(object):
-    def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold):
+    def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold, prior_levels=None):
+        """
+        Args:
+            prior_levels: the prior layout given by box_utils.prior_levels, to match with the memory bounded
+                box_utils.sparse_assign_priors.
+        """
         self.center_form_priors = center_form_priors
         self.corner_form_priors = box_utils.center_form_to_corner_form(center_form_priors)
         self.center_variance = center_variance
         self.size_variance = size_variance
         self.iou_threshold = iou_threshold
+        self.prior_levels = prior_levels
+
+    def _assign(self, gt_boxes, gt_labels):
+        if self.prior_levels is not None:
+            return box_utils.sparse_assign_priors(gt_boxes, gt_labels, self.center_form_priors,
+                                                  self.prior_levels, self.iou_threshold)
+        return box_utils.assign_priors(gt_boxes, gt_labels,
+                                       self.corner_form_priors, self.iou_threshold)
 
     def __call__(self, gt_boxes, gt_labels):
         if type(gt_boxes) is np.ndarray:
             gt_boxes = torch.from_numpy(gt_boxes)
         if type(gt_labels) is np.ndarray:
             gt_labels = torch.from_numpy(gt_labels)
-        boxes, labels = box_utils.assign_priors(gt_boxes, gt_labels,
-                                                self.corner_form_priors, self.iou_threshold)
+        boxes, labels = self._assign(gt_boxes, gt_labels)
+        boxes = box_utils.corner_form_to_center_form(boxes)
+        locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
+        return locations, labels
+
+    def match_batch(self, gt_boxes, gt_labels):
+        """Match a padded batch, as built by padded_detection_collate, on the device of gt_boxes.
+
+        Args:
+            gt_boxes (batch_size, num_targets, 4): ground truth boxes.
+            gt_labels (batch_size, num_targets): labels of targets, negative for the padding.
+        Returns:
+            locations (batch_size, num_priors, 4) and labels (batch_size, num_priors) like __call__.
+        """
+        if self.center_form_priors.device != gt_boxes.device:
+            self.center_form_priors = self.center_form_priors.to(gt_boxes.device)
+            self.corner_form_priors = self.corner_form_priors.to(gt_boxes.device)
+        if self.prior_levels is not None:
+            assigned = [self._assign(boxes[labels >= 0], labels[labels >= 0])
+                        for boxes, labels in zip(gt_boxes, gt_labels)]
+            boxes = torch.stack([boxes for boxes, _ in assigned])
+            labels = torch.stack([labels for _, labels in assigned])
+        else:
+            boxes, labels = box_utils.batched_assign_priors(gt_boxes, gt_labels,
+                                                            self.corner_form_priors, self.iou_threshold)
         boxes = box_utils.corner_form_to_center_form(boxes)
         locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
         return locations, labels
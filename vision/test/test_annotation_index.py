@@ -0,0 +1,65 @@
+import os
+import pickle
+
+import numpy as np
+
+from ..datasets.annotation_index import AnnotationIndex
+
+
+def _write_annotation(path, objects, size=(200, 100)):
+    content = [f"<annotation><size><width>{size[0]}</width><height>{size[1]}</height></size>"]
+    for name, bndbox, polygon, difficult in objects:
+        content.append(f"<object><name>{name}</name><difficult>{difficult}</difficult>")
+        if bndbox is not None:
+            content.append("<bndbox>" + "".join(f"<{tag}>{v}</{tag}>" for tag, v in
+                                                zip(['xmin', 'ymin', 'xmax', 'ymax'], bndbox)) + "</bndbox>")
+        if polygon is not None:
+            content.append("<polygon>" + "".join(f"<point{k}>{x},{y}</point{k}>" for k, (x, y) in
+                                                 enumerate(polygon)) + "</polygon>")
+        content.append("</object>")
+    content.append("</annotation>")
+    path.write_text("".join(content))
+
+
+def test_annotation_index(tmp_path):
+    annotation_dir = tmp_path / "Annotations"
+    annotation_dir.mkdir()
+    polygon = [(1, 2), (30, 2), (30, 40), (1, 40)]
+    _write_annotation(annotation_dir / "a.xml", [("qqq", (1, 2, 30, 40), None, 0),
+                                                 ("Other", None, polygon, 1)])
+    _write_annotation(annotation_dir / "b.xml", [])
+    index_file = tmp_path / "trainval.annotations.idx"
+
+    index = AnnotationIndex(annotation_dir, ["a", "b"], index_file)
+    assert index_file.exists()
+    for loaded in [index, AnnotationIndex(annotation_dir, ["a", "b"], index_file), pickle.loads(pickle.dumps(index))]:
+        w, h, names, bndboxes, polygons, has_polygon, difficult = loaded.get("a")
+        assert (w, h) == (200, 100)
+        assert names == ["qqq", "other"]
+        assert np.array_equal(bndboxes[0], [1, 2, 30, 40])
+        assert np.isnan(bndboxes[1]).all()
+        assert np.array_equal(polygons[1], polygon)
+        assert has_polygon.tolist() == [False, True]
+        assert difficult.tolist() == [0, 1]
+        assert loaded.get("b")[2] == []
+
+    # an edited xml makes the index compile again
+    _write_annotation(annotation_dir / "b.xml", [("qqq", (5, 6, 7, 8), None, 0)])
+    stat = os.stat(annotation_dir / "b.xml")
+    os.utime(annotation_dir / "b.xml", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    index = AnnotationIndex(annotation_dir, ["a", "b"], index_file)
+    assert np.array_equal(index.get("b")[3], [[5, 6, 7, 8]])
+
+
+def test_annotation_index_unpickled_after_the_file_changed(tmp_path):
+    annotation_dir = tmp_path / "Annotations"
+    annotation_dir.mkdir()
+    _write_annotation(annotation_dir / "a.xml", [("qqq", (1, 2, 30, 40), None, 0)])
+    index_file = tmp_path / "trainval.annotations.idx"
+    state = pickle.dumps(AnnotationIndex(annotation_dir, ["a"], index_file))
+    assert [path.name for path in tmp_path.iterdir() if path.is_file()] == [index_file.name]
+
+    for damage in [lambda: index_file.write_bytes(b"not an index"), lambda: index_file.unlink()]:
+        damage()
+        index = pickle.loads(state)
+        assert np.array_equal(index.get("a")[3], [[1, 2, 30, 40]])
@@ -0,0 +1,265 @@
+import torch
+
+from ..utils import box_utils
+
+
+def _random_boxes(n, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.rand(n, 2, generator=generator)
+    sizes = torch.rand(n, 2, generator=generator) * 0.3 + 0.01
+    return torch.cat([centers - sizes / 2, centers + sizes / 2], 1)
+
+
+def test_class_aware_hard_nms_matches_hard_nms():
+    boxes = _random_boxes(300)
+    generator = torch.Generator().manual_seed(1)
+    scores = torch.rand(300, generator=generator)
+    labels = torch.randint(1, 4, (300,), generator=generator)
+    for top_k, candidate_size in [(-1, 200), (5, 200), (-1, 20)]:
+        keep = box_utils.class_aware_hard_nms(boxes, scores, labels, 0.45,
+                                              top_k=top_k, candidate_size=candidate_size)
+        expected = []
+        for label in range(1, 4):
+            mask = labels == label
+            box_scores = torch.cat([boxes[mask], scores[mask].unsqueeze(1)], 1)
+            expected.append(box_utils.hard_nms(box_scores, 0.45, top_k=top_k, candidate_size=candidate_size))
+        expected = torch.cat(expected)
+        assert torch.equal(torch.cat([boxes[keep], scores[keep].unsqueeze(1)], 1), expected)
+
+
+def test_batched_class_aware_nms_matches_single_images():
+    generator = torch.Generator().manual_seed(2)
+    boxes = torch.stack([_random_boxes(200, seed) for seed in range(3)])
+    scores = torch.softmax(torch.randn(3, 200, 3, generator=generator) * 2, dim=2)
+    batched = box_utils.batched_class_aware_nms(boxes, scores, 0.3, 0.45)
+    assert len(batched) == 3
+    for i, (box_probs, labels) in enumerate(batched):
+        single_box_probs, single_labels = box_utils.batched_class_aware_nms(boxes[i:i + 1], scores[i:i + 1],
+                                                                            0.3, 0.45)[0]
+        assert torch.equal(box_probs, single_box_probs)
+        assert torch.equal(labels, single_labels)
+
+
+def _reference_soft_nms(box_scores, score_threshold, sigma=0.5, top_k=-1):
+    picked_box_scores = []
+    while box_scores.size(0) > 0:
+        max_score_index = torch.argmax(box_scores[:, 4])
+        cur_box_prob = box_scores[max_score_index, :].clone()
+        picked_box_scores.append(cur_box_prob)
+        if len(picked_box_scores) == top_k > 0 or box_scores.size(0) == 1:
+            break
+        cur_box = cur_box_prob[:-1]
+        box_scores[max_score_index, :] = box_scores[-1, :]
+        box_scores = box_scores[:-1, :]
+        ious = box_utils.iou_of(cur_box.unsqueeze(0), box_scores[:, :-1])
+        box_scores[:, -1] = box_scores[:, -1] * torch.exp(-(ious * ious) / sigma)
+        box_scores = box_scores[box_scores[:, -1] > score_threshold, :]
+    return torch.stack(picked_box_scores)
+
+
+def test_soft_nms_matches_reference():
+    generator = torch.Generator().manual_seed(3)
+    box_scores = torch.cat([_random_boxes(150, 3), torch.rand(150, 1, generator=generator) * 0.7 + 0.3], 1)
+    for top_k in [-1, 10]:
+        expected = _reference_soft_nms(box_scores.clone(), 0.3, sigma=0.5, top_k=top_k)
+        actual = box_utils.soft_nms(box_scores.clone(), 0.3, sigma=0.5, top_k=top_k)
+        assert actual.size() == expected.size()
+        assert torch.allclose(actual, expected)
+
+
+def test_batched_class_aware_soft_nms_matches_soft_nms():
+    generator = torch.Generator().manual_seed(4)
+    boxes = torch.stack([_random_boxes(100, seed) for seed in range(2)])
+    scores = torch.softmax(torch.randn(2, 100, 3, generator=generator) * 2, dim=2)
+    for method in ["gaussian", "linear"]:
+        batched = box_utils.batched_class_aware_soft_nms(boxes, scores, 0.3, top_k=5, method=method,
+                                                         iou_threshold=0.45)
+        for i, (box_probs, labels) in enumerate(batched):
+            for class_index in range(1, 3):
+                mask = scores[i, :, class_index] > 0.3
+                box_scores = torch.cat([boxes[i][mask], scores[i, mask, class_index].unsqueeze(1)], 1)
+                expected = box_utils.soft_nms(box_scores, 0.3, top_k=5, method=method, iou_threshold=0.45)
+                assert torch.allclose(box_probs[labels == class_index], expected.reshape(-1, 5))
+
+
+def test_batched_class_aware_soft_nms_candidate_size():
+    generator = torch.Generator().manual_seed(6)
+    boxes = torch.stack([_random_boxes(100, seed) for seed in range(2)])
+    scores = torch.softmax(torch.randn(2, 100, 3, generator=generator) * 2, dim=2)
+    batched = box_utils.batched_class_aware_soft_nms(boxes, scores, 0.3, candidate_size=10)
+    for i, (box_probs, labels) in enumerate(batched):
+        for class_index in range(1, 3):
+            mask = scores[i, :, class_index] > 0.3
+            box_scores = torch.cat([boxes[i][mask], scores[i, mask, class_index].unsqueeze(1)], 1)
+            # only the 10 best candidates of the image and class take part
+            box_scores = box_scores[box_scores[:, 4].argsort(descending=True)[:10]]
+            expected = box_utils.soft_nms(box_scores, 0.3)
+            assert torch.allclose(box_probs[labels == class_index], expected.reshape(-1, 5))
+
+
+def test_batched_class_aware_soft_nms_is_not_capped_by_default():
+    generator = torch.Generator().manual_seed(7)
+    boxes = _random_boxes(400, 8).unsqueeze(0)
+    scores = torch.softmax(torch.randn(1, 400, 2, generator=generator), dim=2)
+    box_probs, _ = box_utils.batched_class_aware_soft_nms(boxes, scores, 0.1)[0]
+    mask = scores[0, :, 1] > 0.1
+    assert mask.sum() > 200
+    expected = box_utils.soft_nms(torch.cat([boxes[0][mask], scores[0, mask, 1].unsqueeze(1)], 1), 0.1)
+    assert torch.allclose(box_probs, expected)
+
+
+def test_batched_assign_priors_matches_assign_priors():
+    priors = _random_boxes(500, 10)
+    generator = torch.Generator().manual_seed(5)
+    num_targets = [7, 3, 0]
+    gt_boxes = torch.zeros(3, 7, 4)
+    gt_labels = torch.full((3, 7), -1, dtype=torch.int64)
+    for i, n in enumerate(num_targets):
+        gt_boxes[i, :n] = _random_boxes(n, 20 + i)
+        gt_labels[i, :n] = torch.randint(1, 4, (n,), generator=generator)
+    # several targets sharing their best prior
+    gt_boxes[0, 4] = gt_boxes[0, 5] = gt_boxes[0, 6]
+    boxes, labels = box_utils.batched_assign_priors(gt_boxes, gt_labels, priors, 0.5)
+    for i, n in enumerate(num_targets):
+        if n == 0:
+            assert (labels[i] == 0).all()
+            continue
+        expected_boxes, expected_labels = box_utils.assign_priors(gt_boxes[i, :n], gt_labels[i, :n].clone(),
+                                                                  priors, 0.5)
+        assert torch.equal(boxes[i], expected_boxes)
+        assert torch.equal(labels[i], expected_labels)
+
+
+def test_sparse_assign_priors_matches_assign_priors():
+    from ..ssd.config import mobilenetv1_ssd_config as config
+    levels = box_utils.prior_levels(config.specs, config.image_size)
+    assert levels[-1][0] + levels[-1][1] ** 2 * levels[-1][2] == config.priors.size(0)
+    corner_form_priors = box_utils.center_form_to_corner_form(config.priors)
+    generator = torch.Generator().manual_seed(6)
+    gt_boxes = _random_boxes(300, 30) * 0.5
+    # tiny boxes and duplicates share or miss their best priors
+    gt_boxes[:20] = gt_boxes[:20, :2].repeat(1, 2) + torch.tensor([0, 0, 1e-3, 1e-3])
+    gt_boxes[20:25] = gt_boxes[25]
+    gt_labels = torch.randint(1, 4, (300,), generator=generator)
+    expected_boxes, expected_labels = box_utils.assign_priors(gt_boxes, gt_labels.clone(), corner_form_priors, 0.5)
+    for max_pairs in [1 << 22, 5000]:
+        boxes, labels = box_utils.sparse_assign_priors(gt_boxes, gt_labels.clone(), config.priors, levels, 0.5,
+                                                       max_pairs=max_pairs)
+        assert torch.equal(boxes, expected_boxes)
+        assert torch.equal(labels, expected_labels)
+
+
+def _reference_hard_negative_mining(loss, labels, neg_pos_ratio):
+    pos_mask = labels > 0
+    num_neg = pos_mask.long().sum(dim=1, keepdim=True) * neg_pos_ratio
+    loss[pos_mask] = -float("inf")
+    _, indexes = loss.sort(dim=1, descending=True)
+    _, orders = indexes.sort(dim=1)
+    return pos_mask | (orders < num_neg)
+
+
+def test_hard_negative_mining_matches_sort():
+    generator = torch.Generator().manual_seed(7)
+    loss = torch.rand(4, 1000, generator=generator)
+    labels = (torch.rand(4, 1000, generator=generator) < torch.tensor([[0.01], [0.1], [0.5], [0.0]])).long()
+    for neg_pos_ratio in [1, 3]:
+        mask = box_utils.hard_negative_mining(loss.clone(), labels, neg_pos_ratio)
+        assert torch.equal(mask, _reference_hard_negative_mining(loss.clone(), labels, neg_pos_ratio))
+
+
+def _reference_priors(specs, image_size, both_ways):
+    # the loop generate_ssd_priors used to run, both_ways being the layout of box_utils_numpy
+    import itertools
+    import math
+    priors = []
+    for spec in specs:
+        scale = image_size / spec.shrinkage
+        for j, i in itertools.product(range(spec.feature_map_size), repeat=2):
+            x_center = (i + 0.5) / scale
+            y_center = (j + 0.5) / scale
+            w = spec.box_sizes.min / image_size
+            priors.append([x_center, y_center, w, w])
+            big = math.sqrt(spec.box_sizes.max * spec.box_sizes.min) / image_size
+            priors.append([x_center, y_center, big, big])
+            for ratio in spec.aspect_ratios:
+                ratio = math.sqrt(ratio)
+                priors.append([x_center, y_center, w * ratio, w / ratio])
+                if both_ways:
+                    priors.append([x_center, y_center, w / ratio, w * ratio])
+    return priors
+
+
+def test_generate_ssd_priors_is_bit_identical():
+    import numpy as np
+    from ..ssd.config import mobilenetv1_ssd_config, vgg_ssd_config
+    from ..utils import box_utils_numpy
+    for config in [mobilenetv1_ssd_config, vgg_ssd_config]:
+        for clamp in [True, False]:
+            expected = torch.tensor(_reference_priors(config.specs, config.image_size, False))
+            if clamp:
+                expected = expected.clamp(0.0, 1.0)
+            priors = box_utils.generate_ssd_priors(config.specs, config.image_size, clamp=clamp)
+            assert priors.dtype == expected.dtype and torch.equal(priors, expected)
+
+            expected = np.array(_reference_priors(config.specs, config.image_size, True), dtype=np.float32)
+            if clamp:
+                expected = np.clip(expected, 0.0, 1.0)
+            priors = box_utils_numpy.generate_ssd_priors(config.specs, config.image_size, clamp=clamp)
+            assert priors.dtype == expected.dtype and np.array_equal(priors, expected)
+
+
+def test_generate_ssd_priors_returns_copies():
+    specs = [box_utils.SSDSpec(4, 16, box_utils.SSDBoxSizes(20, 40), [2, 3])]
+    priors = box_utils.generate_ssd_priors(specs, 64)
+    priors.zero_()
+    assert box_utils.generate_ssd_priors(specs, 64).abs().sum() > 0
+    start, size, num_shapes = box_utils.prior_levels(specs, 64)[0]
+    assert (start, size, num_shapes) == (0, 4, 4)
+    assert priors.size(0) == size * size * num_shapes
+
+
+def test_seam_aware_nms_merges_tiles():
+    # two tiles overlapping on x in [60, 100]
+    tile_boxes = torch.tensor([[0., 0., 100., 100.], [60., 0., 160., 100.]])
+    boxes = torch.tensor([
+        [70., 10., 90., 30.],   # tile 0, inside the overlap
+        [70., 10., 90., 31.],   # tile 1, the same object
+        [66., 50., 98., 70.],   # tile 1, whole object
+        [66., 50., 97., 70.],   # tile 0, cut by its right seam, inside the tile 1 box
+        [10., 10., 30., 30.],   # tile 0, only in tile 0
+        [70., 10., 90., 30.],   # tile 1, another label
+    ])
+    scores = torch.tensor([0.9, 0.8, 0.6, 0.7, 0.5, 0.4])
+    labels = torch.tensor([1, 1, 1, 1, 1, 2])
+    tiles = torch.tensor([0, 1, 1, 0, 0, 1])
+    keep, merged = box_utils.seam_aware_nms(boxes, scores, labels, tiles, tile_boxes, 0.5, seam_margin=4.0)
+    assert keep.tolist() == [0, 2, 4, 5]
+    assert torch.equal(merged, boxes)
+
+
+def test_seam_aware_nms_fuses_objects_longer_than_the_overlap():
+    # three tiles overlapping by 40 pixels on x, an object spanning x in [20, 190] cut by all of them
+    tile_boxes = torch.tensor([[0., 0., 100., 100.], [60., 0., 160., 100.], [120., 0., 200., 100.]])
+    boxes = torch.tensor([
+        [20., 10., 100., 40.],   # tile 0, cut by its right seam
+        [60., 11., 160., 40.],   # tile 1, cut by both seams
+        [120., 10., 190., 41.],  # tile 2, cut by its left seam
+        [20., 60., 98., 80.],    # tile 0, ends at the seam but is whole: nothing cut on its right in tile 1
+        [102., 60., 150., 80.],  # tile 1, the next cell of the row
+    ])
+    scores = torch.tensor([0.7, 0.9, 0.8, 0.6, 0.5])
+    labels = torch.tensor([1, 1, 1, 1, 1])
+    tiles = torch.tensor([0, 1, 2, 0, 1])
+    keep, merged = box_utils.seam_aware_nms(boxes, scores, labels, tiles, tile_boxes, 0.5, seam_margin=4.0)
+    assert keep.tolist() == [1, 3, 4]
+    assert torch.equal(merged[1], torch.tensor([20., 10., 190., 41.]))
+    assert torch.equal(merged[[3, 4]], boxes[[3, 4]])
+
+
+def test_unrotate_boxes_identity_and_shift():
+    import numpy as np
+    boxes = torch.tensor([[10., 20., 30., 40.]])
+    assert torch.allclose(box_utils.unrotate_boxes(boxes, np.eye(2, 3), [1.0, 1.0]), boxes)
+    Matrix = np.array([[0., -1., 100.], [1., 0., 0.]])  # a quarter turn
+    assert torch.allclose(box_utils.unrotate_boxes(boxes, Matrix, [2.0, 2.0]),
+                          torch.tensor([[80., 5., 90., 15.]]))
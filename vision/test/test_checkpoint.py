@@ -0,0 +1,57 @@
+import os
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ..utils.checkpoint import CheckpointManager, restore_training_state, state_path
+
+
+def test_checkpoint_manager_rotation(tmp_path):
+    net = nn.Linear(3, 2)
+    checkpoints = CheckpointManager(str(tmp_path), keep_best=2, keep_last=1)
+    paths = [checkpoints.save(net, f"net-{epoch}", loss, epoch=epoch)
+             for epoch, loss in enumerate([5.0, 1.0, 3.0, 2.0, 4.0])]
+    checkpoints.close()
+    # the two lowest losses and the last checkpoint
+    kept = [paths[1], paths[3], paths[4]]
+    for path in paths:
+        assert os.path.exists(path) == (path in kept)
+        assert os.path.exists(state_path(path)) == (path in kept)
+    state_dict = torch.load(paths[4])
+    assert torch.equal(state_dict['weight'], net.weight)
+
+
+def test_checkpoint_manager_keeps_the_newest(tmp_path):
+    net = nn.Linear(3, 2)
+    checkpoints = CheckpointManager(str(tmp_path), keep_best=0, keep_last=0)
+    paths = [checkpoints.save(net, f"net-{epoch}", loss, epoch=epoch) for epoch, loss in enumerate([2.0, 1.0])]
+    checkpoints.close()
+    assert not os.path.exists(paths[0]) and not os.path.exists(state_path(paths[0]))
+    assert os.path.exists(paths[1]) and os.path.exists(state_path(paths[1]))
+
+
+def test_checkpoint_manager_snapshot_and_resume(tmp_path):
+    net = nn.Linear(3, 2)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    net(torch.randn(4, 3)).sum().backward()
+    optimizer.step()
+    checkpoints = CheckpointManager(str(tmp_path), keep_best=-1)
+    path = checkpoints.save(net, "net", 1.0, epoch=7, optimizer=optimizer)
+    expected_weight = net.weight.detach().clone()
+    # the saved weights are the ones at save time
+    with torch.no_grad():
+        net.weight.add_(1.0)
+    expected = (torch.rand(3), np.random.rand(3), random.random())
+    checkpoints.close()
+    assert torch.equal(torch.load(path)['weight'], expected_weight)
+
+    resumed = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    state = restore_training_state(path, resumed)
+    assert state['epoch'] == 7
+    assert torch.equal(resumed.state_dict()['state'][0]['momentum_buffer'],
+                       optimizer.state_dict()['state'][0]['momentum_buffer'])
+    assert torch.equal(torch.rand(3), expected[0])
+    assert np.array_equal(np.random.rand(3), expected[1])
+    assert random.random() == expected[2]
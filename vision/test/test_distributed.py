@@ -0,0 +1,59 @@
+import json
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import TensorDataset
+
+from ..utils.checkpoint import CheckpointManager
+from ..utils.distributed import all_reduce_mean, is_main_process, make_loader, save_checkpoint
+
+
+def _worker(rank, world_size, folder):
+    dist.init_process_group("gloo", init_method=f"file://{os.path.join(folder, 'rendezvous')}",
+                            rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    inputs = torch.randn(10, 3)
+    dataset = TensorDataset(torch.arange(10), inputs, inputs.sum(1, keepdim=True))
+    net = DistributedDataParallel(nn.Linear(3, 1))
+    net.eval()
+    indexes = []
+    losses = []
+    with torch.no_grad():
+        for batch_indexes, x, y in make_loader(dataset, 2, shuffle=False):
+            indexes += batch_indexes.tolist()
+            losses.append(nn.functional.mse_loss(net(x), y).item())
+    shard_loss = sum(losses) / len(losses)
+    val_loss, = all_reduce_mean([shard_loss], torch.device("cpu"))
+
+    checkpoints = CheckpointManager(folder, keep_best=-1)
+    model_path = save_checkpoint(checkpoints, net.module, f"net-{rank}", val_loss)
+    checkpoints.close()
+    with open(os.path.join(folder, f"rank-{rank}.json"), "w") as f:
+        json.dump({'indexes': indexes, 'shard_loss': shard_loss, 'val_loss': val_loss,
+                   'main': is_main_process(), 'model_path': model_path}, f)
+    dist.destroy_process_group()
+
+
+def test_gloo_processes(tmp_path):
+    mp.spawn(_worker, args=(2, str(tmp_path)), nprocs=2)
+    results = []
+    for rank in range(2):
+        with open(tmp_path / f"rank-{rank}.json") as f:
+            results.append(json.load(f))
+
+    # the sampler gives every process its own shard of the dataset
+    assert sorted(results[0]['indexes'] + results[1]['indexes']) == list(range(10))
+    assert len(results[0]['indexes']) == len(results[1]['indexes']) == 5
+    # every process gets the mean of the validation losses of the shards
+    expected = (results[0]['shard_loss'] + results[1]['shard_loss']) / 2
+    for result in results:
+        assert abs(result['val_loss'] - expected) < 1e-9
+    # only the main process saves checkpoints
+    assert [result['main'] for result in results] == [True, False]
+    assert results[0]['model_path'] == str(tmp_path / "net-0.pth")
+    assert results[1]['model_path'] is None
+    assert sorted(path.name for path in tmp_path.glob("*.pth")) == ["net-0-state.pth", "net-0.pth"]
@@ -0,0 +1,43 @@
+import numpy as np
+
+from ..datasets.image_store import build_image_store
+from ..transforms.transforms import CvtRatio
+
+
+class _FakeDataset:
+    def __init__(self, root, shapes):
+        self.root = root
+        self.ids = [f"{i:02d}" for i in range(len(shapes))]
+        self.shapes = dict(zip(self.ids, shapes))
+        for folder in ["Images", "Segmentations"]:
+            (root / folder).mkdir()
+            for image_id in self.ids:
+                (root / folder / f"{image_id}.png").touch()
+
+    def _read_image(self, image_id):
+        h, w = self.shapes[image_id]
+        return np.random.RandomState(int(image_id)).randint(0, 256, (h, w, 3)).astype(np.uint8)
+
+    def _read_mask(self, image_id):
+        h, w = self.shapes[image_id]
+        return np.random.RandomState(int(image_id) + 100).randint(0, 256, (h, w)).astype(np.uint8)
+
+
+def test_image_store(tmp_path):
+    dataset = _FakeDataset(tmp_path, [(20, 50), (30, 30)])
+    store = build_image_store(dataset, tmp_path / "train.store")
+    for image_id in dataset.ids:
+        expected_image, _, _, expected_mask = CvtRatio()(dataset._read_image(image_id),
+                                                         np.zeros((0, 4), dtype=np.float32), None,
+                                                         dataset._read_mask(image_id))
+        image, mask = store.get(image_id)
+        assert np.array_equal(image, expected_image)
+        assert np.array_equal(mask, expected_mask)
+        assert not image.flags.writeable
+
+    # the store is reused until the ids change
+    modified = (tmp_path / "train.store").stat().st_mtime_ns
+    build_image_store(dataset, tmp_path / "train.store")
+    assert (tmp_path / "train.store").stat().st_mtime_ns == modified
+    dataset.ids = dataset.ids[:1]
+    assert "01" not in build_image_store(dataset, tmp_path / "train.store")
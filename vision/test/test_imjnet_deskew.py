@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from ..ssd.imJnet_ssd import estimate_skew_angle, estimate_skew_angles, rotate_bound_resized, rotate_map
+
+
+def _skewed_lines_mask(angle, size=256):
+    mask = torch.zeros(size, size)
+    slope = math.tan(math.radians(angle))
+    for y0 in range(40, size - 40, 40):
+        for x in range(size):
+            y = int(round(y0 + slope * x))
+            if 0 <= y < size - 4:
+                mask[y:y + 4, x] = 1
+    return mask
+
+
+def test_estimate_skew_angle():
+    for angle in [-6.0, 0.0, 4.0]:
+        estimated = float(estimate_skew_angle(_skewed_lines_mask(angle)))
+        assert abs(estimated - angle) < 1.0
+
+
+def test_estimate_skew_angle_sub_degree():
+    for angle in [-0.6, 0.4, 0.8]:
+        estimated = float(estimate_skew_angle(_skewed_lines_mask(angle, size=768)))
+        assert abs(estimated - angle) <= 0.2
+
+
+def _hough_lines_skew_angle(seg_mask):
+    # the cv2 estimation estimate_skew_angles replaces
+    import cv2
+    thresh_mask = (seg_mask * 255).astype(np.uint8)
+    thresh_mask[thresh_mask > 127] = 255
+    thresh_mask[thresh_mask <= 127] = 0
+    thresh_mask = cv2.resize(thresh_mask, (seg_mask.shape[1] // 2, seg_mask.shape[0] // 2))
+    horizon_mask = cv2.Sobel(thresh_mask, cv2.CV_8UC1, 0, 1, ksize=3)
+    lines = cv2.HoughLinesP(horizon_mask, 1, np.pi / 180, threshold=40, minLineLength=10, maxLineGap=10)
+    angles = []
+    for x1, y1, x2, y2 in (lines.reshape(-1, 4).astype(np.int64) if lines is not None else []):
+        theta = np.arctan2(y1 - y2, x1 - x2)
+        if 4.5 / 18 * np.pi < (np.pi + theta if theta < 0 else theta) < 13.5 / 18 * np.pi:
+            continue
+        angle = theta * 180 / np.pi
+        angles.append(180 + angle if angle < 0 else angle - 180)
+    return float(np.mean(angles)) if angles else 0.0
+
+
+def _table_mask(angle, size=768):
+    import cv2
+    table = np.zeros((size, size), dtype=np.uint8)
+    bottom = 60 + 36 * ((size - 120) // 36)
+    for y in range(60, bottom + 1, 36):
+        cv2.line(table, (40, y), (size - 40, y), 255, 3)
+    for x in range(40, size - 39, 90):
+        cv2.line(table, (x, 60), (x, bottom), 255, 3)
+    M = cv2.getRotationMatrix2D((size / 2, size / 2), -angle, 1.0)
+    return cv2.warpAffine(table, M, (size, size)).astype(np.float32) / 255
+
+
+def test_estimate_skew_angle_against_hough_lines():
+    pytest.importorskip("cv2")
+    for angle in [-7.3, -4.4, -1.2, 0.5, 2.2, 5.0]:
+        mask = _table_mask(angle)
+        estimated = float(estimate_skew_angle(torch.from_numpy(mask)))
+        # HoughLinesP pulls small skews towards 0, the estimate is never further from the actual skew
+        assert abs(estimated - angle) <= 0.2
+        assert abs(estimated - angle) <= abs(_hough_lines_skew_angle(mask) - angle) + 0.05
+
+
+def test_estimate_skew_angle_without_lines():
+    assert float(estimate_skew_angle(torch.zeros(64, 64))) == 0.0
+
+
+def test_rotate_bound_resized_identity():
+    x = torch.rand(2, 3, 32, 48)
+    rotated, canvas_sizes = rotate_bound_resized(x, [0.0, 0.0])
+    assert canvas_sizes == [(32, 48), (32, 48)]
+    assert torch.allclose(rotated, x, atol=1e-5)
+
+
+def test_estimate_skew_angles_per_sample():
+    masks = torch.stack([_skewed_lines_mask(angle) for angle in [-6.0, 0.0, 4.0]])
+    angles = estimate_skew_angles(masks)
+    for i in range(3):
+        assert torch.allclose(angles[i], estimate_skew_angle(masks[i]))
+
+
+def test_rotate_map_outputs():
+    mask = torch.stack([_skewed_lines_mask(5.0), _skewed_lines_mask(-3.0)]).view(2, 1, 256, 256)
+    image = torch.rand(2, 3, 256, 256)
+    rotate_mask, rotate_image, angles, Matrices, factors = rotate_map(mask, image, torch.device("cpu"))
+    assert rotate_mask.size() == mask.size()
+    assert rotate_image.size() == image.size()
+    assert abs(angles[0] - 5.0) < 1.0
+    assert abs(angles[1] + 3.0) < 1.0
+    for i, (Matrix, factor) in enumerate(zip(Matrices, factors)):
+        assert Matrix.shape == (2, 3)
+        # the reverse matrix maps the canvas center back to the image center
+        nW, nH = 256 / factor[0], 256 / factor[1]
+        center = Matrix.dot(np.array([nW / 2, nH / 2, 1.0]))
+        assert np.allclose(center, [128, 128], atol=1.0)
+        # every sample is rotated on its own
+        single_mask, single_image, _, _, _ = rotate_map(mask[i:i + 1], image[i:i + 1], torch.device("cpu"))
+        assert torch.allclose(rotate_image[i:i + 1], single_image, atol=1e-5)
+
+
+def test_rotate_map_skips_negligible_skew():
+    mask = torch.stack([_skewed_lines_mask(5.0), _skewed_lines_mask(0.0)]).view(2, 1, 256, 256)
+    image = torch.rand(2, 3, 256, 256)
+    rotate_mask, rotate_image, angles, Matrices, factors = rotate_map(mask, image, torch.device("cpu"),
+                                                                      angle_tolerance=1.0)
+    assert angles[1] == 0.0
+    assert torch.equal(rotate_image[1], image[1])
+    assert torch.equal(rotate_mask[1], mask[1])
+    assert np.array_equal(Matrices[1], [[1, 0, 0], [0, 1, 0]])
+    assert factors[1] == [1.0, 1.0]
+    # the other sample is rotated as if it was alone
+    _, single_image, single_angles, _, _ = rotate_map(mask[:1], image[:1], torch.device("cpu"))
+    assert angles[0] == single_angles[0]
+    assert torch.allclose(rotate_image[:1], single_image, atol=1e-5)
@@ -0,0 +1,34 @@
+from ..utils.manifest import GenerationManifest, file_digest
+
+
+def test_manifest_resumes_finished_pages(tmp_path):
+    page = tmp_path / "page.png"
+    page.write_bytes(b"page")
+    digest = file_digest(page)
+    manifest_file = tmp_path / "out" / "manifest.jsonl"
+    manifest = GenerationManifest(manifest_file, settings={'model': 'a'})
+    manifest.record("page", digest, ["page.xml"])
+    # a run dying while writing a line
+    manifest._file.write('{"id": "other", "ha')
+    manifest._file.flush()
+
+    manifest = GenerationManifest(manifest_file, settings={'model': 'a'})
+    assert manifest.is_done("page", digest)
+    assert manifest.outputs("page") == ["page.xml"]
+    assert not manifest.is_done("other", digest)
+    page.write_bytes(b"modified page")
+    assert not manifest.is_done("page", file_digest(page))
+    manifest.record("other", digest)
+    manifest.close()
+
+    with GenerationManifest(manifest_file, settings={'model': 'a'}) as manifest:
+        assert manifest.is_done("other", digest)
+
+
+def test_manifest_with_other_settings_starts_over(tmp_path):
+    manifest_file = tmp_path / "manifest.jsonl"
+    with GenerationManifest(manifest_file, settings={'model': 'a'}) as manifest:
+        manifest.record("page", "hash")
+    with GenerationManifest(manifest_file, settings={'model': 'b'}) as manifest:
+        assert not manifest.is_done("page", "hash")
+        assert manifest.outputs("page") == []
@@ -0,0 +1,106 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ..datasets.mask_cache import build_mask_cache, is_deterministic
+from ..ssd.data_preprocessing import TestTransform, TrainAugmentation
+from ..ssd.imJnet_ssd import SSD
+from ..utils.misc import freeze_net_layers
+
+
+class _FakeMaskNet(nn.Module):
+    def __init__(self):
+        super(_FakeMaskNet, self).__init__()
+        self.conv = nn.Conv2d(3, 1, 3, padding=1)
+
+    def forward(self, x):
+        return self.conv(x), x
+
+
+class _FakeDataset:
+    transform = None
+
+    def __init__(self, size):
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.rand(size, 3, 16, 16, generator=generator)
+
+    def __getitem__(self, index):
+        return self.images[index], np.zeros((1, 4), dtype=np.float32), np.ones(1, dtype=np.int64), \
+            torch.zeros(16, 16)
+
+    def __len__(self):
+        return len(self.images)
+
+
+def test_is_deterministic():
+    assert is_deterministic(TestTransform(32))
+    assert not is_deterministic(TrainAugmentation(32))
+
+
+def test_build_mask_cache(tmp_path):
+    mask_net = _FakeMaskNet()
+    dataset = _FakeDataset(5)
+    cache_file = tmp_path / "val.npy"
+    cached = build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    assert len(cached) == 5
+    for i in range(5):
+        image, _, _, _, mask_logits = cached[i]
+        with torch.no_grad():
+            expected, _ = mask_net(image.unsqueeze(0))
+        assert torch.allclose(mask_logits, expected[0], atol=1e-6)
+
+    # the cache is reused until the mask_net weights change
+    modified = cache_file.stat().st_mtime_ns
+    build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    assert cache_file.stat().st_mtime_ns == modified
+    with torch.no_grad():
+        mask_net.conv.bias.add_(1.0)
+    image, _, _, _, mask_logits = build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)[0]
+    with torch.no_grad():
+        expected, _ = mask_net(image.unsqueeze(0))
+    assert torch.allclose(mask_logits, expected[0], atol=1e-6)
+
+
+def test_build_mask_cache_dataset_changes(tmp_path):
+    mask_net = _FakeMaskNet()
+    dataset = _FakeDataset(5)
+    cache_file = tmp_path / "val.npy"
+    build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    modified = cache_file.stat().st_mtime_ns
+
+    # other images of the same count
+    dataset.ids = [f"page-{i}" for i in range(5)]
+    build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    assert cache_file.stat().st_mtime_ns != modified
+    modified = cache_file.stat().st_mtime_ns
+
+    # another image size
+    dataset.transform = TestTransform(32)
+    build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    assert cache_file.stat().st_mtime_ns != modified
+    modified = cache_file.stat().st_mtime_ns
+    dataset.transform = TestTransform(64)
+    build_mask_cache(mask_net, dataset, cache_file, batch_size=2, num_workers=0)
+    assert cache_file.stat().st_mtime_ns != modified
+    assert not list(tmp_path.glob("*.tmp.npy"))
+
+
+def test_mask_net_eval():
+    mask_net = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))
+    net = SSD(2, mask_net, nn.ModuleList(), [], nn.ModuleList(), nn.ModuleList(), nn.ModuleList(),
+              device=torch.device("cpu"))
+    # a frozen mask_net still trains its BatchNorm statistics by default
+    freeze_net_layers(net.mask_net)
+    net.train(True)
+    assert mask_net[1].training
+
+    net.set_mask_net_eval()
+    net.train(True)
+    assert net.training and not mask_net[1].training
+    x = torch.rand(2, 3, 8, 8)
+    with torch.no_grad():
+        expected = mask_net(x)
+        net.train(True)
+        assert torch.equal(mask_net(x), expected)
+    net.set_mask_net_eval(False)
+    assert mask_net[1].training
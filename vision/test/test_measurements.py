@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from ..utils import measurements
+
+
+def test_iou_matrix():
+    boxes0 = np.array([[0, 0, 10, 10], [5, 5, 15, 15]], dtype=np.float64)
+    boxes1 = np.array([[0, 0, 10, 10], [20, 20, 30, 30]], dtype=np.float64)
+    ious = measurements.iou_matrix(boxes0, boxes1)
+    assert ious.shape == (2, 2)
+    np.testing.assert_allclose(ious, [[1, 0], [25 / 175, 0]], atol=1e-4)
+
+
+def test_match_detections_pascal_rules():
+    gt_image_ids = np.array([0, 0, 1])
+    gt_boxes = np.array([[0, 0, 10, 10], [20, 20, 30, 30], [0, 0, 10, 10]], dtype=np.float64)
+    gt_difficult = np.array([0, 1, 0])
+    image_ids = np.array([0, 0, 0, 1, 2])
+    scores = np.array([0.6, 0.9, 0.8, 0.7, 0.5])
+    boxes = np.array([
+        [0, 0, 10, 10],    # duplicate of the best match
+        [0, 0, 10, 11],    # best match of the first box
+        [20, 20, 30, 30],  # difficult, ignored
+        [50, 50, 60, 60],  # no overlap
+        [0, 0, 10, 10],    # image without ground truth
+    ], dtype=np.float64)
+    true_positive, false_positive = measurements.match_detections(
+        image_ids, scores, boxes, gt_image_ids, gt_boxes, gt_difficult, iou_threshold=0.5)
+    # sorted by score: 0.9, 0.8, 0.7, 0.6, 0.5
+    np.testing.assert_array_equal(true_positive, [1, 0, 0, 0, 0])
+    np.testing.assert_array_equal(false_positive, [0, 0, 1, 1, 1])
+
+
+def test_average_precision_perfect_detections():
+    true_positive = np.array([1., 1.])
+    false_positive = np.array([0., 0.])
+    assert measurements.average_precision(true_positive, false_positive, 2, use_2007_metric=True) == pytest.approx(1.0)
+    assert measurements.average_precision(true_positive, false_positive, 2, use_2007_metric=False) == pytest.approx(1.0)
+    assert measurements.average_precision(true_positive, false_positive, 4, use_2007_metric=False) == pytest.approx(0.5)
@@ -0,0 +1,21 @@
+import torch
+
+from ..utils.misc import RunningSums
+
+
+def test_running_sums_means():
+    running = RunningSums()
+    running.add(loss=torch.tensor(1.0), positives=torch.tensor(3))
+    running.add(loss=torch.tensor(3.0), positives=torch.tensor(5))
+    assert running.totals() == {'loss': 4.0, 'positives': 8.0}
+    assert running.means() == {'loss': 2.0, 'positives': 4.0}
+
+
+def test_running_sums_detach_and_reset():
+    weight = torch.tensor(2.0, requires_grad=True)
+    running = RunningSums()
+    running.add(loss=weight * 3)
+    assert not running.sums['loss'].requires_grad
+    running.reset()
+    assert running.totals() == {}
+    assert running.means() == {}
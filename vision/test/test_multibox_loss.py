@@ -0,0 +1,43 @@
+import torch
+import torch.nn.functional as F
+
+from ..nn.multibox_loss import MultiboxLoss
+from ..utils import box_utils
+
+
+def _reference_loss(confidence, predicted_locations, masks, labels, gt_locations, gt_masks, neg_pos_ratio):
+    num_classes = confidence.size(2)
+    with torch.no_grad():
+        loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
+        mask = box_utils.hard_negative_mining(loss, labels, neg_pos_ratio)
+    classification_loss = F.cross_entropy(confidence[mask, :].reshape(-1, num_classes), labels[mask],
+                                          reduction='sum')
+    pos_mask = labels > 0
+    predicted_locations = predicted_locations[pos_mask, :].reshape(-1, 4)
+    gt_locations = gt_locations[pos_mask, :].reshape(-1, 4)
+    smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='sum')
+    mse_loss = F.mse_loss(torch.squeeze(masks), torch.squeeze(gt_masks))
+    num_pos = gt_locations.size(0)
+    return smooth_l1_loss / num_pos, classification_loss / num_pos, mse_loss
+
+
+def test_multibox_loss_matches_reference():
+    generator = torch.Generator().manual_seed(0)
+    priors = torch.rand(500, 4, generator=generator)
+    criterion = MultiboxLoss(priors, iou_threshold=0.5, neg_pos_ratio=3,
+                             center_variance=0.1, size_variance=0.2, device=torch.device("cpu"))
+    confidence = torch.randn(2, 500, 3, generator=generator, requires_grad=True)
+    predicted_locations = torch.randn(2, 500, 4, generator=generator, requires_grad=True)
+    masks = torch.rand(2, 1, 16, 16, generator=generator)
+    labels = torch.randint(0, 3, (2, 500), generator=generator) * (torch.rand(2, 500, generator=generator) < 0.1)
+    gt_locations = torch.randn(2, 500, 4, generator=generator)
+    gt_masks = torch.rand(2, 16, 16, generator=generator)
+
+    losses = criterion(confidence, predicted_locations, masks, labels, gt_locations, gt_masks)
+    grads = torch.autograd.grad(sum(losses), [confidence, predicted_locations])
+    expected = _reference_loss(confidence, predicted_locations, masks, labels, gt_locations, gt_masks, 3)
+    expected_grads = torch.autograd.grad(sum(expected), [confidence, predicted_locations])
+    for loss, expected_loss in zip(losses, expected):
+        assert torch.allclose(loss, expected_loss, atol=1e-5)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
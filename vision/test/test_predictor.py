@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+from torch import nn
+
+from ..ssd.predictor import Predictor
+
+
+class _FakeDeskewSSD(nn.Module):
+    """Mimics the outputs of the imJnet SSD in test mode, each sample depending only on its own image."""
+
+    def __init__(self, num_priors=64, num_classes=3):
+        super(_FakeDeskewSSD, self).__init__()
+        centers = torch.rand(num_priors, 2) * 0.8 + 0.1
+        sizes = torch.rand(num_priors, 2) * 0.2 + 0.05
+        self.register_buffer("boxes", torch.cat([centers - sizes / 2, centers + sizes / 2], 1))
+        self.register_buffer("logits", torch.randn(num_priors, num_classes) * 3)
+
+    def forward(self, x):
+        batch_size = x.size(0)
+        means = x.mean(dim=3).mean(dim=2).mean(dim=1).view(-1, 1, 1)
+        scores = torch.softmax(self.logits.unsqueeze(0) * (1 + means), dim=2)
+        boxes = self.boxes.unsqueeze(0) + means * 0.01
+        angles = [0.0] * batch_size
+        Matrices = [np.eye(2, 3)] * batch_size
+        factors = [[1.0, 1.0]] * batch_size
+        return scores, boxes, x[:, :1], angles, Matrices, factors
+
+
+def test_predict_batch_matches_predict():
+    torch.manual_seed(0)
+    predictor = Predictor(_FakeDeskewSSD(), 64, std=255.0, device=torch.device("cpu"))
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 255, (h, w, 3)).astype(np.uint8) for h, w in [(80, 60), (64, 64), (100, 40)]]
+    masks = [np.zeros(image.shape[:2], dtype=np.uint8) for image in images]
+
+    batched = predictor.predict_batch(images, masks)
+    assert len(batched) == len(images)
+    for image, mask, result in zip(images, masks, batched):
+        single = predictor.predict(image, mask)
+        assert len(single) == len(result)
+        for expected, actual in zip(single[:3], result[:3]):
+            assert expected.size() == actual.size()
+            assert torch.allclose(expected.float(), actual.float())
+
+
+def test_tile_starts_cover_the_page():
+    from ..ssd.predictor import _tile_starts
+    assert _tile_starts(50, 64, 16) == [0]
+    starts = _tile_starts(200, 64, 16)
+    assert starts[0] == 0 and starts[-1] == 200 - 64
+    assert all(b - a <= 64 - 16 for a, b in zip(starts, starts[1:]))
+
+
+def test_predict_tiled_single_tile_matches_predict():
+    torch.manual_seed(0)
+    predictor = Predictor(_FakeDeskewSSD(), 64, std=255.0, device=torch.device("cpu"))
+    image = np.random.RandomState(1).randint(0, 255, (64, 64, 3)).astype(np.uint8)
+    mask = np.zeros((64, 64), dtype=np.uint8)
+    expected = predictor.predict(image, mask)
+    boxes, labels, probs = predictor.predict_tiled(image, mask)
+    # the tiled boxes are clipped to the page
+    assert torch.allclose(boxes, expected[0].clamp(0, 64))
+    assert torch.equal(labels, expected[1])
+    assert torch.allclose(probs, expected[2])
+
+
+def test_predict_tiled_boxes_stay_in_the_page():
+    torch.manual_seed(0)
+    predictor = Predictor(_FakeDeskewSSD(), 64, std=255.0, device=torch.device("cpu"))
+    image = np.random.RandomState(2).randint(0, 255, (150, 230, 3)).astype(np.uint8)
+    boxes, labels, probs = predictor.predict_tiled(image, overlap=16, batch_size=3)
+    assert boxes.size(0) == labels.size(0) == probs.size(0) > 0
+    assert (boxes[:, :2] >= 0).all() and (boxes[:, 2] <= 230).all() and (boxes[:, 3] <= 150).all()
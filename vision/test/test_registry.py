@@ -0,0 +1,21 @@
+import pytest
+
+from ..ssd import registry
+from ..ssd.config import mobilenetv1_ssd_config, squeezenet_ssd_config
+
+
+def test_registry_configs():
+    assert registry.get_config('sq-ssd-lite') is squeezenet_ssd_config
+    assert registry.get_config('jnet-ssd-lite') is mobilenetv1_ssd_config
+
+
+def test_registry_drops_options_a_net_does_not_take():
+    net = registry.create_net('mb1-ssd-lite', 3, is_test=True, width_mult=0.5)
+    assert net.num_classes == 3 and net.is_test
+    predictor = registry.create_predictor('mb1-ssd-lite', net, candidate_size=10)
+    assert predictor.candidate_size == 10
+
+
+def test_registry_unknown_net():
+    with pytest.raises(ValueError):
+        registry.create_net('no-such-net', 2)
@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+from JNetV3.utils.metrics import confusion_counts, metrics_pred, pr_curve
+
+
+def _reference_counts(pred, mask, threshold):
+    predicted = pred > threshold
+    possible = mask > 0.5
+    true_positive = np.logical_and(predicted, possible).sum()
+    return (true_positive, predicted.sum() - true_positive, possible.sum() - true_positive,
+            np.logical_or(predicted, possible).sum())
+
+
+def test_confusion_counts_multiple_thresholds():
+    torch.manual_seed(0)
+    pred_b = torch.rand(3, 16, 20)
+    masks = (torch.rand(3, 16, 20) > 0.6).float()
+    thresholds = [0.7, 0.1, 0.5, 0.9]
+    counts = confusion_counts(pred_b, masks, thresholds)
+    for values in counts:
+        assert values.shape == (len(thresholds), 3)
+    for t, threshold in enumerate(thresholds):
+        for i in range(3):
+            expected = _reference_counts(pred_b[i].numpy(), masks[i].numpy(), threshold)
+            assert tuple(int(values[t, i]) for values in counts) == tuple(int(value) for value in expected)
+
+
+def test_metrics_pred_matches_single_threshold():
+    torch.manual_seed(1)
+    pred_b = torch.rand(2, 8, 8)
+    masks = (torch.rand(2, 8, 8) > 0.5).float()
+    true_positives, predicted_positives, possible_positives, union_areas = metrics_pred(
+        pred_b.numpy(), None, masks.numpy())
+    for i in range(2):
+        tp, fp, fn, union = _reference_counts(pred_b[i].numpy(), masks[i].numpy(), 0.5)
+        assert (true_positives[i], predicted_positives[i], possible_positives[i], union_areas[i]) == \
+               (tp, tp + fp, tp + fn, union)
+
+
+def test_pr_curve_is_monotonic_in_recall():
+    torch.manual_seed(2)
+    pred_b = torch.rand(2, 32, 32)
+    masks = (pred_b + 0.3 * torch.rand(2, 32, 32) > 0.7).float()
+    thresholds = torch.linspace(0.05, 0.95, 10)
+    true_positives, false_positives, false_negatives, _ = confusion_counts(pred_b, masks, thresholds)
+    precisions, recalls = pr_curve(true_positives.sum(1), false_positives.sum(1), false_negatives.sum(1))
+    assert torch.all(recalls[1:] <= recalls[:-1])
+    assert precisions[-1] > precisions[0]
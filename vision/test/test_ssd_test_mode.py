@@ -0,0 +1,56 @@
+import torch
+
+from ..ssd.config import mobilenetv1_ssd_config as config
+from ..ssd.imJnet_ssd_lite import create_imJnet_ssd_lite
+from ..ssd.mobilenetv1_ssd_lite import create_mobilenetv1_ssd_lite
+from ..utils.misc import autocast
+
+
+def _test_mode_net(create_net):
+    net = create_net(3, is_test=True)
+    net.init()
+    net.eval()
+    return net.to(net.device)
+
+
+def _check_pruning(net, x):
+    with torch.no_grad():
+        confidences, boxes = net.forward(x)[:2]
+        net.set_test_pruning(top_k=100)
+        pruned_confidences, pruned_boxes = net.forward(x)[:2]
+        net.set_test_pruning(score_threshold=0.4)
+        filtered_confidences, filtered_boxes = net.forward(x)[:2]
+        net.set_test_pruning()
+    assert pruned_confidences.size() == torch.Size([x.size(0), 100, 3])
+    assert pruned_boxes.size() == torch.Size([x.size(0), 100, 4])
+    _, indexes = confidences[:, :, 1:].max(dim=2)[0].topk(100, dim=1)
+    for i in range(x.size(0)):
+        assert torch.allclose(pruned_confidences[i], confidences[i][indexes[i]])
+        assert torch.allclose(pruned_boxes[i], boxes[i][indexes[i]], atol=1e-6)
+
+    # the score threshold applies without top_k too, every prior is kept in its place
+    assert filtered_confidences.size() == confidences.size()
+    assert torch.allclose(filtered_boxes, boxes, atol=1e-6)
+    kept = confidences[:, :, 1:].max(dim=2)[0] > 0.4
+    assert torch.allclose(filtered_confidences[kept], confidences[kept])
+    assert (filtered_confidences[~kept] == 0).all()
+
+
+def test_ssd_test_mode_pruning():
+    net = _test_mode_net(create_mobilenetv1_ssd_lite)
+    _check_pruning(net, torch.randn(2, 3, config.image_size, config.image_size).to(net.device))
+
+
+def test_imjnet_ssd_test_mode_pruning():
+    net = _test_mode_net(create_imJnet_ssd_lite)
+    _check_pruning(net, torch.rand(1, 3, config.image_size, config.image_size).to(net.device))
+
+
+def test_ssd_test_mode_decodes_in_float32_under_autocast():
+    net = _test_mode_net(create_mobilenetv1_ssd_lite)
+    x = torch.randn(1, 3, config.image_size, config.image_size).to(net.device)
+    with torch.no_grad(), autocast(net.device):
+        confidences, boxes = net.forward(x)
+    assert confidences.dtype == torch.float32
+    assert boxes.dtype == torch.float32
+    assert torch.allclose(confidences.sum(2), torch.ones(1, confidences.size(1), device=net.device))
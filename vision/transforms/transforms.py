@@ -364,9 +364,11 @@ class Expand(object):
         return image, boxes, labels, mask
 
 class CvtRatio(object):
+    h_ratio = 2
+
     def __call__(self, image, boxes=None, labels=None, mask = None):
         h, w = image.shape[:2]
-        h_ratio = 2
+        h_ratio = self.h_ratio
         image = cv2.resize(image,(w, h * h_ratio))
         mask = cv2.resize(mask, (w, h * h_ratio))
         max_edge = max(image.shape[0], image.shape[1])
@@ -1,6 +1,5 @@
 import collections
 import torch
-import itertools
 from typing import List
 import math
 
@@ -29,63 +28,48 @@ def generate_ssd_priors(specs: List[SSDSpec], image_size, clamp=True) -> torch.T
         priors (num_priors, 4): The prior boxes represented as [[center_x, center_y, w, h]]. All the values
             are relative to the image size.
     """
-    priors = []
-    for spec in specs:
-        scale = image_size / spec.shrinkage
-        for j, i in itertools.product(range(spec.feature_map_size), repeat=2):
-            x_center = (i + 0.5) / scale
-            y_center = (j + 0.5) / scale
-
-            # small sized square box
-            size = spec.box_sizes.min
-            h = w = size / image_size
-            priors.append([
-                x_center,
-                y_center,
-                w,
-                h
-            ])
-
-            # big sized square box
-            size = math.sqrt(spec.box_sizes.max * spec.box_sizes.min)
-            h = w = size / image_size
-            priors.append([
-                x_center,
-                y_center,
-                w,
-                h
-            ])
-
-            # change h/w ratio of the small sized box
-            size = spec.box_sizes.min
-            h = w = size / image_size
-            for ratio in spec.aspect_ratios:
-                # ratio_a = ratio
-                # priors.append([
-                #     x_center,
-                #     y_center,
-                #     w * ratio_a,
-                #     h / ratio_a
-                # ])
-                ratio = math.sqrt(ratio)
-                priors.append([
-                    x_center,
-                    y_center,
-                    w * ratio,
-                    h / ratio
-                ])
-                # ratio = math.sqrt(ratio)
-                # priors.append([
-                #     x_center,
-                #     y_center,
-                #     w * ratio,
-                #     h / ratio
-                # ])
-
-    priors = torch.tensor(priors)
-    if clamp:
-        torch.clamp(priors, 0.0, 1.0, out=priors)
-    return priors
+    key = (_specs_key(specs), image_size, clamp)
+    if key not in _priors_cache:
+        levels = []
+        for spec in specs:
+            scale = image_size / spec.shrinkage
+            # computed in float64 like the python floats they replace, so the float32 priors are unchanged
+            centers = (torch.arange(spec.feature_map_size, dtype=torch.float64) + 0.5) / scale
+            y_center, x_center = torch.meshgrid(centers, centers, indexing='ij')
+            shapes = torch.tensor(_prior_shapes(spec, image_size), dtype=torch.float64)
+            size, num_shapes = spec.feature_map_size, shapes.size(0)
+            centers = torch.stack([x_center, y_center], -1).unsqueeze(2).expand(size, size, num_shapes, 2)
+            levels.append(torch.cat([centers, shapes.expand(size, size, num_shapes, 2)], -1).reshape(-1, 4))
+        priors = torch.cat(levels).float()
+        if clamp:
+            torch.clamp(priors, 0.0, 1.0, out=priors)
+        _priors_cache[key] = priors
+    return _priors_cache[key].clone()
+
+
+# generated priors by specs, image size and clamp, shared by the configs and the datasets of a process
+_priors_cache = {}
+
+
+def _specs_key(specs):
+    return tuple((spec.feature_map_size, spec.shrinkage, tuple(spec.box_sizes), tuple(spec.aspect_ratios))
+                 for spec in specs)
+
+
+def _prior_shapes(spec: SSDSpec, image_size):
+    """The (w, h) of the priors of every location of spec, in their order."""
+    # small sized square box
+    size = spec.box_sizes.min
+    w = size / image_size
+    shapes = [(w, w)]
+    # big sized square box
+    big = math.sqrt(spec.box_sizes.max * spec.box_sizes.min) / image_size
+    shapes.append((big, big))
+    # change h/w ratio of the small sized box
+    for ratio in spec.aspect_ratios:
+        ratio = math.sqrt(ratio)
+        shapes.append((w * ratio, w / ratio))
+    return shapes
 
 
 def convert_locations_to_boxes(locations, priors, center_variance,
@@ -114,6 +98,31 @@ def convert_locations_to_boxes(locations, priors, center_variance,
     ], dim=locations.dim() - 1)
 
 
+def select_top_priors(confidences, locations, priors, top_k, score_threshold=0.0):
+    """Keep, for every image, the top_k priors with the best foreground score.
+
+    It lets the test mode decode only the priors that can survive the score filter of the predictor.
+    Args:
+        confidences (batch_size, num_priors, num_classes): class probabilities, class 0 being the background.
+        locations (batch_size, num_priors, 4): the regression output of SSD.
+        priors (num_priors, 4): center form prior boxes.
+        top_k: the number of priors to keep per image, all of them are kept in their order if k <= 0.
+        score_threshold: kept priors whose best foreground score is not above it get all-zero probabilities,
+            so that the outputs keep a fixed shape.
+    Returns:
+        confidences (batch_size, top_k, num_classes), locations (batch_size, top_k, 4) and
+            priors (batch_size, top_k, 4) of the kept priors, or the priors unchanged if top_k <= 0.
+    """
+    best_scores, _ = confidences[:, :, 1:].max(dim=2)
+    if top_k > 0:
+        best_scores, indexes = best_scores.topk(min(top_k, confidences.size(1)), dim=1)
+        confidences = confidences.gather(1, indexes.unsqueeze(2).expand(-1, -1, confidences.size(2)))
+        locations = locations.gather(1, indexes.unsqueeze(2).expand(-1, -1, locations.size(2)))
+        priors = priors[indexes]
+    confidences = confidences * (best_scores > score_threshold).unsqueeze(2).to(confidences.dtype)
+    return confidences, locations, priors
+
+
 def convert_boxes_to_locations(center_form_boxes, center_form_priors, center_variance, size_variance):
     # priors can have one dimension less
     if center_form_priors.dim() + 1 == center_form_boxes.dim():
@@ -187,6 +196,181 @@ def assign_priors(gt_boxes, gt_labels, corner_form_priors,
     return boxes, labels
 
 
+def _last_target_per_prior(prior_index, target_index, num_targets):
+    """Resolve the priors that are the best prior of several targets like assign_priors: the last target wins.
+
+    Returns:
+        the distinct prior indexes and the target index kept for each of them.
+    """
+    order = torch.argsort(prior_index * num_targets + target_index)
+    prior_index = prior_index[order]
+    target_index = target_index[order]
+    last = torch.ones_like(prior_index, dtype=torch.bool)
+    last[:-1] = prior_index[1:] != prior_index[:-1]
+    return prior_index[last], target_index[last]
+
+
+def batched_assign_priors(gt_boxes, gt_labels, corner_form_priors, iou_threshold):
+    """Assign ground truth boxes and targets to priors for a whole batch at once.
+
+    Same assignment as assign_priors applied to every image, including which target wins a prior that
+     is the best prior of several targets.
+
+    Args:
+        gt_boxes (batch_size, num_targets, 4): ground truth boxes, padded to the largest image.
+        gt_labels (batch_size, num_targets): labels of targets, negative for the padding.
+        priors (num_priors, 4): corner form priors
+    Returns:
+        boxes (batch_size, num_priors, 4): real values for priors.
+        labels (batch_size, num_priros): labels for priors, 0 for every prior of an image without target.
+    """
+    batch_size, num_targets = gt_labels.size()
+    num_priors = corner_form_priors.size(0)
+    if num_targets == 0:
+        return (gt_boxes.new_zeros(batch_size, num_priors, 4),
+                gt_labels.new_zeros(batch_size, num_priors))
+    valid = gt_labels >= 0
+    # size: batch_size x num_priors x num_targets
+    ious = iou_of(gt_boxes.unsqueeze(1), corner_form_priors.unsqueeze(0).unsqueeze(2))
+    ious = ious.masked_fill(~valid.unsqueeze(1), -1)
+    # size: batch_size x num_priors
+    best_target_per_prior, best_target_per_prior_index = ious.max(2)
+    # size: batch_size x num_targets
+    best_prior_per_target, best_prior_per_target_index = ious.max(1)
+
+    image_index, target_index = valid.nonzero(as_tuple=True)
+    flat_prior_index, target_index = _last_target_per_prior(
+        image_index * num_priors + best_prior_per_target_index[image_index, target_index], target_index, num_targets)
+    best_target_per_prior_index = best_target_per_prior_index.view(-1)
+    best_target_per_prior_index[flat_prior_index] = target_index
+    best_target_per_prior_index = best_target_per_prior_index.view(batch_size, num_priors)
+    # 2.0 is used to make sure every target has a prior assigned
+    best_target_per_prior = best_target_per_prior.view(-1).index_fill(0, flat_prior_index, 2)
+    best_target_per_prior = best_target_per_prior.view(batch_size, num_priors)
+    # size: batch_size x num_priors
+    labels = torch.gather(gt_labels, 1, best_target_per_prior_index)
+    labels[best_target_per_prior < iou_threshold] = 0  # the backgournd id
+    boxes = torch.gather(gt_boxes, 1, best_target_per_prior_index.unsqueeze(2).expand(-1, -1, 4))
+    return boxes, labels
+
+
+def prior_levels(specs: List[SSDSpec], image_size):
+    """Layout of the priors generated by generate_ssd_priors(specs, image_size).
+
+    Returns:
+        for every spec, the index of its first prior, its feature map size and its number of priors per
+         location.
+    """
+    levels = []
+    start = 0
+    for spec in specs:
+        num_shapes = len(_prior_shapes(spec, image_size))
+        levels.append((start, spec.feature_map_size, num_shapes))
+        num_priors = spec.feature_map_size ** 2 * num_shapes
+        start += num_priors
+    return levels
+
+
+def _first_per_group(groups, ious):
+    """Index of the best IoU of every group, the earliest one on ties, groups being sorted by element order."""
+    order = torch.sort(ious, descending=True, stable=True)[1]
+    order = order[torch.sort(groups[order], stable=True)[1]]
+    sorted_groups = groups[order]
+    first = torch.ones_like(sorted_groups, dtype=torch.bool)
+    first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    return order[first]
+
+
+def sparse_assign_priors(gt_boxes, gt_labels, center_form_priors, levels, iou_threshold, max_pairs=1 << 22):
+    """Same assignment as assign_priors without building the num_priors x num_targets IoU matrix.
+
+    The priors of every feature map level sit on a regular grid, so a target can only overlap the priors
+     centered in the cells around it. IoUs are computed for those pairs only, max_pairs at most at a time.
+     The priors and targets that overlap nothing get index 0, as argmax on a row of zeros does.
+
+    Args:
+        gt_boxes (num_targets, 4): ground truth boxes.
+        gt_labels (num_targets): labels of targets.
+        center_form_priors (num_priors, 4): center form priors.
+        levels: the layout of the priors, as returned by prior_levels.
+    Returns:
+        boxes (num_priors, 4): real values for priors.
+        labels (num_priros): labels for priors.
+    """
+    num_priors = center_form_priors.size(0)
+    num_targets = gt_boxes.size(0)
+    if num_targets == 0:
+        return gt_boxes.new_zeros(num_priors, 4), gt_labels.new_zeros(num_priors)
+    corner_form_priors = center_form_to_corner_form(center_form_priors)
+    # size: num_targets x num_levels, the grid cells whose priors may overlap each target
+    cells = []
+    for start, feature_map_size, num_boxes in levels:
+        grid = center_form_priors[start: start + feature_map_size ** 2 * num_boxes].view(
+            feature_map_size, feature_map_size, num_boxes, 4)
+        half_width = grid[..., 2].max() / 2 + 1e-6
+        half_height = grid[..., 3].max() / 2 + 1e-6
+        x_centers = grid[0, :, 0, 0].contiguous()
+        y_centers = grid[:, 0, 0, 1].contiguous()
+        col_start = torch.searchsorted(x_centers, (gt_boxes[:, 0] - half_width).contiguous())
+        col_end = torch.searchsorted(x_centers, (gt_boxes[:, 2] + half_width).contiguous(), right=True)
+        row_start = torch.searchsorted(y_centers, (gt_boxes[:, 1] - half_height).contiguous())
+        row_end = torch.searchsorted(y_centers, (gt_boxes[:, 3] + half_height).contiguous(), right=True)
+        cells.append(torch.stack([
+            torch.full_like(col_start, start), torch.full_like(col_start, feature_map_size),
+            torch.full_like(col_start, num_boxes), row_start, col_start,
+            (row_end - row_start).clamp(min=0), (col_end - col_start).clamp(min=0)], 1))
+    cells = torch.stack(cells, 1)
+    counts = cells[..., 5] * cells[..., 6] * cells[..., 2]
+
+    # size: num_priors
+    best_target_per_prior = gt_boxes.new_zeros(num_priors)
+    best_target_per_prior_index = torch.zeros(num_priors, dtype=torch.long, device=gt_boxes.device)
+    # size: num_targets
+    best_prior_per_target_index = torch.zeros(num_targets, dtype=torch.long, device=gt_boxes.device)
+    target_pairs = torch.cumsum(counts.sum(1), 0)
+    chunk_start = 0
+    while chunk_start < num_targets:
+        # the targets whose pairs fit in max_pairs, one target at least
+        done = int(target_pairs[chunk_start - 1]) if chunk_start > 0 else 0
+        chunk_end = int(torch.searchsorted(target_pairs, torch.tensor([done + max_pairs],
+                                                                      device=target_pairs.device), right=True))
+        chunk_end = max(chunk_end, chunk_start + 1)
+        chunk_cells = cells[chunk_start:chunk_end].reshape(-1, 7)
+        chunk_counts = counts[chunk_start:chunk_end].reshape(-1)
+        # the pairs are ordered by target, then by prior index
+        entry = torch.repeat_interleave(torch.arange(chunk_counts.size(0), device=gt_boxes.device), chunk_counts)
+        position = torch.arange(entry.size(0), device=gt_boxes.device) - (torch.cumsum(chunk_counts, 0) -
+                                                                         chunk_counts)[entry]
+        start, feature_map_size, num_boxes, row, col, _, num_cols = chunk_cells[entry].unbind(1)
+        box_index = position % num_boxes
+        position = position // num_boxes
+        prior_index = start + ((row + position // num_cols) * feature_map_size + col + position % num_cols) * \
+            num_boxes + box_index
+        target_index = chunk_start + entry // len(levels)
+        ious = iou_of(gt_boxes[target_index], corner_form_priors[prior_index])
+
+        best = _first_per_group(prior_index, ious)
+        better = ious[best] > best_target_per_prior[prior_index[best]]
+        best = best[better]
+        best_target_per_prior[prior_index[best]] = ious[best]
+        best_target_per_prior_index[prior_index[best]] = target_index[best]
+        best = _first_per_group(target_index, ious)
+        best = best[ious[best] > 0]
+        best_prior_per_target_index[target_index[best]] = prior_index[best]
+        chunk_start = chunk_end
+
+    prior_index, target_index = _last_target_per_prior(
+        best_prior_per_target_index, torch.arange(num_targets, device=gt_boxes.device), num_targets)
+    best_target_per_prior_index[prior_index] = target_index
+    # 2.0 is used to make sure every target has a prior assigned
+    best_target_per_prior.index_fill_(0, best_prior_per_target_index, 2)
+    # size: num_priors
+    labels = gt_labels[best_target_per_prior_index]
+    labels[best_target_per_prior < iou_threshold] = 0  # the backgournd id
+    boxes = gt_boxes[best_target_per_prior_index]
+    return boxes, labels
+
+
 def hard_negative_mining(loss, labels, neg_pos_ratio):
     """
     It used to suppress the presence of a large number of negative prediction.
@@ -206,9 +390,13 @@ def hard_negative_mining(loss, labels, neg_pos_ratio):
     num_neg = num_pos * neg_pos_ratio
 
     loss[pos_mask] = -math.inf
-    _, indexes = loss.sort(dim=1, descending=True)
-    _, orders = indexes.sort(dim=1)
-    neg_mask = orders < num_neg
+    # only the num_neg largest losses of every row matter, select them instead of sorting the whole row
+    k = min(int(num_neg.max()), loss.size(1))
+    if k == 0:
+        return pos_mask
+    _, indexes = loss.topk(k, dim=1)
+    ranks = torch.arange(k, device=loss.device).unsqueeze(0)
+    neg_mask = torch.zeros_like(pos_mask).scatter_(1, indexes, ranks < num_neg)
     return pos_mask | neg_mask
 
 
@@ -257,17 +445,173 @@ def hard_nms(box_scores, iou_threshold, top_k=-1, candidate_size=200):
     return box_scores[picked, :]
 
 
+def _group_ranks(sorted_groups):
+    """Position of every element inside its run of equal values.
+
+    Args:
+        sorted_groups (N): group ids where equal ids are contiguous.
+    Returns:
+        ranks (N): 0 for the first element of each group, 1 for the second one and so on.
+    """
+    _, counts = torch.unique_consecutive(sorted_groups, return_counts=True)
+    starts = torch.cumsum(counts, 0) - counts
+    positions = torch.arange(sorted_groups.size(0), device=sorted_groups.device)
+    return positions - torch.repeat_interleave(starts, counts)
+
+
+def _greedy_keep(ious, iou_threshold):
+    """Greedy suppression driven by a precomputed IoU matrix.
+
+    Box i is dropped when a kept box j < i overlaps it by more than iou_threshold, which is exactly what
+    hard_nms does when the boxes are sorted by descending score. Instead of visiting the boxes one by
+    one, the keep mask is refined with whole-matrix operations until it stops changing; every pass fixes
+    at least the next undecided box, so it converges to the greedy result.
+
+    Args:
+        ious (..., K, K): pairwise IoU of the boxes in processing order, for any leading batch of groups.
+        iou_threshold: intersection over union threshold.
+    Returns:
+        keep (..., K): boolean mask of the kept boxes.
+    """
+    positions = torch.arange(ious.size(-1), device=ious.device)
+    suppress = (ious > iou_threshold) & (positions.unsqueeze(1) < positions.unsqueeze(0))
+    keep = torch.ones(ious.shape[:-1], dtype=torch.bool, device=ious.device)
+    while True:
+        new_keep = ~(suppress & keep.unsqueeze(-1)).any(-2)
+        if torch.equal(new_keep, keep):
+            return keep
+        keep = new_keep
+
+
+def class_aware_hard_nms(boxes, scores, labels, iou_threshold, top_k=-1, candidate_size=200):
+    """Vectorized hard NMS over all the classes in one call.
+
+    It gives the same picks as running hard_nms once per label. The candidates of every label are laid
+    out in a row of a (num_labels, max_candidates) block, so only the IoU matrices of the boxes of a same
+    label are computed and the memory grows linearly with the number of labels.
+
+    Args:
+        boxes (N, 4): boxes in corner-form.
+        scores (N): probabilities.
+        labels (N): the group of every box, usually its class index.
+        iou_threshold: intersection over union threshold.
+        top_k: keep top_k results per label. If k <= 0, keep all the results.
+        candidate_size: only consider the candidates with the highest scores of every label.
+    Returns:
+        keep: indexes of the kept boxes, ordered by label and then by descending score.
+    """
+    if boxes.size(0) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    _, order = scores.sort(descending=True)
+    # order by label first, keeping the descending scores inside each label.
+    key = labels[order] * order.size(0) + torch.arange(order.size(0), device=order.device)
+    order = order[key.argsort()]
+    order = order[_group_ranks(labels[order]) < candidate_size]
+
+    ranks = _group_ranks(labels[order])
+    _, groups = torch.unique_consecutive(labels[order], return_inverse=True)
+    grouped_boxes = boxes.new_zeros((int(groups[-1]) + 1, int(ranks.max()) + 1, 4))
+    grouped_boxes[groups, ranks] = boxes[order]
+    # the padding boxes are empty, they overlap nothing and come after the candidates
+    ious = iou_of(grouped_boxes.unsqueeze(2), grouped_boxes.unsqueeze(1))
+    keep = order[_greedy_keep(ious, iou_threshold)[groups, ranks]]
+    if top_k > 0:
+        keep = keep[_group_ranks(labels[keep]) < top_k]
+    return keep
+
+
+def batched_class_aware_nms(boxes, scores, prob_threshold, iou_threshold, top_k=-1, candidate_size=200):
+    """Class-aware hard NMS of a whole batch of SSD outputs in one call.
+
+    Args:
+        boxes (batch_size, num_priors, 4): boxes in corner-form.
+        scores (batch_size, num_priors, num_classes): probabilities, class 0 being the background.
+        prob_threshold: only the scores above this value are considered.
+        iou_threshold, top_k, candidate_size: as in class_aware_hard_nms, applied per image and class.
+    Returns:
+        a list with, for every image, the kept box_probs (K, 5) and their labels (K), ordered by label
+         and then by descending score.
+    """
+    batch_size, _, num_classes = scores.size()
+    image_indexes, prior_indexes, class_indexes = (scores[:, :, 1:] > prob_threshold).nonzero().t()
+    class_indexes = class_indexes + 1
+    candidate_probs = scores[image_indexes, prior_indexes, class_indexes]
+    candidate_boxes = boxes[image_indexes, prior_indexes]
+    groups = image_indexes * num_classes + class_indexes
+    keep = class_aware_hard_nms(candidate_boxes, candidate_probs, groups, iou_threshold,
+                                top_k=top_k, candidate_size=candidate_size)
+
+    box_probs = torch.cat([candidate_boxes[keep], candidate_probs[keep].unsqueeze(1)], 1)
+    labels = class_indexes[keep]
+    counts = torch.bincount(image_indexes[keep], minlength=batch_size).tolist()
+    return list(zip(box_probs.split(counts), labels.split(counts)))
+
+
 def nms(box_scores, nms_method=None, score_threshold=None, iou_threshold=None,
-        sigma=0.5, top_k=-1, candidate_size=200):
+        sigma=0.5, top_k=-1, candidate_size=200, soft_method="gaussian"):
     if nms_method == "soft":
-        return soft_nms(box_scores, score_threshold, sigma, top_k)
+        return soft_nms(box_scores, score_threshold, sigma, top_k, method=soft_method, iou_threshold=iou_threshold)
     else:
         return hard_nms(box_scores, iou_threshold, top_k, candidate_size=candidate_size)
 
 
-def soft_nms(box_scores, score_threshold, sigma=0.5, top_k=-1):
+def _soft_nms_picks(boxes, scores, labels, score_threshold, sigma=0.5, top_k=-1, method="gaussian",
+                    iou_threshold=0.3, candidate_size=-1):
+    """Run Soft-NMS on every label on its own, with score decays taken from a precomputed IoU matrix.
+
+    Boxes of different labels never decay each other, so only the IoU matrix of the boxes of a label is
+    computed, and the memory stays quadratic in the candidates of the largest label.
+
+    Args:
+        top_k: keep top_k results per label. If k <= 0, keep all the results.
+        candidate_size: only consider the candidates with the highest scores of every label. If <= 0,
+            consider them all.
+    Returns:
+        picked: indexes of the picked boxes, ordered by label and then by pick order.
+        picked_scores: the decayed score of every picked box at the time it was picked.
+    """
+    _, order = scores.sort(descending=True)
+    # order by label first, keeping the descending scores inside each label.
+    key = labels[order] * order.size(0) + torch.arange(order.size(0), device=order.device)
+    order = order[key.argsort()]
+    if candidate_size > 0:
+        order = order[_group_ranks(labels[order]) < candidate_size]
+    _, counts = torch.unique_consecutive(labels[order], return_counts=True)
+
+    picked = []
+    picked_scores = []
+    for group in order.split(counts.tolist()):
+        group_boxes = boxes[group]
+        ious = iou_of(group_boxes.unsqueeze(1), group_boxes.unsqueeze(0))
+        if method == "linear":
+            decays = torch.where(ious > iou_threshold, 1 - ious, torch.ones_like(ious))
+        elif method == "gaussian":
+            decays = torch.exp(-(ious * ious) / sigma)
+        else:
+            raise ValueError(f"Soft-NMS method {method} is not supported.")
+
+        group_scores = scores[group]
+        alive = torch.ones(group.size(0), dtype=torch.bool, device=scores.device)
+        num_picked = 0
+        while alive.any() and (top_k <= 0 or num_picked < top_k):
+            max_score_index = group_scores.masked_fill(~alive, -math.inf).argmax()
+            picked.append(group[max_score_index])
+            picked_scores.append(group_scores[max_score_index])
+            num_picked += 1
+            alive[max_score_index] = False
+            group_scores = group_scores * decays[max_score_index]
+            alive &= group_scores > score_threshold
+    if not picked:
+        return order.new_zeros(0), scores.new_zeros(0)
+    return torch.stack(picked), torch.stack(picked_scores)
+
+
+def soft_nms(box_scores, score_threshold, sigma=0.5, top_k=-1, method="gaussian", iou_threshold=0.3):
     """Soft NMS implementation.
 
+    The pairwise IoU matrix is computed once and the scores of all the remaining boxes are decayed with
+    bulk tensor operations after every pick.
+
     References:
         https://arxiv.org/abs/1704.04503
         https://github.com/facebookresearch/Detectron/blob/master/detectron/utils/cython_nms.pyx
@@ -278,26 +622,180 @@ def soft_nms(box_scores, score_threshold, sigma=0.5, top_k=-1):
         sigma: the parameter in score re-computation.
             scores[i] = scores[i] * exp(-(iou_i)^2 / simga)
         top_k: keep top_k results. If k <= 0, keep all the results.
+        method: "gaussian" for the re-computation above, or "linear" for
+            scores[i] = scores[i] * (1 - iou_i) if iou_i > iou_threshold.
+        iou_threshold: the overlap from which the linear method decays scores.
     Returns:
          picked_box_scores (K, 5): results of NMS.
     """
-    picked_box_scores = []
-    while box_scores.size(0) > 0:
-        max_score_index = torch.argmax(box_scores[:, 4])
-        cur_box_prob = torch.tensor(box_scores[max_score_index, :])
-        picked_box_scores.append(cur_box_prob)
-        if len(picked_box_scores) == top_k > 0 or box_scores.size(0) == 1:
-            break
-        cur_box = cur_box_prob[:-1]
-        box_scores[max_score_index, :] = box_scores[-1, :]
-        box_scores = box_scores[:-1, :]
-        ious = iou_of(cur_box.unsqueeze(0), box_scores[:, :-1])
-        box_scores[:, -1] = box_scores[:, -1] * torch.exp(-(ious * ious) / sigma)
-        box_scores = box_scores[box_scores[:, -1] > score_threshold, :]
-    if len(picked_box_scores) > 0:
-        return torch.stack(picked_box_scores)
-    else:
+    if box_scores.size(0) == 0:
         return torch.tensor([])
+    labels = torch.zeros(box_scores.size(0), dtype=torch.long, device=box_scores.device)
+    picked, picked_scores = _soft_nms_picks(box_scores[:, :-1], box_scores[:, -1], labels, score_threshold,
+                                            sigma=sigma, top_k=top_k, method=method, iou_threshold=iou_threshold)
+    return torch.cat([box_scores[picked, :-1], picked_scores.unsqueeze(1)], 1)
+
+
+def batched_class_aware_soft_nms(boxes, scores, prob_threshold, sigma=0.5, top_k=-1, method="gaussian",
+                                 iou_threshold=0.3, candidate_size=-1):
+    """Class-aware Soft-NMS of a whole batch of SSD outputs in one call.
 
+    Args:
+        boxes (batch_size, num_priors, 4): boxes in corner-form.
+        scores (batch_size, num_priors, num_classes): probabilities, class 0 being the background.
+        prob_threshold: only the scores above this value are considered.
+        sigma, top_k, method, iou_threshold: as in soft_nms, applied per image and class.
+        candidate_size: only consider the candidates with the highest scores of every image and class. If
+            <= 0, consider them all, as soft_nms does.
+    Returns:
+        a list with, for every image, the kept box_probs (K, 5) and their labels (K), ordered by label
+         and then by pick order.
+    """
+    batch_size, _, num_classes = scores.size()
+    image_indexes, prior_indexes, class_indexes = (scores[:, :, 1:] > prob_threshold).nonzero().t()
+    if image_indexes.size(0) == 0:
+        return [(boxes.new_zeros((0, 5)), class_indexes) for _ in range(batch_size)]
+    class_indexes = class_indexes + 1
+    candidate_boxes = boxes[image_indexes, prior_indexes]
+    groups = image_indexes * num_classes + class_indexes
+    picked, picked_scores = _soft_nms_picks(candidate_boxes, scores[image_indexes, prior_indexes, class_indexes],
+                                            groups, prob_threshold, sigma=sigma, top_k=top_k, method=method,
+                                            iou_threshold=iou_threshold, candidate_size=candidate_size)
+    box_probs = torch.cat([candidate_boxes[picked], picked_scores.unsqueeze(1)], 1)
+    labels = class_indexes[picked]
+    counts = torch.bincount(image_indexes[picked], minlength=batch_size).tolist()
+    return list(zip(box_probs.split(counts), labels.split(counts)))
+
+
+def unrotate_boxes(boxes, Matrix, factor):
+    """Map boxes predicted on a deskewed input back to the input, see imJnet_ssd.rotate_map.
+
+    Args:
+        boxes (N, 4): corner form boxes in pixels of the deskewed input.
+        Matrix (2, 3): the matrix mapping the deskewed input back to the input.
+        factor: the (x, y) size factor between the input and the rotation canvas.
+    Returns:
+        boxes (N, 4): the axis aligned bounds of the rotated boxes, in pixels of the input.
+    """
+    Matrix = torch.as_tensor(Matrix, dtype=boxes.dtype, device=boxes.device)
+    factor = torch.as_tensor(factor, dtype=boxes.dtype, device=boxes.device)
+    corners = torch.stack([boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]], 1) / factor
+    corners = corners @ Matrix[:, :2].t() + Matrix[:, 2]
+    return torch.cat([corners.min(1)[0], corners.max(1)[0]], 1)
 
 
+def _seam_fragments(boxes, labels, tiles, tile_boxes, seam_margin, align_threshold):
+    """Pairs of boxes of an object cut by the seams of two overlapping tiles, one fragment in each tile.
+
+    Along x, box i of a tile meets box j of a tile further right when i reaches the right seam of its tile, j
+    reaches the left seam of its own tile, the two overlap on x and their y extents have an IoU above
+    align_threshold. The same goes along y.
+    Returns:
+        fragments (N, N): the symmetric boolean matrix of the pairs, only between boxes of the same label.
+    """
+    own = tile_boxes[tiles]
+    image_right_bottom = tile_boxes[:, 2:].max(0)[0]
+    fragments = torch.zeros(boxes.size(0), boxes.size(0), dtype=torch.bool, device=boxes.device)
+    for axis in range(2):
+        other = 1 - axis
+        far = (boxes[:, axis + 2] >= own[:, axis + 2] - seam_margin) & (own[:, axis + 2] < image_right_bottom[axis])
+        near = (boxes[:, axis] <= own[:, axis] + seam_margin) & (own[:, axis] > 0)
+        meet = (far[:, None] & near[None, :] &
+                (own[None, :, axis] > own[:, None, axis]) & (own[None, :, axis] < own[:, None, axis + 2]) &
+                (boxes[None, :, axis] < boxes[:, None, axis + 2]))
+        overlap = (torch.min(boxes[:, None, other + 2], boxes[None, :, other + 2]) -
+                   torch.max(boxes[:, None, other], boxes[None, :, other])).clamp(min=0)
+        union = (torch.max(boxes[:, None, other + 2], boxes[None, :, other + 2]) -
+                 torch.min(boxes[:, None, other], boxes[None, :, other]))
+        fragments |= meet & (overlap / (union + 1e-5) > align_threshold)
+    fragments &= labels[:, None] == labels[None, :]
+    return fragments | fragments.t()
+
+
+def _connected_components(adjacency):
+    """Smallest index of the connected component of every node of a symmetric boolean adjacency matrix."""
+    num_nodes = adjacency.size(0)
+    components = torch.arange(num_nodes, device=adjacency.device)
+    while True:
+        neighbours = components[None, :].expand(num_nodes, num_nodes).masked_fill(~adjacency, num_nodes)
+        new_components = torch.min(components, neighbours.min(1)[0])
+        # jump to the component of the component, which halves the remaining path lengths
+        new_components = new_components[new_components]
+        if torch.equal(new_components, components):
+            return components
+        components = new_components
+
+
+def seam_aware_nms(boxes, scores, labels, tiles, tile_boxes, iou_threshold, seam_margin=4.0, align_threshold=0.5):
+    """Merge the detections of the overlapping tiles of an image.
+
+    Only the boxes reaching into another tile than their own can duplicate a detection of that tile, so the
+    merging runs on them alone. First, the fragments of an object longer than the tile overlap, cut by the seams
+    of every tile it crosses, are fused: fragments meeting across a seam (see _seam_fragments) are chained and
+    replaced by the union of their boxes, with the best score of the chain. Then a box of one tile suppresses
+    the boxes of other tiles it overlaps by more than iou_threshold in IoU or in intersection over the smaller
+    box, which removes the cut copies of an object seen whole by another tile. Boxes touching a seam, a tile
+    edge inside the image, are likely cut and rank after the others, then by descending score.
+    Args:
+        boxes (N, 4): corner form boxes in pixels of the image.
+        scores (N): probabilities.
+        labels (N): class indexes, boxes of different labels are never merged.
+        tiles (N): the tile of every box.
+        tile_boxes (T, 4): the corner form extent of every tile in pixels of the image.
+        iou_threshold: the overlap threshold.
+        seam_margin: the distance in pixels under which a box touches a seam.
+        align_threshold: the IoU of their extents along a seam above which two cut boxes are fused.
+    Returns:
+        keep: indexes of the kept boxes, ordered by label and then by descending score.
+        boxes (N, 4): the boxes, those of the kept fused fragments being replaced by their union.
+    """
+    if boxes.size(0) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device), boxes
+    image_right_bottom = tile_boxes[:, 2:].max(0)[0]
+    own = tile_boxes[tiles]
+    seams = torch.cat([own[:, :2] > 0, own[:, 2:] < image_right_bottom], 1)
+    near = torch.cat([boxes[:, :2] - own[:, :2], own[:, 2:] - boxes[:, 2:]], 1) <= seam_margin
+    cut = (seams & near).any(1)
+    reach = ((boxes[:, None, :2] < tile_boxes[None, :, 2:]).all(2) &
+             (boxes[:, None, 2:] > tile_boxes[None, :, :2]).all(2))
+    reach[torch.arange(boxes.size(0), device=boxes.device), tiles] = False
+
+    keep = torch.ones(boxes.size(0), dtype=torch.bool, device=boxes.device)
+    shared = reach.any(1).nonzero().squeeze(1)
+    if shared.numel() > 0:
+        fragments = _seam_fragments(boxes[shared], labels[shared], tiles[shared], tile_boxes, seam_margin,
+                                    align_threshold)
+        if fragments.any():
+            components = _connected_components(fragments)
+            separate = (components[:, None] != components[None, :]).unsqueeze(2)
+            shared_boxes = boxes[shared][None, :, :].expand(shared.size(0), -1, -1)
+            best = scores[shared][None, :].expand(shared.size(0), -1).masked_fill(separate[:, :, 0], -math.inf)
+            fused = best.argmax(1) == torch.arange(shared.size(0), device=boxes.device)
+            fused_boxes = torch.cat([shared_boxes[:, :, :2].masked_fill(separate, math.inf).min(1)[0],
+                                     shared_boxes[:, :, 2:].masked_fill(separate, -math.inf).max(1)[0]], 1)
+            chained = fragments.any(1)
+            boxes = boxes.clone()
+            boxes[shared[fused & chained]] = fused_boxes[fused & chained]
+            cut[shared[fused & chained]] = False
+            keep[shared[~fused]] = False
+            shared = shared[fused]
+
+        order = shared[torch.sort(scores[shared], descending=True, stable=True)[1]]
+        order = order[torch.sort(cut[order].long(), stable=True)[1]]
+        order = order[torch.sort(labels[order], stable=True)[1]]
+        sorted_boxes = boxes[order]
+        overlap_area = area_of(torch.max(sorted_boxes[:, None, :2], sorted_boxes[None, :, :2]),
+                               torch.min(sorted_boxes[:, None, 2:], sorted_boxes[None, :, 2:]))
+        areas = area_of(sorted_boxes[:, :2], sorted_boxes[:, 2:])
+        ious = overlap_area / (areas[:, None] + areas[None, :] - overlap_area + 1e-5)
+        smaller_overlaps = overlap_area / (torch.min(areas[:, None], areas[None, :]) + 1e-5)
+        sorted_tiles = tiles[order]
+        overlaps = torch.where(sorted_tiles[:, None] != sorted_tiles[None, :],
+                               torch.max(ious, smaller_overlaps), ious)
+        sorted_labels = labels[order]
+        overlaps = overlaps.masked_fill(sorted_labels[:, None] != sorted_labels[None, :], 0.0)
+        keep[order] = _greedy_keep(overlaps, iou_threshold)
+
+    kept = keep.nonzero().squeeze(1)
+    kept = kept[torch.sort(scores[kept], descending=True, stable=True)[1]]
+    return kept[torch.sort(labels[kept], stable=True)[1]], boxes
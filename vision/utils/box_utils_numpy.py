@@ -1,7 +1,6 @@
-from .box_utils import SSDSpec
+from .box_utils import SSDSpec, _specs_key
 
 from typing import List
-import itertools
 import math
 import numpy as np
 
@@ -26,55 +25,45 @@ def generate_ssd_priors(specs: List[SSDSpec], image_size, clamp=True):
         priors (num_priors, 4): The prior boxes represented as [[center_x, center_y, w, h]]. All the values
             are relative to the image size.
     """
-    priors = []
-    for spec in specs:
-        scale = image_size / spec.shrinkage
-        for j, i in itertools.product(range(spec.feature_map_size), repeat=2):
-            x_center = (i + 0.5) / scale
-            y_center = (j + 0.5) / scale
-
-            # small sized square box
-            size = spec.box_sizes.min
-            h = w = size / image_size
-            priors.append([
-                x_center,
-                y_center,
-                w,
-                h
-            ])
-
-            # big sized square box
-            size = math.sqrt(spec.box_sizes.max * spec.box_sizes.min)
-            h = w = size / image_size
-            priors.append([
-                x_center,
-                y_center,
-                w,
-                h
-            ])
-
-            # change h/w ratio of the small sized box
-            size = spec.box_sizes.min
-            h = w = size / image_size
-            for ratio in spec.aspect_ratios:
-                ratio = math.sqrt(ratio)
-                priors.append([
-                    x_center,
-                    y_center,
-                    w * ratio,
-                    h / ratio
-                ])
-                priors.append([
-                    x_center,
-                    y_center,
-                    w / ratio,
-                    h * ratio
-                ])
-
-    priors = np.array(priors, dtype=np.float32)
-    if clamp:
-        np.clip(priors, 0.0, 1.0, out=priors)
-    return priors
+    key = (_specs_key(specs), image_size, clamp)
+    if key not in _priors_cache:
+        levels = []
+        for spec in specs:
+            scale = image_size / spec.shrinkage
+            # computed in float64 like the python floats they replace, so the float32 priors are unchanged
+            centers = (np.arange(spec.feature_map_size, dtype=np.float64) + 0.5) / scale
+            y_center, x_center = np.meshgrid(centers, centers, indexing='ij')
+            shapes = np.array(_prior_shapes(spec, image_size), dtype=np.float64)
+            size, num_shapes = spec.feature_map_size, len(shapes)
+            centers = np.broadcast_to(np.stack([x_center, y_center], -1)[:, :, None], (size, size, num_shapes, 2))
+            shapes = np.broadcast_to(shapes, (size, size, num_shapes, 2))
+            levels.append(np.concatenate([centers, shapes], -1).reshape(-1, 4))
+        priors = np.concatenate(levels).astype(np.float32)
+        if clamp:
+            np.clip(priors, 0.0, 1.0, out=priors)
+        _priors_cache[key] = priors
+    return _priors_cache[key].copy()
+
+
+# generated priors by specs, image size and clamp, shared by the configs of a process
+_priors_cache = {}
+
+
+def _prior_shapes(spec: SSDSpec, image_size):
+    """The (w, h) of the priors of every location of spec, in their order."""
+    # small sized square box
+    size = spec.box_sizes.min
+    w = size / image_size
+    shapes = [(w, w)]
+    # big sized square box
+    big = math.sqrt(spec.box_sizes.max * spec.box_sizes.min) / image_size
+    shapes.append((big, big))
+    # change h/w ratio of the small sized box, both ways
+    for ratio in spec.aspect_ratios:
+        ratio = math.sqrt(ratio)
+        shapes.append((w * ratio, w / ratio))
+        shapes.append((w / ratio, w * ratio))
+    return shapes
 
 
 def convert_locations_to_boxes(locations, priors, center_variance,
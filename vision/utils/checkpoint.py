@@ -0,0 +1,150 @@
+import logging
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy every tensor of a (nested) state to the CPU, so training can go on modifying the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    # the numpy keys are kept as a tensor so the state only holds tensors and plain python values
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian),
+        'random': random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    name, keys, position, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def state_path(model_path):
+    """The file holding the optimizer, epoch and RNG state saved along with the weights in model_path."""
+    root, ext = os.path.splitext(model_path)
+    return f"{root}-state{ext}"
+
+
+def restore_training_state(model_path, optimizer=None):
+    """Restore the optimizer and RNG state saved with the weights in model_path.
+
+    Returns:
+        the saved training state, holding the epoch and the score, or None when there is none.
+    """
+    path = state_path(model_path)
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location=lambda storage, loc: storage)
+    if optimizer is not None and state.get('optimizer') is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    set_rng_state(state['rng'])
+    return state
+
+
+class CheckpointManager:
+
+    def __init__(self, folder, keep_best=3, keep_last=2, higher_is_better=False):
+        """Save checkpoints on a background thread and keep the keep_best best and keep_last latest ones.
+
+        The weights are saved as a plain state_dict, loadable by the nets' load, and the optimizer, epoch,
+         RNG state and score next to them, see state_path. The states are copied to the CPU before save
+         returns, so training can go on while they are written.
+        Args:
+            keep_best: the number of best scored checkpoints kept, all of them are kept if negative.
+            keep_last: the number of latest checkpoints kept, the newest one is always kept.
+            higher_is_better: whether a higher score is better, a loss is not.
+        """
+        self.folder = folder
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.higher_is_better = higher_is_better
+        self.checkpoints = []
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def save(self, net, name, score, epoch=None, optimizer=None, extra=None):
+        """Queue the checkpoint and return the path its weights will be written to."""
+        self._raise_error()
+        model_path = os.path.join(self.folder, f"{name}.pth")
+        state = {
+            'epoch': epoch,
+            'score': score,
+            'optimizer': snapshot(optimizer.state_dict()) if optimizer is not None else None,
+            'rng': rng_state(),
+            'extra': extra,
+        }
+        self._queue.put((model_path, snapshot(net.state_dict()), state, score))
+        return model_path
+
+    def wait(self):
+        """Block until every queued checkpoint is written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                model_path, net_state, state, score = item
+                for path, obj in [(state_path(model_path), state), (model_path, net_state)]:
+                    tmp_path = path + ".tmp"
+                    torch.save(obj, tmp_path)
+                    os.replace(tmp_path, path)
+                self.checkpoints.append((model_path, score))
+                self._rotate()
+            except Exception as e:
+                logging.error(f"Failed to save checkpoint: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _rotate(self):
+        if self.keep_best < 0:
+            return
+        # the newest checkpoint is the path save just returned, it is kept whatever keep_last is
+        kept = {path for path, _ in self.checkpoints[-max(self.keep_last, 1):]}
+        ranked = sorted(self.checkpoints, key=lambda checkpoint: checkpoint[1], reverse=self.higher_is_better)
+        kept.update(path for path, _ in ranked[:self.keep_best])
+        for path, _ in self.checkpoints:
+            if path not in kept:
+                for obsolete in [path, state_path(path)]:
+                    if os.path.exists(obsolete):
+                        os.remove(obsolete)
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[0] in kept]
@@ -0,0 +1,54 @@
+import contextlib
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Let the main process build the shared caches before the other processes read them."""
+    if not is_main_process():
+        dist.barrier()
+    yield
+    if is_distributed() and is_main_process():
+        dist.barrier()
+
+
+def make_loader(dataset, batch_size, shuffle, num_workers=0, collate_fn=None):
+    # every process of a distributed run loads its own shard of the dataset
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if is_distributed() else None
+    return DataLoader(dataset, batch_size,
+                      num_workers=num_workers,
+                      collate_fn=collate_fn,
+                      shuffle=shuffle and sampler is None,
+                      sampler=sampler)
+
+
+def all_reduce_mean(values, device):
+    """Average the floats of every process, like the losses of the validation shards."""
+    if not is_distributed():
+        return list(values)
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(values)
+    return (values / dist.get_world_size()).tolist()
+
+
+def save_checkpoint(checkpoints, net, name, score, **kwargs):
+    """Save net with the CheckpointManager on the main process only, every process holding the same weights.
+
+    Returns:
+        the path of the saved weights, None on the other processes.
+    """
+    if not is_main_process():
+        return None
+    return checkpoints.save(net, name, score, **kwargs)
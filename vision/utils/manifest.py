@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import uuid
+
+
+def file_digest(*paths):
+    """Hash of the contents of the files, the identity of a source page."""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GenerationManifest:
+
+    def __init__(self, manifest_file, settings=None):
+        """The source pages a generation run has finished, so that a rerun only processes new or modified ones.
+
+        The manifest is a json lines log: its settings, then one {"id", "hash", "outputs"} line appended and
+        flushed to disk as every page finishes, later lines overriding earlier ones. A run dying halfway loses at
+        most the line being written, which is ignored. A manifest written with other settings is started over.
+        Args:
+            manifest_file: the log file, created when missing.
+            settings: what the outputs depend on besides the pages, like the model, as a json serializable dict.
+        """
+        self.manifest_file = pathlib.Path(manifest_file)
+        self.settings = settings or {}
+        self.pages = {}
+        if self.manifest_file.exists():
+            self._load()
+        else:
+            self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            self.compact()
+        self._file = open(self.manifest_file, "a")
+
+    def is_done(self, page_id, digest):
+        return page_id in self.pages and self.pages[page_id]['hash'] == digest
+
+    def outputs(self, page_id):
+        """The outputs recorded for page_id by the last run finishing it."""
+        return self.pages[page_id]['outputs'] if page_id in self.pages else []
+
+    def record(self, page_id, digest, outputs=()):
+        """Mark page_id as finished, once its outputs are completely written."""
+        entry = {'id': page_id, 'hash': digest, 'outputs': list(outputs)}
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.pages[page_id] = entry
+
+    def compact(self):
+        """Rewrite the log with a single line per page."""
+        tmp_file = self.manifest_file.with_name(f"{self.manifest_file.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps({'settings': self.settings}) + "\n")
+            for entry in self.pages.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_file, self.manifest_file)
+
+    def close(self):
+        self._file.close()
+        self.compact()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load(self):
+        with open(self.manifest_file) as f:
+            lines = f.read().splitlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Ignoring a truncated line of the manifest {self.manifest_file}.")
+        if not entries or entries[0].get('settings') != json.loads(json.dumps(self.settings)):
+            logging.info("The settings changed, every page is processed again.")
+            self.compact()
+            return
+        for entry in entries[1:]:
+            self.pages[entry['id']] = entry
+        # the truncated lines are dropped from the log
+        self.compact()
@@ -30,3 +30,65 @@ def compute_voc2007_average_precision(precision, recall):
             p = np.max(precision[recall >= t])
         ap = ap + p / 11.
     return ap
+
+
+def iou_matrix(boxes0, boxes1):
+    """Intersection over union of every pair of corner form boxes (N, 4) and (M, 4), as a (N, M) array."""
+    left_top = np.maximum(boxes0[:, None, :2], boxes1[None, :, :2])
+    right_bottom = np.minimum(boxes0[:, None, 2:], boxes1[None, :, 2:])
+    overlap_area = np.prod(np.clip(right_bottom - left_top, 0.0, None), axis=2)
+    area0 = np.prod(np.clip(boxes0[:, 2:] - boxes0[:, :2], 0.0, None), axis=1)
+    area1 = np.prod(np.clip(boxes1[:, 2:] - boxes1[:, :2], 0.0, None), axis=1)
+    return overlap_area / (area0[:, None] + area1[None, :] - overlap_area + 1e-5)
+
+
+def match_detections(image_ids, scores, boxes, gt_image_ids, gt_boxes, gt_difficult, iou_threshold=0.5):
+    """Match the detections of a class to its ground truth boxes, the Pascal way.
+
+    Every detection is matched to the ground truth box of its image it overlaps most. Going by descending score,
+    the first detection matched to a box above iou_threshold is a true positive and the following ones are false
+    positives, detections matched to a difficult box count as neither.
+    Args:
+        image_ids (N,), scores (N,), boxes (N, 4): the detections.
+        gt_image_ids (M,), gt_boxes (M, 4), gt_difficult (M,): the ground truth boxes.
+    Returns:
+        true_positive, false_positive (N,): 0/1 flags of the detections sorted by descending score.
+    """
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    image_ids = np.asarray(image_ids)[order]
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)[order]
+    gt_image_ids = np.asarray(gt_image_ids)
+    gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+    gt_difficult = np.asarray(gt_difficult, dtype=bool)
+
+    matched = np.full(len(order), -1, dtype=np.int64)
+    max_ious = np.zeros(len(order))
+    for image_id in np.intersect1d(image_ids, gt_image_ids):
+        detections = np.nonzero(image_ids == image_id)[0]
+        gts = np.nonzero(gt_image_ids == image_id)[0]
+        ious = iou_matrix(boxes[detections], gt_boxes[gts])
+        best = ious.argmax(axis=1)
+        matched[detections] = gts[best]
+        max_ious[detections] = ious[np.arange(len(detections)), best]
+
+    hit = (matched >= 0) & (max_ious > iou_threshold)
+    ignored = hit & gt_difficult[np.maximum(matched, 0)]
+    counted = np.nonzero(hit & ~ignored)[0]
+    # np.unique returns the first, so highest scored, detection matched to every box
+    _, first = np.unique(matched[counted], return_index=True)
+    true_positive = np.zeros(len(order))
+    true_positive[counted[first]] = 1
+    false_positive = (~hit).astype(np.float64)
+    false_positive[counted] = 1 - true_positive[counted]
+    return true_positive, false_positive
+
+
+def average_precision(true_positive, false_positive, num_true_cases, use_2007_metric=True):
+    """The average precision of the detections flagged by match_detections."""
+    true_positive = np.cumsum(true_positive)
+    false_positive = np.cumsum(false_positive)
+    precision = true_positive / np.maximum(true_positive + false_positive, 1e-12)
+    recall = true_positive / max(num_true_cases, 1)
+    if use_2007_metric:
+        return compute_voc2007_average_precision(precision, recall)
+    return compute_average_precision(precision, recall)
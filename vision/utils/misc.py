@@ -21,6 +21,38 @@ class Timer:
         return interval
         
 
+class RunningSums:
+    def __init__(self):
+        """Running sums of scalar tensors, kept on their device until they are read.
+
+        Adding a value does not wait for the device, only totals and means copy them to the host.
+        """
+        self.sums = {}
+        self.count = 0
+
+    def add(self, count=1, **values):
+        for name, value in values.items():
+            value = value.detach() if torch.is_tensor(value) else torch.tensor(float(value))
+            self.sums[name] = self.sums[name] + value if name in self.sums else value.clone()
+        self.count += count
+
+    def totals(self):
+        """The sums as python floats, read from the device at once."""
+        names = list(self.sums)
+        if not names:
+            return {}
+        device = self.sums[names[0]].device
+        values = torch.stack([self.sums[name].to(device, torch.float64) for name in names]).tolist()
+        return dict(zip(names, values))
+
+    def means(self):
+        return {name: value / max(self.count, 1) for name, value in self.totals().items()}
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+
+
 def save_checkpoint(epoch, net_state_dict, optimizer_state_dict, best_score, checkpoint_path, model_path):
     torch.save({
         'epoch': epoch,
@@ -35,6 +67,13 @@ def load_checkpoint(checkpoint_path):
     return torch.load(checkpoint_path)
 
 
+def autocast(device, enabled=True):
+    """Mixed precision context for device: bfloat16 on CPU, float16 on GPU."""
+    device_type = torch.device(device).type
+    dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+
+
 def freeze_net_layers(net):
     for param in net.parameters():
         param.requires_grad = False